@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import statistics
+import subprocess
+import tempfile
+import urllib.request
+from pathlib import Path
+
+import toml
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+BATCH_SCRIPT = SCRIPT_DIR / "ollama-batch-process.py"
+MOCK_SCRIPT = SCRIPT_DIR / "ollama-mock-server.py"
+
+# Options passed through to ollama-mock-server.py unchanged
+MOCK_OPTIONS = [
+    "speeds", "tokens_per_second", "prefill_tokens_per_second", "parallel", "batch_scaling",
+    "output_tokens", "jitter", "failure_rate", "stall_rate", "stall_seconds", "load_seconds",
+]
+
+def write_prompts(path, count, min_words, max_words, seed):
+    """Write a reproducible JSONL file of synthetic prompts of varying length."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            words = " ".join(f"word{rng.randrange(1000)}" for _ in range(rng.randint(min_words, max_words)))
+            f.write(json.dumps({"id": f"bench-{i:05d}", "content": f"Write about {words}"}) + "\n")
+
+def write_config(path, base_config, model, ports, slots, work_dir):
+    """
+    Write the batch config for a run: the base config (if any) with its
+    instances replaced by the mock hosts and everything kept inside work_dir.
+    """
+    config = toml.load(base_config) if base_config else {}
+    config.setdefault("model", model)
+    config.setdefault("system_message", "You are a benchmark.")
+    config["ollama_instances"] = {f"127.0.0.1:{port}": {"gpu": i, "slots": slots} for i, port in enumerate(ports)}
+    config.setdefault("url_cache", {})["directory"] = str(Path(work_dir) / ".url_cache")
+    config.setdefault("metrics", {})["enabled"] = False
+    with open(path, 'w', encoding='utf-8') as f:
+        toml.dump(config, f)
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"Mock server did not start on port {port}")
+
+def mock_request(port, path, method="GET"):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", method=method)
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+def run_batch(config_path, prompts_path, output_dir, work_dir):
+    """
+    Run ollama-batch-process.py to completion. Returns (exit code, wall
+    seconds, CPU seconds, max RSS in MB) of the batch process alone.
+    """
+    started = time.monotonic()
+    with open(Path(work_dir) / "batch.log", 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, str(BATCH_SCRIPT), "--config", str(config_path), "--prompts", str(prompts_path),
+             "--output_dir", str(output_dir), "--no-notify"],
+            cwd=work_dir, stdout=log, stderr=subprocess.STDOUT,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - started
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return process.returncode, wall, usage.ru_utime + usage.ru_stime, rss_mb
+
+def summarize(host_stats, wall, cpu, rss_mb, exit_code):
+    """Reduce one run to its metrics."""
+    first = min((s["first_request"] for s in host_stats.values() if s["first_request"]), default=None)
+    last = max((s["last_finish"] for s in host_stats.values() if s["last_finish"]), default=None)
+    makespan = (last - first) if first and last else 0.0
+    utilization = {
+        host: (s["busy_seconds"] / makespan if makespan else 0.0) for host, s in host_stats.items()
+    }
+    eval_tokens = sum(s["eval_tokens"] for s in host_stats.values())
+    return {
+        "exit_code": exit_code,
+        "wall_seconds": round(wall, 3),
+        "makespan_seconds": round(makespan, 3),
+        "gpu_idle_fraction": round(1 - statistics.mean(utilization.values()), 4) if utilization else None,
+        "tokens_per_second": round(eval_tokens / makespan, 1) if makespan else 0.0,
+        "dispatcher_cpu_seconds": round(cpu, 3),
+        "dispatcher_max_rss_mb": round(rss_mb, 1),
+        "requests": sum(s["requests"] for s in host_stats.values()),
+        "failures": sum(s["failures"] for s in host_stats.values()),
+        "host_utilization": {host: round(u, 4) for host, u in utilization.items()},
+    }
+
+def median_summary(runs):
+    """Median of every numeric metric across repeated runs."""
+    keys = [key for key, value in runs[0].items() if isinstance(value, (int, float)) and value is not None]
+    result = {key: round(statistics.median(run[key] for run in runs), 4) for key in keys}
+    result["host_utilization"] = {
+        host: round(statistics.median(run["host_utilization"][host] for run in runs), 4)
+        for host in runs[0]["host_utilization"]
+    }
+    return result
+
+def print_report(label, summary, baseline=None):
+    print(f"\n{label}")
+    for key, value in summary.items():
+        if key == "host_utilization":
+            continue
+        line = f"  {key:<24} {value}"
+        if baseline and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            line += f"  ({(value - baseline[key]) / baseline[key]:+.1%} vs baseline)"
+        print(line)
+    for host, utilization in summary["host_utilization"].items():
+        print(f"  utilization {host:<16} {utilization:.1%}")
+
+def benchmark(args):
+    work_dir = Path(tempfile.mkdtemp(prefix="ollama-bench-"))
+    prompts_path = work_dir / "prompts.jsonl"
+    config_path = work_dir / "config.toml"
+    ports = [args.port + i for i in range(args.hosts)]
+    write_prompts(prompts_path, args.prompts, args.min_words, args.max_words, args.seed)
+    write_config(config_path, args.config, args.model, ports, args.slots, work_dir)
+
+    mock_command = [sys.executable, str(MOCK_SCRIPT), "--port", str(args.port), "--hosts", str(args.hosts),
+                    "--seed", str(args.seed)]
+    for option in MOCK_OPTIONS:
+        value = getattr(args, option)
+        if value is not None and value != "":
+            mock_command += [f"--{option.replace('_', '-')}", str(value)]
+
+    runs = []
+    mock = subprocess.Popen(mock_command, stdout=subprocess.DEVNULL)
+    try:
+        for port in ports:
+            wait_for_port(port)
+        for run_number in range(1, args.repeat + 1):
+            for port in ports:
+                mock_request(port, "/mock/reset", "POST")
+            # A fresh output directory, so nothing is skipped as unchanged
+            output_dir = work_dir / f"responses-{run_number}"
+            exit_code, wall, cpu, rss_mb = run_batch(config_path, prompts_path, output_dir, work_dir)
+            host_stats = {f"127.0.0.1:{port}": mock_request(port, "/mock/stats") for port in ports}
+            summary = summarize(host_stats, wall, cpu, rss_mb, exit_code)
+            runs.append(summary)
+            print(f"Run {run_number}/{args.repeat}: makespan {summary['makespan_seconds']}s, "
+                  f"idle {summary['gpu_idle_fraction']:.1%}, CPU {summary['dispatcher_cpu_seconds']}s"
+                  + ("" if exit_code == 0 else f", exit code {exit_code} (see {work_dir / 'batch.log'})"))
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    result = {
+        "label": args.label,
+        "settings": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+        "median": median_summary(runs),
+        "runs": runs,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["median"]
+    print_report(f"{args.label} (median of {len(runs)} run(s))", result["median"], baseline)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    print(f"Work directory: {work_dir}")
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ollama-batch-process.py against simulated Ollama hosts.")
+    parser.add_argument("--hosts", type=int, default=4, help="Number of simulated hosts (GPUs).")
+    parser.add_argument("--prompts", type=int, default=200, help="Number of synthetic prompts.")
+    parser.add_argument("--min-words", type=int, default=20, help="Shortest synthetic prompt in words.")
+    parser.add_argument("--max-words", type=int, default=400, help="Longest synthetic prompt in words.")
+    parser.add_argument("--slots", type=int, default=4, help="Batch client slots per host.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs to take the median of.")
+    parser.add_argument("--config", help="Base config.toml; its [ollama_instances] are replaced by the mock hosts.")
+    parser.add_argument("--model", default="mock-model", help="Model name when the base config has none.")
+    parser.add_argument("--port", type=int, default=18432, help="Port of the first mock host.")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the prompts and the mock hosts.")
+    parser.add_argument("--label", default="benchmark", help="Name of this run in the report.")
+    parser.add_argument("--save", help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against.")
+    mock_group = parser.add_argument_group("mock hosts (see ollama-mock-server.py)")
+    mock_group.add_argument("--speeds", default="", help="Comma-separated speed multiplier per host.")
+    mock_group.add_argument("--tokens-per-second", type=float, default=None)
+    mock_group.add_argument("--prefill-tokens-per-second", type=float, default=None)
+    mock_group.add_argument("--parallel", type=int, default=None)
+    mock_group.add_argument("--batch-scaling", type=float, default=None)
+    mock_group.add_argument("--output-tokens", type=int, default=None)
+    mock_group.add_argument("--jitter", type=float, default=None)
+    mock_group.add_argument("--failure-rate", type=float, default=None)
+    mock_group.add_argument("--stall-rate", type=float, default=None)
+    mock_group.add_argument("--stall-seconds", type=float, default=None)
+    mock_group.add_argument("--load-seconds", type=float, default=None)
+
+    benchmark(parser.parse_args())
@@ -9,13 +9,24 @@ import os
 import sys
 import platform
 from datetime import datetime
-from ollama import AsyncClient
+from ollama import AsyncClient, ResponseError
 from pathlib import Path
 import trafilatura
 from urllib.parse import urlparse
 import aiohttp
+import aiohttp.web
+import httpx
 from typing import List, Tuple, Dict
 import traceback
+import hashlib
+import math
+import threading
+import functools
+import socket
+import sqlite3
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from response_cleaning import DEFAULT_CLEANER, ResponseCleaner, clean_in_worker, init_worker
 
 def safe_print(message):
     """Safely print messages, handling encoding issues that may occur with emojis."""
@@ -82,21 +93,232 @@ def show_notification(title, message):
     
     return True  # Return success for non-Windows platforms
 
-async def fetch_url_content(url: str) -> str:
-    """Fetch and clean content from a URL using trafilatura."""
-    log_message(f"Attempting to fetch content from URL: {url}")
+def extract_text(html):
+    """Extract the main text from downloaded HTML. Runs in a worker process."""
+    return trafilatura.extract(html)
+
+class UrlContentCache:
+    """
+    On-disk cache of extracted URL text, one JSON file per URL.
+
+    Entries younger than `ttl` seconds are served as-is; older ones keep
+    their ETag/Last-Modified validators so the fetcher can revalidate them
+    with a conditional request. The directory is bounded to `max_bytes`,
+    evicting the least recently used entries first. Methods do blocking
+    file I/O and are meant to be called through asyncio.to_thread().
+    """
+
+    def __init__(self, directory, ttl=86400.0, max_bytes=512 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {}  # cache file name -> (size in bytes, last access time)
+        self._total_bytes = 0
+
+    def load(self):
+        """Create the cache directory and index the entries already on disk."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._index.clear()
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    self._index[entry.name] = (stat.st_size, stat.st_mtime)
+            self._total_bytes = sum(size for size, _ in self._index.values())
+        log_message(f"URL cache: {len(self._index)} entries, {self._total_bytes / 1e6:.1f} MB in {self.directory}")
+
+    def _filename(self, url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, url):
+        """Return the cached entry for a URL, or None, and mark it as recently used."""
+        filename = self._filename(url)
+        path = self.directory / filename
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if entry.get("url") != url:
+            return None
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            if filename in self._index:
+                self._index[filename] = (self._index[filename][0], now)
+        return entry
+
+    def is_fresh(self, entry):
+        """True if the entry is younger than the TTL."""
+        return time.time() - entry.get("fetched_at", 0) < self.ttl
+
+    def put(self, url, text, etag=None, last_modified=None):
+        """Store extracted text for a URL and evict old entries if over budget."""
+        entry = {
+            "url": url,
+            "fetched_at": time.time(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "text": text,
+        }
+        filename = self._filename(url)
+        path = self.directory / filename
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        size = path.stat().st_size
+        with self._lock:
+            previous_size, _ = self._index.get(filename, (0, 0))
+            self._index[filename] = (size, time.time())
+            self._total_bytes += size - previous_size
+            self._evict()
+        return entry
+
+    def touch(self, url, entry):
+        """Record a successful revalidation by restarting the entry's TTL."""
+        return self.put(url, entry["text"], entry.get("etag"), entry.get("last_modified"))
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        for filename, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self.directory / filename)
+            except OSError:
+                pass
+            del self._index[filename]
+            self._total_bytes -= size
+
+class ContextFetcher:
+    """
+    Downloads reference URLs and extracts their text without blocking the event loop.
+
+    Downloads share one aiohttp session whose connector caps connections per
+    domain and in total; trafilatura extraction, which is CPU-heavy, runs in a
+    process pool (or a thread when extract_workers is 0). With a
+    UrlContentCache, extracted text is reused across prompts and runs, and
+    concurrent requests for the same URL share a single fetch.
+    """
+
+    def __init__(self, timeout=30.0, per_domain_limit=4, max_connections=32, extract_workers=None, cache=None):
+        self.timeout = timeout
+        self.per_domain_limit = per_domain_limit
+        self.max_connections = max_connections
+        self.extract_workers = extract_workers
+        self.cache = cache
+        self.session = None
+        self.executor = None
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "deduplicated": 0}
+        self.download_seconds = Histogram(LATENCY_BUCKETS)
+        self._in_flight = {}
+
+    async def start(self):
+        """Open the shared HTTP session, the extraction process pool and the cache."""
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.per_domain_limit)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; ollama-batch-cluster)"},
+        )
+        if self.extract_workers != 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.extract_workers)
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.load)
+
+    async def close(self):
+        """Close the HTTP session and shut down the process pool."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def download(self, url, headers=None):
+        """Download a URL and return (status, response headers, raw body)."""
+        async with self.session.get(url, headers=headers) as response:
+            body = await response.read() if response.status == 200 else None
+            return response.status, response.headers, body
+
+    async def extract(self, html):
+        """Run trafilatura extraction off the event loop."""
+        if self.executor is None:
+            return await asyncio.to_thread(extract_text, html)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, extract_text, html)
+
+    async def fetch(self, url):
+        """Return the extracted text for a URL, sharing one fetch between concurrent callers."""
+        task = self._in_flight.get(url)
+        if task is not None:
+            self.stats["deduplicated"] += 1
+            return await asyncio.shield(task)
+        task = asyncio.ensure_future(self._fetch(url))
+        self._in_flight[url] = task
+        task.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, url):
+        entry = None
+        headers = {}
+        if self.cache is not None:
+            entry = await asyncio.to_thread(self.cache.get, url)
+            if entry is not None:
+                if self.cache.is_fresh(entry):
+                    self.stats["hits"] += 1
+                    log_message(f"Using cached content for {url} ({len(entry['text'])} characters)")
+                    return entry["text"]
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+
+        log_message(f"Attempting to fetch content from URL: {url}")
+        download_started = time.monotonic()
+        status, response_headers, downloaded = await self.download(url, headers or None)
+        self.download_seconds.observe(None, time.monotonic() - download_started)
+        if status == 304 and entry is not None:
+            self.stats["revalidated"] += 1
+            log_message(f"Cached content for {url} is still current")
+            await asyncio.to_thread(self.cache.touch, url, entry)
+            return entry["text"]
+        if not downloaded:
+            log_message(f"Failed to download content from {url}: HTTP {status}")
+            return ""
+
+        self.stats["misses"] += 1
+        log_message(f"Successfully downloaded content from {url}")
+        text = await self.extract(downloaded)
+        if not text:
+            log_message(f"Failed to extract text from {url}")
+            return ""
+        text = text.strip()
+        log_message(f"Successfully extracted text from {url} ({len(text)} characters)")
+        if self.cache is not None:
+            await asyncio.to_thread(
+                self.cache.put, url, text,
+                response_headers.get("ETag"), response_headers.get("Last-Modified"),
+            )
+        return text
+
+async def fetch_url_content(url: str, fetcher: "ContextFetcher") -> str:
+    """Fetch and clean content from a URL using the shared fetcher."""
     try:
-        downloaded = trafilatura.fetch_url(url)
-        if downloaded:
-            log_message(f"Successfully downloaded content from {url}")
-            text = trafilatura.extract(downloaded)
-            if text:
-                log_message(f"Successfully extracted text from {url} ({len(text)} characters)")
-                return text.strip()
-            else:
-                log_message(f"Failed to extract text from {url}")
-        else:
-            log_message(f"Failed to download content from {url}")
+        return await fetcher.fetch(url)
     except Exception as e:
         log_message(f"Error fetching {url}: {e}")
         traceback.print_exc()
@@ -124,23 +346,124 @@ def process_prompt_with_context(prompt: str) -> Tuple[str, List[str]]:
 
     return prompt, [url for _, url in links]
 
-async def fetch_all_contexts(urls: List[str]) -> List[str]:
-    """Fetch content from all URLs concurrently."""
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_url_content(url) for url in urls]
-        results = await asyncio.gather(*tasks)
+async def fetch_all_contexts(urls: List[str], fetcher: "ContextFetcher" = None) -> List[str]:
+    """Fetch content from all URLs concurrently, on a temporary fetcher if none is given."""
+    if fetcher is None:
+        async with ContextFetcher() as temporary_fetcher:
+            return await fetch_all_contexts(urls, temporary_fetcher)
+
+    tasks = [fetch_url_content(url, fetcher) for url in urls]
+    results = await asyncio.gather(*tasks)
+    
+    # Check if any fetch failed (returned empty string)
+    if any(content == "" for content in results):
+        failed_urls = [url for url, content in zip(urls, results) if content == ""]
+        error_message = f"Failed to fetch content from URLs: {', '.join(failed_urls)}"
+        log_message(error_message)
+        raise ValueError(error_message)
         
-        # Check if any fetch failed (returned empty string)
-        if any(content == "" for content in results):
-            failed_urls = [url for url, content in zip(urls, results) if content == ""]
-            error_message = f"Failed to fetch content from URLs: {', '.join(failed_urls)}"
-            log_message(error_message)
-            raise ValueError(error_message)
-            
-        return results
+    return results
+
+# Rough tokenizer estimate, good enough for budgeting English text
+CHARS_PER_TOKEN = 4
+# Tokens shared by all references of a prompt, unless [context] says otherwise
+DEFAULT_REFERENCE_TOKENS = 1500
+# Tokens left for the response when num_ctx is known and max_tokens isn't set
+DEFAULT_RESERVE_TOKENS = 1024
+
+BLANK_LINES = re.compile(r'\n\s*\n')
+SENTENCE_BREAK = re.compile(r'(?<=[.!?])\s+')
+
+def estimate_tokens(text):
+    """Fast estimate of the number of tokens in a text."""
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+@functools.lru_cache(maxsize=256)
+def split_reference(content):
+    """Split reference text into its non-empty paragraphs. Cached, since prompts often share references."""
+    return tuple(paragraph.strip() for paragraph in BLANK_LINES.split(content) if paragraph.strip())
 
-def create_context_block(contents: List[str] = None, links: List[Tuple[str, str]] = None) -> str:
-    """Create a formatted context block from fetched contents."""
+@functools.lru_cache(maxsize=1024)
+def fit_reference(content, max_tokens):
+    """
+    Shorten reference text to about max_tokens, keeping whole paragraphs and
+    then whole sentences. Text without sentence breaks is cut at a word.
+    """
+    paragraphs = split_reference(content)
+    parts, used = [], 0
+    for paragraph in paragraphs:
+        tokens = estimate_tokens(paragraph)
+        if used + tokens <= max_tokens:
+            parts.append(paragraph)
+            used += tokens
+            continue
+        sentences = []
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            tokens = estimate_tokens(sentence)
+            if used + tokens > max_tokens:
+                break
+            sentences.append(sentence)
+            used += tokens
+        if sentences:
+            parts.append(" ".join(sentences))
+        elif not parts and max_tokens > 0:
+            cut = paragraph[:max_tokens * CHARS_PER_TOKEN]
+            parts.append((cut.rsplit(" ", 1)[0] if " " in cut else cut) + "...")
+        return "\n\n".join(parts + ["(content truncated for brevity)"])
+    return "\n\n".join(parts)
+
+def allocate_token_budget(sizes, budget):
+    """
+    Split a token budget across references of the given sizes. Short
+    references get all they need and what they leave over is shared evenly
+    by the longer ones.
+    """
+    shares = [0] * len(sizes)
+    remaining = max(int(budget), 0)
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        if sizes[pending[0]] > share:
+            for i in pending:
+                shares[i] = share
+            break
+        i = pending.pop(0)
+        shares[i] = sizes[i]
+        remaining -= sizes[i]
+    return shares
+
+def reference_token_budget(context_settings, options, fixed_text):
+    """
+    Tokens available for a prompt's references: the [context] reference_tokens
+    budget, capped so that with the fixed text (system message, context and
+    prompt) and room for the response the request fits in num_ctx, when known.
+    """
+    context_settings = context_settings or {}
+    budget = int(context_settings.get("reference_tokens", DEFAULT_REFERENCE_TOKENS))
+    num_ctx = int((options or {}).get("num_ctx") or 0)
+    if num_ctx:
+        reserve = int(context_settings.get("reserve_tokens", DEFAULT_RESERVE_TOKENS))
+        budget = min(budget, num_ctx - reserve - estimate_tokens(fixed_text))
+    return max(budget, 0)
+
+def format_references(contents, links, budget=None):
+    """Format the reference sections, sharing the token budget across them."""
+    if budget is None:
+        budget = DEFAULT_REFERENCE_TOKENS
+    sizes = [sum(estimate_tokens(p) for p in split_reference(content)) if content else 0 for content in contents]
+    shares = allocate_token_budget(sizes, budget)
+
+    sections = ""
+    for i, (content, share, (link_text, url)) in enumerate(zip(contents, shares, links), 1):
+        if content:
+            sections += f"Reference [{i}]: {url}\n{fit_reference(content, share)}\n\n"
+    return sections
+
+def create_context_block(contents: List[str] = None, links: List[Tuple[str, str]] = None, budget: int = None) -> str:
+    """
+    Create a formatted context block from fetched contents. The references
+    share a budget of about `budget` tokens (see format_references).
+    """
     # Get current date in unambiguous format
     current_date = datetime.now().strftime("%B %d, %Y")
     
@@ -152,19 +475,7 @@ def create_context_block(contents: List[str] = None, links: List[Tuple[str, str]
     if contents and any(contents) and links:
         # Add a section for reference materials
         context_block += "## References\n"
-        
-        for i, (content, (link_text, url)) in enumerate(zip(contents, links), 1):
-            if content:
-                # Clean up the content by removing excessive whitespace
-                cleaned_content = re.sub(r'\n\s*\n', '\n\n', content)
-                # Truncate to a reasonable length but include enough for context
-                max_chars = 1500  # Adjust this value as needed
-                if len(cleaned_content) > max_chars:
-                    truncated_content = cleaned_content[:max_chars] + "...\n\n(content truncated for brevity)"
-                else:
-                    truncated_content = cleaned_content
-                    
-                context_block += f"Reference [{i}]: {url}\n{truncated_content}\n\n"
+        context_block += format_references(contents, links, budget)
     
     # Add a section for writing instructions
     context_block += "## Writing Instructions\n"
@@ -174,7 +485,69 @@ def create_context_block(contents: List[str] = None, links: List[Tuple[str, str]
     
     return context_block
 
-def save_response(prompt, response_text, output_dir, prompt_id=None, start_time=None, duration=None, length=None, full_prompt=None):
+def create_context_preamble(current_date=None) -> str:
+    """
+    Create the invariant part of the context for the prefix-cache layout.
+
+    Everything that is the same for every prompt in a run (date, location and
+    writing instructions) goes here, so together with the system message it
+    forms a byte-identical prefix that Ollama can reuse from its prompt cache.
+    The date is fixed by the caller for the whole run.
+    """
+    current_date = current_date or datetime.now().strftime("%B %d, %Y")
+
+    preamble = "# Context Information\n\n"
+    preamble += f"Today is {current_date} - treat this as a fact, not a hypothetical. Keep this in mind when you refer to years and dates, future and past!\n\n"
+    preamble += "You are based in Sweden and should consider Nordic and European perspectives in your responses. Approach topics from this cultural viewpoint when relevant.\n\n"
+    preamble += "## Writing Instructions\n"
+    preamble += "Please use this context and any references provided with the request to inform your article. "
+    preamble += "Remember to maintain a friendly, engaging tone while being thorough and accurate. "
+    preamble += "Synthesize the information from references into your own words rather than copying directly.\n\n"
+    return preamble
+
+def create_references_block(contents: List[str], links: List[Tuple[str, str]], budget: int = None) -> str:
+    """Create the per-prompt references section for the prefix-cache layout."""
+    block = format_references(contents, links, budget)
+    return f"## References\n{block}" if block else ""
+
+def build_response_record(prompt, response_text, start_time=None, duration=None, length=None, full_prompt=None, extra_metrics=None, extra_fields=None, cleaned=None):
+    """
+    Build the output dictionary for a response and its cleaned markdown.
+
+    cleaned is the (response, think, markdown) result of a ResponseCleaner
+    for response_text, if it has been cleaned already. The untouched model
+    output is kept as raw_response, so response-reclean.py can always start
+    over from it. Returns (output, clean_markdown); writing them is left to
+    save_response() or a ResponseWriter.
+    """
+    raw_text = response_text
+    # Split off the think block and clean the markdown, unless a
+    # ResponsePostProcessor already did
+    response_text, think_content, clean_markdown = cleaned or DEFAULT_CLEANER.clean(response_text)
+
+    # Track the current timestamp for last_updated field
+    current_time = datetime.now()
+
+    # Create the output dictionary with timing and length metrics
+    output = {
+        "prompt": prompt,
+        "full_prompt": full_prompt if full_prompt else prompt,  # Include full prompt if available
+        "response": response_text,
+        "think": think_content,
+        "raw_response": raw_text,
+        "metrics": {
+            "start_time": start_time.isoformat() if start_time else None,
+            "duration_seconds": duration,
+            "length": length,
+            **(extra_metrics or {})
+        },
+        "last_updated": current_time.isoformat(),
+        **(extra_fields or {})
+    }
+
+    return output, clean_markdown
+
+def save_response(prompt, response_text, output_dir, prompt_id=None, start_time=None, duration=None, length=None, full_prompt=None, extra_metrics=None, extra_fields=None):
     """Saves the response to JSON and TXT files with a unique filename based on prompt ID."""
     # Use prompt_id as filename, or fallback to a timestamp if no ID provided
     if prompt_id:
@@ -184,241 +557,2032 @@ def save_response(prompt, response_text, output_dir, prompt_id=None, start_time=
         random_suffix = random.randint(1000, 9999)
         base_filename = f"{epoch}-{random_suffix}"
 
-    # Extract think content if present
-    think_match = re.search(r'<think>(.*?)</think>', response_text, re.DOTALL)
-    think_content = think_match.group(1).strip() if think_match else ""
-    
-    # Remove think tags from response
-    response_text = re.sub(r'<think>.*?</think>', '', response_text, flags=re.DOTALL).strip()
-    
-    # Clean up markdown output - remove article markers and think-related artifacts
-    clean_markdown = response_text
-    clean_markdown = re.sub(r'---BEGIN ARTICLE---\s*', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = re.sub(r'---END ARTICLE---\s*', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = re.sub(r'---END---\s*', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = re.sub(r'\\boxed\{.*?\}', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = re.sub(r'</think>', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = re.sub(r'<CURRENT_CURSOR_POSITION>', '', clean_markdown, flags=re.DOTALL)
-    clean_markdown = clean_markdown.strip()
+    output, clean_markdown = build_response_record(
+        prompt, response_text, start_time, duration, length, full_prompt, extra_metrics, extra_fields
+    )
+
+    # Ensure output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    return write_response_files(output_dir, base_filename, output, clean_markdown)
+
+def write_response_files(output_dir, base_filename, output, clean_markdown):
+    """Write a response's JSON and markdown files, returning their paths."""
+    # Save TXT with just the cleaned response, then JSON with full data. Both
+    # are written to a temporary file and renamed into place, so a crash never
+    # leaves a half-written file behind under the final name.
+    txt_path = os.path.join(output_dir, f"{base_filename}.md")
+    write_file_atomic(txt_path, clean_markdown)
+
+    json_path = os.path.join(output_dir, f"{base_filename}.json")
+    write_file_atomic(json_path, json.dumps(output, indent=2, ensure_ascii=False))
+
+    return json_path, txt_path
+
+def write_file_atomic(path, text):
+    """Write text to path via a temporary file and an atomic rename."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class ResponseWriter:
+    """
+    Writes responses from one background task so workers never block on disk I/O.
+
+    With backend "files" every response becomes <id>.json and <id>.md in the
+    output directory. With backend "jsonl" compact records are appended to
+    rotating shard files in <output_dir>/shards (use response-shard-export.py
+    to produce per-prompt files from them). Records are written in batches
+    off the event loop and fsynced once per batch; each submit()'s callback
+    runs only after its record is durable.
+    """
+
+    SHARD_DIR = "shards"
+
+    def __init__(self, output_dir, backend="files", shard_mb=256, batch_size=64, flush_interval=0.5, queue_size=256):
+        if backend not in ("files", "jsonl"):
+            raise ValueError(f"Unknown output backend: {backend}")
+        self.output_dir = output_dir
+        self.backend = backend
+        self.shard_bytes = int(shard_mb * 1024 * 1024)
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self._shard_index = 0
+        self._shard_file = None
+
+    async def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.backend == "jsonl":
+            shard_dir = os.path.join(self.output_dir, self.SHARD_DIR)
+            os.makedirs(shard_dir, exist_ok=True)
+            existing = sorted(Path(shard_dir).glob("responses-*.jsonl"))
+            if existing:
+                self._shard_index = int(existing[-1].stem.split("-")[-1])
+            self._shard_file = open(self._shard_path(), "ab")
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, prompt_id, output, markdown, on_written=None):
+        """
+        Queue a response for writing. on_written(location, error) is called
+        once the batch containing it has been written and synced.
+        """
+        await self._queue.put((prompt_id, output, markdown, on_written))
+
+    async def close(self):
+        """Write everything still queued and stop the writer."""
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+
+    def _shard_path(self):
+        return os.path.join(self.output_dir, self.SHARD_DIR, f"responses-{self._shard_index:05d}.jsonl")
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            entry = await self._queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            try:
+                locations = await asyncio.to_thread(self._write_batch, batch)
+                error = None
+            except Exception as e:
+                log_message(f"Error writing {len(batch)} response(s): {str(e)}")
+                traceback.print_exc()
+                locations, error = [None] * len(batch), e
+            for (_, _, _, on_written), location in zip(batch, locations):
+                if on_written is not None:
+                    on_written(location, error)
+
+    def _write_batch(self, batch):
+        if self.backend == "files":
+            return [
+                os.path.relpath(write_response_files(self.output_dir, prompt_id, output, markdown)[0], self.output_dir)
+                for prompt_id, output, markdown, _ in batch
+            ]
+
+        locations = []
+        for prompt_id, output, markdown, _ in batch:
+            if self._shard_file.tell() >= self.shard_bytes:
+                self._rotate()
+            line = json.dumps({"id": prompt_id, **output, "markdown": markdown}, ensure_ascii=False) + "\n"
+            offset = self._shard_file.tell()
+            self._shard_file.write(line.encode("utf-8"))
+            locations.append(f"{os.path.relpath(self._shard_path(), self.output_dir)}:{offset}")
+        self._shard_file.flush()
+        os.fsync(self._shard_file.fileno())
+        return locations
+
+    def _rotate(self):
+        self._shard_file.flush()
+        os.fsync(self._shard_file.fileno())
+        self._shard_file.close()
+        self._shard_index += 1
+        self._shard_file = open(self._shard_path(), "ab")
+
+class ResponsePostProcessor:
+    """
+    Runs a ResponseCleaner over finished responses without blocking the event loop.
+
+    The regex passes run in a process pool whose workers receive the
+    cleaner once at startup (or in a thread when workers is 0), so long
+    responses never stall dispatch or streaming on the event-loop thread.
+    """
+
+    def __init__(self, cleaner, workers=None):
+        self.cleaner = cleaner
+        self.workers = min(os.cpu_count() or 1, 4) if workers is None else workers
+        self.executor = None
+
+    def start(self):
+        if self.workers != 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=init_worker, initargs=(self.cleaner,)
+            )
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def clean(self, response_text):
+        """Return (response, think, markdown) for a raw response."""
+        if self.executor is None:
+            return await asyncio.to_thread(self.cleaner.clean, response_text)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, clean_in_worker, response_text)
+
+def should_regenerate(prompt_id, output_dir, prompt_file_modified_time):
+    """
+    Check if we should regenerate the response by comparing prompt file's 
+    modification time with the last_updated time in the output JSON.
+    
+    Returns True if the response should be regenerated, False otherwise.
+    """
+    if not prompt_id:
+        return True  # Always regenerate if no prompt ID is provided
+    
+    # Check if the output file exists
+    output_file = os.path.join(output_dir, f"{prompt_id}.json")
+    if not os.path.exists(output_file):
+        return True  # Regenerate if output doesn't exist
+    
+    try:
+        # Load the existing output file
+        with open(output_file, 'r', encoding='utf-8') as f:
+            output_data = json.load(f)
+        
+        # Get the last_updated timestamp from the output
+        last_updated_str = output_data.get('last_updated')
+        if not last_updated_str:
+            return True  # Regenerate if no last_updated field
+        
+        # Convert last_updated string to datetime
+        last_updated = datetime.fromisoformat(last_updated_str)
+        
+        # Compare with prompt file's modification time
+        if prompt_file_modified_time > last_updated:
+            return True  # Regenerate if prompt file was modified after last run
+        
+        return False  # No need to regenerate
+    except Exception as e:
+        log_message(f"Error checking regeneration status: {str(e)}")
+        return True  # Regenerate on error to be safe
+
+def output_generation_settings(generation):
+    """
+    The [generation] settings that can change a response's text, for hashing.
+
+    max_tokens is always sent as num_predict; stop markers and max_seconds
+    only cut a streamed response. warmup, model_keep_alive and stream itself
+    don't change what the model writes, so changing them keeps responses.
+    """
+    generation = generation or {}
+    keys = ("max_tokens", "stop_markers", "max_seconds") if generation.get("stream") else ("max_tokens",)
+    return {key: generation[key] for key in keys if generation.get(key)}
+
+def compute_input_hash(prompt, system_message, model, options=None):
+    """
+    Hash the inputs that determine a response: prompt text (including its
+    reference URLs), system message, model and generation options.
+    """
+    payload = json.dumps(
+        {"prompt": prompt, "system_message": system_message, "model": model, "options": options or {}},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def normalize_request_text(text):
+    """Normalize text for request matching: NFC, LF line endings, no trailing whitespace."""
+    text = unicodedata.normalize("NFC", text or "").replace("\r\n", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+def compute_request_key(item, generation):
+    """
+    Content address of the exact request an item sends: model, model options,
+    system message, context, references and prompt, plus the generation
+    settings that shape the response (stop markers and budgets).
+    """
+    generation = generation or {}
+    options = dict(item.get("options") or {})
+    if generation.get("max_tokens"):
+        options.setdefault("num_predict", int(generation["max_tokens"]))
+    payload = json.dumps(
+        {
+            "model": normalize_model_name(item["model"]),
+            "options": options,
+            "system_message": normalize_request_text(item["system_message"]),
+            "context": normalize_request_text(item["context_block"]),
+            "references": normalize_request_text(item.get("references")),
+            "prompt": normalize_request_text(item["chat_prompt"]),
+            "generation": output_generation_settings(generation),
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def compute_context_digest(contents):
+    """Hash the fetched reference contents, or None for prompts without references."""
+    if not contents:
+        return None
+    digest = hashlib.sha256()
+    for content in contents:
+        digest.update(content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class ResponseManifest:
+    """
+    Compact index of generated responses, stored as JSONL in the output directory.
+
+    Each line records a prompt id with the input hash and context digest its
+    response was generated from, so skip decisions never need to open the
+    response files. Later lines supersede earlier ones; the file is
+    compacted on close once superseded lines outnumber live entries.
+    """
+
+    FILENAME = ".manifest.jsonl"
+
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / self.FILENAME
+        self.entries = {}
+        self._lines = 0
+        self._file = None
+
+    def load(self):
+        """Read the manifest into memory and open it for appending."""
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A torn last line from an interrupted run
+                    self.entries[entry["id"]] = entry
+                    self._lines += 1
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        log_message(f"Manifest: {len(self.entries)} responses indexed in {self.path}")
+
+    def get(self, prompt_id):
+        return self.entries.get(prompt_id)
+
+    def record(self, prompt_id, input_hash, context_digest=None, model=None, location=None):
+        """Append an entry for a freshly generated (or adopted) response."""
+        entry = {
+            "id": prompt_id,
+            "input_hash": input_hash,
+            "context_digest": context_digest,
+            "model": model,
+            "location": location,
+            "updated": datetime.now().isoformat(),
+        }
+        self.entries[prompt_id] = entry
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._lines += 1
+
+    def close(self):
+        """Close the manifest, compacting it if it has grown with superseded lines."""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        if self._lines > 2 * len(self.entries):
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._lines = len(self.entries)
+
+# Distinct prompt texts without ids remembered per file to number repeats;
+# a text that last appeared further back than this counts as a first copy
+REPEAT_WINDOW = 10000
+
+def derive_prompt_id(prompt, source=None, occurrence=0):
+    """
+    Derive a stable id for a prompt without one from its text and source file
+    name. occurrence numbers repeats of the same text in the same file, so
+    each copy gets its own id; the first copy keeps the plain id.
+    """
+    key = f"{Path(source).name if source else ''}\0{prompt}"
+    if occurrence:
+        key += f"\0{occurrence}"
+    return "p-" + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of raw model responses, keyed by
+    compute_request_key(), one JSON file per request. Entries older than
+    `ttl` seconds (0 = never) are ignored. Methods do blocking file I/O and
+    are meant to be called through asyncio.to_thread().
+    """
+
+    def __init__(self, directory, ttl=0.0):
+        self.directory = Path(directory)
+        self.ttl = ttl
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        """Return the cached record for a request key, or None."""
+        path = self._path(key)
+        try:
+            if self.ttl and time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def put(self, key, record):
+        """Store a record atomically (write to a temporary file, then rename)."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+class RunJournal:
+    """
+    Append-only JSONL journal of prompt states for the current run.
+
+    Every prompt moves through queued -> in_flight -> done or failed, and each
+    transition is appended as one line. A prompt is only marked done after its
+    response files have been renamed into place. A new run starts a fresh
+    journal. With resume, the previous run's journal is kept, prompts it
+    finished are skipped and the rest are queued again.
+    """
+
+    FILENAME = ".journal.jsonl"
+
+    def __init__(self, output_dir):
+        self.path = Path(output_dir) / self.FILENAME
+        self.run_id = None
+        self.states = {}
+        self._file = None
+
+    def open(self, resume=False):
+        """Start a new run, or continue the last one when resume is set."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume and self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A torn last line from the crash we are resuming from
+                    self.run_id = record.get("run", self.run_id)
+                    self.states[record["id"]] = record["state"]
+            done = sum(1 for state in self.states.values() if state == "done")
+            log_message(f"Resuming run {self.run_id}: {done} of {len(self.states)} prompts already done")
+            self._file = open(self.path, "a", encoding="utf-8")
+        else:
+            if resume:
+                log_message(f"No journal found at {self.path}, starting a new run")
+            self._file = open(self.path, "w", encoding="utf-8")
+        if self.run_id is None:
+            self.run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    def is_done(self, prompt_id):
+        return self.states.get(prompt_id) == "done"
+
+    def record(self, prompt_id, state, flush=True, **details):
+        """Append a state transition for a prompt."""
+        self.states[prompt_id] = state
+        record = {"run": self.run_id, "id": prompt_id, "state": state, "time": datetime.now().isoformat(), **details}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if flush:
+            self._file.flush()
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class LeaseQueue:
+    """
+    Work queue shared by several driver processes through a SQLite file.
+
+    Drivers insert their prompts (a prompt id is stored once, and queued
+    again only when its input hash changes) and claim batches of them with a
+    lease. A driver renews the leases it holds
+    with heartbeat(); prompts whose lease runs out, because their driver
+    crashed or lost the shared filesystem, are claimed again by another
+    driver. Each prompt therefore runs at least once, and only more than once
+    when a driver stalls past its lease. Completions are buffered and written
+    with the next heartbeat. Methods do blocking database I/O and are meant
+    to be called through asyncio.to_thread(), except complete() and
+    outstanding(): they only touch memory under a lock that is never held
+    during database I/O, so they are safe on the event loop.
+    """
+
+    def __init__(self, path, driver_id=None, lease_seconds=120.0):
+        self.path = path
+        self.driver_id = driver_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self._completed = []
+        # Ids this driver claimed and has not completed yet
+        self._claimed = set()
+        # _lock serializes database access (and may be held through a busy
+        # wait); _buffer_lock only guards _completed and _claimed
+        self._lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+        self._db = None
+
+    def open(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode; transactions are started explicitly where needed
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS prompts (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                task TEXT NOT NULL,
+                model TEXT NOT NULL,
+                input_hash TEXT,
+                priority INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'pending',
+                driver TEXT,
+                lease_until REAL,
+                leases INTEGER NOT NULL DEFAULT 0,
+                updated REAL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS prompts_state ON prompts (state, priority DESC, seq)")
+
+    def add(self, tasks):
+        """
+        Insert tasks as pending. An id already in the queue is left alone in
+        whatever state it is, unless its input hash changed (the prompt was
+        edited since it was queued): then it is replaced and pending again.
+        """
+        now = time.time()
+        rows = []
+        for task in tasks:
+            if not task.get("model"):
+                raise ValueError(f"Prompt {task['id']} has no model to queue it for")
+            # default=str: modified_time is only needed before a task is queued
+            # Models are stored normalized, like the names claim() filters on
+            rows.append((
+                task["id"], json.dumps(task, ensure_ascii=False, default=str), normalize_model_name(task["model"]),
+                task.get("input_hash"), task.get("priority", 0), now,
+            ))
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO prompts (id, task, model, input_hash, priority, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET task = excluded.task, model = excluded.model, "
+                    "input_hash = excluded.input_hash, priority = excluded.priority, state = 'pending', "
+                    "driver = NULL, lease_until = NULL, leases = 0, updated = excluded.updated "
+                    "WHERE input_hash IS NOT excluded.input_hash",
+                    rows,
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _model_filter(self, models):
+        if models is None:
+            return "", []
+        models = sorted(models)
+        return f" AND model IN ({', '.join('?' * len(models))})", models
+
+    def claim(self, limit, models=None):
+        """
+        Lease up to limit pending or expired prompts to this driver, highest
+        priority first. models restricts the claim to prompts this driver's
+        hosts serve (None = any). Returns the tasks.
+        """
+        now = time.time()
+        model_sql, model_args = self._model_filter(models)
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, task FROM prompts WHERE (state = 'pending' OR (state = 'leased' AND lease_until < ?))"
+                    f"{model_sql} ORDER BY priority DESC, seq LIMIT ?",
+                    [now, *model_args, limit],
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE prompts SET state = 'leased', driver = ?, lease_until = ?, leases = leases + 1, updated = ? "
+                    "WHERE id = ?",
+                    [(self.driver_id, now + self.lease_seconds, now, prompt_id) for prompt_id, _ in rows],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        with self._buffer_lock:
+            self._claimed.update(prompt_id for prompt_id, _ in rows)
+        return [json.loads(task) for _, task in rows]
+
+    def outstanding(self):
+        """Number of prompts this driver has claimed and not yet completed."""
+        with self._buffer_lock:
+            return len(self._claimed)
+
+    def complete(self, prompt_id, state):
+        """Note a prompt as done or failed; written by the next heartbeat()."""
+        with self._buffer_lock:
+            self._claimed.discard(prompt_id)
+            self._completed.append((state, time.time(), prompt_id, self.driver_id))
+
+    def heartbeat(self):
+        """Write buffered completions and extend the leases this driver still holds."""
+        now = time.time()
+        with self._buffer_lock:
+            completed, self._completed = self._completed, []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Only while this driver still holds the lease: a prompt that
+                # was edited and queued again meanwhile stays pending
+                self._db.executemany(
+                    "UPDATE prompts SET state = ?, lease_until = NULL, updated = ? "
+                    "WHERE id = ? AND driver = ? AND state = 'leased'",
+                    completed,
+                )
+                self._db.execute(
+                    "UPDATE prompts SET lease_until = ? WHERE state = 'leased' AND driver = ?",
+                    (now + self.lease_seconds, self.driver_id),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                with self._buffer_lock:
+                    self._completed = completed + self._completed
+                raise
+
+    def unfinished(self, models=None):
+        """Number of prompts (for the given models) not yet done or failed."""
+        model_sql, model_args = self._model_filter(models)
+        with self._lock:
+            return self._db.execute(
+                f"SELECT COUNT(*) FROM prompts WHERE state IN ('pending', 'leased'){model_sql}", model_args
+            ).fetchone()[0]
+
+    def counts(self):
+        """Prompts per state."""
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM prompts GROUP BY state").fetchall())
+
+    def close(self):
+        if self._db is not None:
+            self.heartbeat()
+            self._db.close()
+            self._db = None
+
+def build_task(prompt_id, prompt, system_msg, model, options, modified_time, manifest, output_dir):
+    """
+    Create a queue task for a prompt, or return None if its response is current.
+
+    A response is current when the manifest has the same input hash for the
+    prompt id. Prompts with references can only be confirmed after their
+    context is fetched, so for those the recorded context digest travels with
+    the task and prepare_task() makes the final call. Responses from before
+    the manifest existed are checked once by modification time and adopted.
+    """
+    input_hash = compute_input_hash(prompt, system_msg, model, options)
+    task = {
+        "id": prompt_id,
+        "prompt": prompt,
+        "system_message": system_msg,
+        "modified_time": modified_time,
+        "input_hash": input_hash,
+        "expected_context_digest": None,
+    }
+    if not prompt_id:
+        return task  # Always regenerate if no prompt ID is provided
+
+    entry = manifest.get(prompt_id)
+    if entry is None:
+        if not should_regenerate(prompt_id, output_dir, modified_time):
+            manifest.record(prompt_id, input_hash, None, model)
+            return None
+        return task
+    if entry["input_hash"] != input_hash:
+        return task
+    if entry.get("context_digest"):
+        task["expected_context_digest"] = entry["context_digest"]
+        return task
+    return None
+
+class OllamaClientPool:
+    """
+    Long-lived AsyncClient instances, one per Ollama host.
+
+    Each client sends its requests through an httpx transport owned by the
+    pool, whose connection pool is bounded to `max_connections`, so requests
+    reuse keep-alive HTTP/1.1 connections instead of opening a new socket per
+    prompt. Call close() on shutdown to release them.
+    """
+
+    def __init__(self, hosts, timeout=600.0, connect_timeout=10.0, keep_alive=True, keepalive_expiry=300.0):
+        self._clients = {}
+        self._transports = {}
+        self.request_timeout = httpx.Timeout(timeout or None, connect=connect_timeout or None)
+        self.keep_alive = keep_alive
+        self.keepalive_expiry = keepalive_expiry
+        for host, max_connections in hosts.items():
+            self.add(host, max_connections)
+
+    def add(self, host, max_connections):
+        """Create the client for a host that joined after startup."""
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections if self.keep_alive else 0,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        # AsyncClient passes extra arguments on to the httpx client it creates
+        transport = httpx.AsyncHTTPTransport(limits=limits)
+        self._transports[host] = transport
+        self._clients[host] = AsyncClient(host=host, timeout=self.request_timeout, transport=transport)
+
+    def __contains__(self, host):
+        return host in self._clients
+
+    def get(self, host):
+        """Return the shared client for a host."""
+        return self._clients[host]
+
+    async def close(self):
+        """Close every client's pooled connections."""
+        for host, transport in self._transports.items():
+            try:
+                await transport.aclose()
+            except Exception as e:
+                log_message(f"Error closing client for {host}: {str(e)}")
+        self._transports.clear()
+        self._clients.clear()
+
+def client_connections(instance, config):
+    """Connection limit for an instance's client: [client] max_connections, or its max_slots."""
+    return int(config.get("client", {}).get("max_connections", 0)) or instance["max_slots"]
+
+def create_client_pool(instances, config):
+    """Create the OllamaClientPool for the parsed Ollama instances from the [client] settings."""
+    client_config = config.get("client", {})
+    hosts = {instance["host"]: client_connections(instance, config) for instance in instances}
+    return OllamaClientPool(
+        hosts,
+        timeout=float(client_config.get("timeout", 600)),
+        connect_timeout=float(client_config.get("connect_timeout", 10)),
+        keep_alive=bool(client_config.get("keep_alive", True)),
+        keepalive_expiry=float(client_config.get("keepalive_expiry", 300)),
+    )
+
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+
+async def stream_chat(client, model, messages, generation, options=None):
+    """
+    Stream a chat completion, stopping early when the generation budget is hit.
+
+    Generation is cancelled as soon as one of generation["stop_markers"]
+    appears in the answer, or when max_tokens chunks or max_seconds have been
+    produced; closing the stream drops the HTTP connection, which makes Ollama
+    stop generating. Markers inside a <think> block are ignored, since
+    reasoning models often name them while planning. Returns the text (up to
+    and including a stop marker), the final chunk if the model finished on its
+    own, and a metrics dict.
+    """
+    stop_markers = [marker for marker in generation.get("stop_markers", []) if marker]
+    max_tokens = int(generation.get("max_tokens", 0))
+    max_seconds = float(generation.get("max_seconds", 0))
+    window = max([len(marker) for marker in stop_markers] + [len(THINK_CLOSE)])
+
+    started = time.monotonic()
+    parts = []
+    length = 0
+    tail = ""
+    thinking = False
+    chunks = 0
+    first_token_seconds = None
+    stop_reason = "done"
+    final_chunk = None
+
+    stream = await client.chat(
+        model=model, messages=messages, stream=True, options=options,
+        keep_alive=generation.get("model_keep_alive") or None,
+    )
+    try:
+        async for chunk in stream:
+            content = chunk["message"]["content"]
+            if content:
+                if first_token_seconds is None:
+                    first_token_seconds = time.monotonic() - started
+                parts.append(content)
+                length += len(content)
+                chunks += 1
+            if chunk.get("done"):
+                final_chunk = chunk
+                break
+
+            if stop_markers and content:
+                # Only the newest text plus one marker length can complete a
+                # marker or think tag; tail is always a suffix of the text
+                tail = (tail + content)[-(window + len(content)):]
+                found = []
+                while True:
+                    if thinking:
+                        close = tail.find(THINK_CLOSE)
+                        if close < 0:
+                            break
+                        thinking = False
+                        tail = tail[close + len(THINK_CLOSE):]
+                        continue
+                    opened = tail.find(THINK_OPEN)
+                    answer = tail if opened < 0 else tail[:opened]
+                    found = [marker for marker in stop_markers if marker in answer]
+                    if found or opened < 0:
+                        break
+                    thinking = True
+                    tail = tail[opened + len(THINK_OPEN):]
+                if found:
+                    offset = length - len(tail)
+                    cut = min(offset + tail.find(marker) + len(marker) for marker in found)
+                    parts = ["".join(parts)[:cut]]
+                    stop_reason = "stop_marker"
+                    break
+            if max_tokens and chunks >= max_tokens:
+                stop_reason = "max_tokens"
+                break
+            if max_seconds and time.monotonic() - started >= max_seconds:
+                stop_reason = "max_seconds"
+                break
+    finally:
+        await stream.aclose()
+
+    metrics = {
+        "streamed": True,
+        "time_to_first_token": first_token_seconds,
+        "stop_reason": stop_reason,
+        "chunks": chunks,
+    }
+    return "".join(parts), final_chunk, metrics
+
+def token_metrics(response, fallback_tokens=None):
+    """
+    Token counts and timings from the fields Ollama returns with a finished
+    response (durations are reported in nanoseconds).
+
+    A stream cut short by stream_chat's budget has no final response; its
+    generated token count is then approximated by fallback_tokens (the
+    number of streamed chunks) and the timings are unknown.
+    """
+    def field(name):
+        return response.get(name) if response is not None else None
+
+    def seconds(name):
+        value = field(name)
+        return value / 1e9 if value is not None else None
+
+    def rate(count, duration):
+        return count / duration if count is not None and duration else None
+
+    prompt_tokens = field("prompt_eval_count")
+    completion_tokens = field("eval_count")
+    prompt_eval_seconds = seconds("prompt_eval_duration")
+    eval_seconds = seconds("eval_duration")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens if completion_tokens is not None else fallback_tokens,
+        "prompt_eval_seconds": prompt_eval_seconds,
+        "eval_seconds": eval_seconds,
+        "load_seconds": seconds("load_duration"),
+        "total_seconds": seconds("total_duration"),
+        "prompt_tokens_per_second": rate(prompt_tokens, prompt_eval_seconds),
+        "tokens_per_second": rate(completion_tokens, eval_seconds),
+    }
+
+async def chat(prompt, host, model, system_message, context_block=None, client=None, generation=None, references=None, options=None):
+    """
+    Process a single prompt with context and return the response.
+
+    With generation["stream"] set, the response is streamed and cut short by
+    the stop markers and max_tokens/max_seconds budget (see stream_chat).
+    References, when given separately (prefix-cache layout), are sent as
+    their own message between the context and the prompt. options are the
+    Ollama model options (temperature, num_ctx, num_predict, ...).
+    Returns (text, start_time, duration, length, full_prompt, metrics).
+    """
+    start_time = datetime.now()
+    generation = generation or {}
+    
+    # Create context block with date and location if none was provided
+    if context_block is None:
+        context_block = create_context_block()
+    
+    # Prepare messages with context if available
+    messages = []
+    if system_message:
+        messages.append({"role": "system", "content": system_message})
+    
+    # Always include context block
+    messages.append({"role": "user", "content": context_block})
+    if references:
+        messages.append({"role": "user", "content": references})
+    messages.append({"role": "user", "content": prompt})
+
+    # Create the full prompt for debugging
+    full_prompt = ""
+    if system_message:
+        full_prompt += f"System: {system_message}\n\n"
+    
+    # Always include context block in full prompt
+    full_prompt += f"Context: {context_block}\n\n"
+    if references:
+        full_prompt += f"References: {references}\n\n"
+    full_prompt += f"User: {prompt}"
+
+    # Let the server enforce the token budget as well
+    options = dict(options or {})
+    if generation.get("max_tokens"):
+        options.setdefault("num_predict", int(generation["max_tokens"]))
+    options = options or None
+
+    # Make the API request, on the pooled client for this host if one was given
+    if client is None:
+        client = AsyncClient(host=host)
+    if generation.get("stream"):
+        response_text, response, metrics = await stream_chat(client, model, messages, generation, options)
+        metrics.update(token_metrics(response, metrics["chunks"]))
+    else:
+        response = await client.chat(
+            model=model,
+            messages=messages,
+            stream=False,
+            options=options,
+            keep_alive=generation.get("model_keep_alive") or None,
+        )
+        response_text = response['message']['content']
+        metrics = {"streamed": False, **token_metrics(response)}
+    
+    # Calculate duration and get response length
+    duration = (datetime.now() - start_time).total_seconds()
+    length = len(response_text)
+    
+    return response_text, start_time, duration, length, full_prompt, metrics
+
+class ConcurrencyController:
+    """
+    Limits the number of in-flight requests on one Ollama host.
+
+    A worker reserves a slot with acquire() before it takes a prompt, so a
+    host at its limit leaves prompts to the others, and calls start() once it
+    has one; in_flight and peak count only those running requests, not
+    workers parked on an empty queue.
+
+    In adaptive mode the limit follows an AIMD scheme: after every `window`
+    successful requests it grows by one while throughput keeps improving, and
+    it is cut by `backoff_factor` on timeouts, 5xx/OOM errors, or when the
+    average latency rises above `latency_factor` times the best seen so far.
+    Throughput is only compared over windows in which the running requests
+    reached the limit; below it, the limit is not what holds the host back.
+    """
+
+    def __init__(self, host, initial, min_limit=1, max_limit=None, adaptive=False,
+                 window=8, latency_factor=2.0, backoff_factor=0.5, improve_threshold=0.05):
+        self.host = host
+        self.adaptive = adaptive
+        self.max_limit = max(max_limit or initial, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.window = max(int(window), 1)
+        self.latency_factor = latency_factor
+        self.backoff_factor = backoff_factor
+        self.improve_threshold = improve_threshold
+        self.reserved = 0
+        self.in_flight = 0
+        self.peak = 0
+        self._condition = asyncio.Condition()
+        self._window_started = time.monotonic()
+        self._window_count = 0
+        self._window_units = 0
+        self._window_latency = 0.0
+        self._window_saturated = False
+        self._last_throughput = None
+        self._best_latency = None
+
+    async def acquire(self):
+        """Wait until the host has a free slot under the current limit."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.reserved < self.limit)
+            self.reserved += 1
+
+    def start(self):
+        """A request is about to be sent on an acquired slot."""
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        if self.in_flight >= self.limit:
+            self._window_saturated = True
+
+    async def release(self, success=None, latency=None, units=0, started=False):
+        """
+        Free a slot and feed the outcome into the controller.
+
+        success is True for a completed request, False for an overload signal
+        (timeout, 5xx, OOM) and None when the slot carried no signal, e.g. a
+        skipped prompt. started says whether start() was called on the slot.
+        """
+        async with self._condition:
+            self.reserved -= 1
+            if started:
+                self.in_flight -= 1
+            if self.adaptive:
+                if success is True:
+                    self._record_success(latency or 0.0, units)
+                elif success is False:
+                    self._decrease("request failed")
+            self._condition.notify_all()
+
+    def _record_success(self, latency, units):
+        self._window_count += 1
+        self._window_units += units
+        self._window_latency += latency
+        if self._window_count < self.window:
+            return
+
+        avg_latency = self._window_latency / self._window_count
+        # A window can close on a burst of completions; never measure it as
+        # shorter than one average request, or throughput would spike
+        elapsed = max(time.monotonic() - self._window_started, avg_latency)
+        throughput = self._window_units / elapsed if elapsed > 0 else 0.0
+        saturated = self._window_saturated
+        self._reset_window()
+
+        if self._best_latency is None or avg_latency < self._best_latency:
+            self._best_latency = avg_latency
+
+        if avg_latency > self._best_latency * self.latency_factor:
+            self._decrease(f"latency {avg_latency:.2f}s vs best {self._best_latency:.2f}s")
+            return
+        if not saturated:
+            # Too few prompts to fill the limit: throughput says nothing about it
+            self._last_throughput = None
+            return
+        if self._last_throughput is None or throughput > self._last_throughput * (1 + self.improve_threshold):
+            if self.limit < self.max_limit:
+                self.limit += 1
+                log_message(f"Host {self.host}: throughput {throughput:.2f}/s, raising concurrency to {self.limit}")
+        elif throughput < self._last_throughput * (1 - self.improve_threshold) and self.limit > self.min_limit:
+            self.limit -= 1
+            log_message(f"Host {self.host}: throughput fell to {throughput:.2f}/s, lowering concurrency to {self.limit}")
+        self._last_throughput = throughput
+
+    def _decrease(self, reason):
+        new_limit = max(self.min_limit, int(self.limit * self.backoff_factor))
+        if new_limit < self.limit:
+            log_message(f"Host {self.host}: {reason}, backing off concurrency from {self.limit} to {new_limit}")
+            self.limit = new_limit
+        # Measurements taken at the old limit no longer apply
+        self._reset_window()
+        self._last_throughput = None
+
+    def _reset_window(self):
+        self._window_started = time.monotonic()
+        self._window_count = 0
+        self._window_units = 0
+        self._window_latency = 0.0
+        self._window_saturated = self.in_flight >= self.limit
+
+def is_overload_error(error):
+    """Return True if an error from chat() suggests the host is overloaded."""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.ConnectError)):
+        return True
+    if isinstance(error, ResponseError):
+        if error.status_code >= 500:
+            return True
+        return "out of memory" in str(error).lower()
+    return False
+
+def is_host_failure(error):
+    """
+    Return True if an error says something about the host rather than the
+    prompt: overload, or a broken connection. Errors such as an unknown
+    model or a bad request fail on every host and don't count against it.
+    """
+    return is_overload_error(error) or isinstance(error, (httpx.TransportError, ConnectionError))
+
+class HostHealth:
+    """
+    Circuit breaker for one Ollama host.
+
+    After `failure_threshold` consecutive failed requests the host is
+    ejected: its workers stop taking prompts and a probe of /api/tags runs
+    every `probe_interval` seconds until the host answers again.
+    """
+
+    def __init__(self, host, client, failure_threshold=3, probe_interval=15.0):
+        self.host = host
+        self.client = client
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_since = None
+        self._available = asyncio.Event()
+        self._available.set()
+        self._probe_task = None
+
+    @property
+    def is_available(self):
+        return self._available.is_set()
+
+    async def wait_available(self):
+        """Block while the host is ejected."""
+        await self._available.wait()
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        """Count a failed request and eject the host once the threshold is reached."""
+        self.consecutive_failures += 1
+        if self.is_available and self.consecutive_failures >= self.failure_threshold:
+            self.ejections += 1
+            self.ejected_since = time.monotonic()
+            self._available.clear()
+            log_message(
+                f"Host {self.host}: {self.consecutive_failures} consecutive failures, "
+                f"ejecting and probing every {self.probe_interval:.0f}s"
+            )
+            self._probe_task = asyncio.create_task(self._probe())
+
+    async def _probe(self):
+        while not self.is_available:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                await self.client.list()
+            except Exception as e:
+                log_message(f"Host {self.host}: health probe failed: {str(e)}")
+                continue
+            log_message(f"Host {self.host}: health probe succeeded, accepting prompts again")
+            self.consecutive_failures = 0
+            self.ejected_since = None
+            self._available.set()
+
+    def shutdown(self):
+        """Release workers waiting on this host so they can exit."""
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+        self._available.set()
+
+class DispatchQueue:
+    """
+    Hand-off between the prefetch stage and the GPU workers.
+
+    Producers put() into it like a bounded asyncio.Queue. Items that failed
+    can be requeue()d without waiting for space, and get() prefers items that
+    have not already failed on the asking host. Items taken by a worker stay
+    outstanding until task_done() or requeue(). get() returns None only once
+    close() was called and nothing is queued or outstanding, so retries
+    scheduled near the end of a run are still picked up.
+
+    Items are handed out by priority, then longest job first, using an
+    estimated cost in tokens (prompt and context size plus the expected
+    output). Each GPU's speed is measured from completed requests; when
+    several hosts are waiting for work, the fastest gets the longest job, and
+    a slower host skips jobs that a busy faster host is expected to finish
+    sooner, so the last long prompts don't end up on the slowest GPU.
+
+    With hedging enabled, hosts left idle once the queue is closed and empty
+    get a duplicate of a prompt still running elsewhere when they are
+    expected to finish it sooner. Workers race the copies (see worker()) and
+    cancel the losers. Hedges are capped at hedge_budget times the number of
+    prompts dispatched.
+
+    With affinity enabled, prompts sharing the same references are kept on
+    the host that last ran one of them, ahead of cost order, so that host's
+    prompt cache already holds their common prefix.
+
+    Items only go to hosts that serve their model, and a host prefers items
+    for models it already has loaded (as last reported by /api/ps or seen
+    in a completed request) so that models aren't swapped back and forth.
+    A host that would have to evict a model to run an item loaded on another
+    host leaves it to that host until it has waited swap_delay seconds.
+
+    A host registered with a HostHealth gets nothing while it is ejected,
+    even if its worker was already waiting in get(), and other hosts don't
+    hold work back for it.
+    """
+
+    # Seconds between re-checks while a host defers to a busy faster one
+    DEFER_RECHECK = 0.25
+
+    def __init__(self, maxsize, expected_output_tokens=0, hedging=False, hedge_budget=0.05, hedge_delay=1.0,
+                 affinity=False, swap_delay=30.0, max_loaded_models=1):
+        self.maxsize = maxsize
+        self.swap_delay = swap_delay
+        self.max_loaded_models = max(int(max_loaded_models), 1)
+        self.affinity = affinity
+        self._affinity_hosts = {}
+        self._host_models = {}
+        self._loaded = {}
+        self._health = {}
+        self.expected_output_tokens = expected_output_tokens
+        self.hedging = hedging
+        self.hedge_budget = hedge_budget
+        self.hedge_delay = hedge_delay
+        self.hedges = {"issued": 0, "won": 0, "lost": 0}
+        self._dispatched = 0
+        self._items = []
+        self._outstanding = 0
+        self._closed = False
+        self._condition = asyncio.Condition()
+        self._gpus = {}
+        self._speed_priors = {}
+        self._speeds = {}
+        self._waiting = {}
+        self._running = {}
+        self._completions = 0
+        self._completion_tokens = 0
+
+    def register_host(self, host, gpu, speed=1.0, models=None, health=None):
+        """
+        Declare a host and the GPU it runs on. Instances on the same machine
+        and GPU index share a speed estimate; speed is the relative prior used
+        until requests on that GPU have been measured. models lists the
+        models the host may run; None means any. health is the host's
+        HostHealth, if it has a circuit breaker.
+        """
+        gpu_key = (urlparse(f"//{host}").hostname or host, gpu)
+        self._gpus[host] = gpu_key
+        self._speed_priors[gpu_key] = float(speed)
+        self._host_models[host] = {normalize_model_name(m) for m in models} if models else None
+        self._loaded.setdefault(host, [])
+        if health is not None:
+            self._health[host] = health
+
+    def host_available(self, host):
+        """False while the host is ejected by its circuit breaker."""
+        health = self._health.get(host)
+        return health is None or health.is_available
+
+    def host_serves(self, host, model):
+        models = self._host_models.get(host)
+        return models is None or normalize_model_name(model) in models
+
+    def serves(self, model):
+        """True if at least one registered host may run the model."""
+        return any(self.host_serves(host, model) for host in self._host_models)
+
+    def served_models(self):
+        """Every model the registered hosts may run, or None if some host runs any."""
+        if any(models is None for models in self._host_models.values()):
+            return None
+        return set().union(*self._host_models.values())
+
+    def set_loaded(self, host, models):
+        """Replace a host's loaded models with what /api/ps reported."""
+        self._loaded[host] = [normalize_model_name(m) for m in models]
+
+    def note_loaded(self, host, model):
+        """
+        A host was given a request for the model, so it is loaded there. Until the
+        next /api/ps poll, assume it evicted the least recently used models
+        beyond max_loaded_models.
+        """
+        model = normalize_model_name(model)
+        loaded = [m for m in self._loaded.get(host, []) if m != model] + [model]
+        self._loaded[host] = loaded[-self.max_loaded_models:]
+
+    def _can_take(self, host, item, now):
+        """True if the host may run the item now."""
+        if not self.host_serves(host, item["model"]):
+            return False
+        # Swapping models costs more than waiting a little for the host that has it loaded
+        return self._model_rank(host, item) < 2 or now - item["ready_at"] >= self.swap_delay
+
+    def _model_rank(self, host, item):
+        """
+        0 if the item's model is loaded on this host, 2 if running it here would
+        evict a model while another host has it loaded, 1 otherwise.
+        """
+        model = normalize_model_name(item["model"])
+        loaded = self._loaded.get(host, [])
+        if model in loaded:
+            return 0
+        if len(loaded) >= self.max_loaded_models and any(
+            model in others for other, others in self._loaded.items() if other != host
+        ):
+            return 2
+        return 1
+
+    def estimate_cost(self, item):
+        """Estimated tokens to process an item: its prompt and context plus the expected output."""
+        tokens = sum(estimate_tokens(item.get(key)) for key in ("chat_prompt", "context_block", "references", "system_message"))
+        expected_output = self.expected_output_tokens
+        if not expected_output and self._completions:
+            expected_output = self._completion_tokens / self._completions
+        return tokens + expected_output
+
+    def host_speed(self, host):
+        """Measured (or prior-scaled) cost units per second for a host's GPU."""
+        gpu_key = self._gpus.get(host)
+        if gpu_key in self._speeds:
+            return self._speeds[gpu_key]
+        prior = self._speed_priors.get(gpu_key, 1.0)
+        if self._speeds:
+            return prior * sum(self._speeds.values()) / len(self._speeds)
+        return prior
+
+    def mark_stopped(self, host, item, failed=False):
+        """
+        Note that a host is no longer running an item it took. After a failure the
+        item's model is no longer assumed loaded there, so other hosts don't hold
+        back on its account.
+        """
+        self._running.get(host, {}).pop(id(item), None)
+        if failed:
+            model = normalize_model_name(item["model"])
+            self._loaded[host] = [m for m in self._loaded.get(host, []) if m != model]
+
+    def record_completion(self, host, item, seconds, completion_tokens=None):
+        """Feed a finished request into the host's GPU speed and the output size estimate."""
+        self.mark_stopped(host, item)
+        if completion_tokens is not None:
+            self._completions += 1
+            self._completion_tokens += completion_tokens
+        gpu_key = self._gpus.get(host)
+        if gpu_key is None or seconds <= 0:
+            return
+        speed = item["cost"] / seconds
+        previous = self._speeds.get(gpu_key)
+        self._speeds[gpu_key] = speed if previous is None else 0.7 * previous + 0.3 * speed
+
+    def _choose(self, host):
+        """Index of the item a host should take now, or None to keep waiting."""
+        now = time.monotonic()
+        servable = [i for i, item in enumerate(self._items) if self._can_take(host, item, now)]
+        if not servable:
+            return None
+        candidates = [
+            i for i in servable if host not in self._items[i].get("failed_hosts", ())
+        ] or servable
+        top_priority = max(self._items[i]["priority"] for i in candidates)
+        candidates = [i for i in candidates if self._items[i]["priority"] == top_priority]
+        candidates.sort(key=lambda i: (
+            self._model_rank(host, self._items[i]),
+            self._affinity_rank(host, self._items[i]),
+            -self._items[i]["cost"],
+        ))
+
+        # Leave the longest jobs to faster hosts that are waiting as well,
+        # one job per faster GPU
+        speed = self.host_speed(host)
+        waiting_faster = {}
+        for other, waiting in self._waiting.items():
+            if waiting and other != host and self.host_available(other) and self.host_speed(other) > speed:
+                waiting_faster.setdefault(self._gpus.get(other), other)
+
+        # ...and to busy faster hosts that would still finish them first
+        busy_faster = {}
+        for other, running in self._running.items():
+            other_speed = self.host_speed(other)
+            if other == host or other_speed <= speed or not running or self._waiting.get(other):
+                continue
+            if not self.host_available(other):
+                continue
+            expected = [running_item["cost"] / other_speed for running_item, _ in running.values()]
+            remaining = [left - (now - started) for left, (_, started) in zip(expected, running.values())]
+            # A host far behind its estimate may be stuck; don't wait for it
+            if all(left < -estimate for left, estimate in zip(remaining, expected)):
+                continue
+            busy_faster[other] = (max(min(remaining), 0.0), other_speed)
+
+        for index in candidates:
+            item = self._items[index]
+            waiting_gpu = next(
+                (gpu for gpu, other in waiting_faster.items() if self._can_take(other, item, now)),
+                None,
+            )
+            if waiting_gpu is not None:
+                del waiting_faster[waiting_gpu]
+                continue
+            cost = item["cost"]
+            sooner = next(
+                (other for other, (free_in, other_speed) in busy_faster.items()
+                 if self._can_take(other, item, now) and free_in + cost / other_speed < cost / speed),
+                None,
+            )
+            if sooner is None:
+                return index
+            del busy_faster[sooner]
+        return None
+
+    def _affinity_rank(self, host, item):
+        """0 for items whose prefix this host has cached, 1 for unclaimed items, 2 for other hosts' items."""
+        if not self.affinity or not item.get("context_digest"):
+            return 1
+        owner = self._affinity_hosts.get(item["context_digest"])
+        if owner is None:
+            return 1
+        return 0 if owner == host else 2
+
+    def _choose_hedge(self, host):
+        """A running item worth duplicating on an idle host, or None."""
+        if not (self.hedging and self._closed) or self._items:
+            return None
+        if self.hedges["issued"] >= math.ceil(self.hedge_budget * self._dispatched):
+            return None
+        speed = self.host_speed(host)
+        now = time.monotonic()
+        best, best_gain = None, 0.0
+        for other, running in self._running.items():
+            if other == host:
+                continue
+            other_speed = self.host_speed(other)
+            for item, started in running.values():
+                elapsed = now - started
+                if elapsed < self.hedge_delay or item.get("hedge_host") or host in item.get("failed_hosts", ()):
+                    continue
+                if not self.host_serves(host, item["model"]):
+                    continue
+                # Past its estimate the request is assumed to need as long again
+                remaining = item["cost"] / other_speed - elapsed
+                if remaining <= 0:
+                    remaining = elapsed
+                gain = remaining - item["cost"] / speed
+                if gain > best_gain:
+                    best, best_gain = item, gain
+        return best
+
+    def qsize(self):
+        return len(self._items)
+
+    @property
+    def finished(self):
+        return self._closed and not self._items and self._outstanding == 0
+
+    async def put(self, item):
+        """
+        Add an item, waiting while the queue is full. The item's ready_at
+        (the start of its queue wait) is stamped once it is actually queued,
+        so time spent waiting for space isn't counted.
+        """
+        item.setdefault("priority", 0)
+        item["cost"] = self.estimate_cost(item)
+        async with self._condition:
+            await self._condition.wait_for(lambda: len(self._items) < self.maxsize)
+            item["ready_at"] = time.monotonic()
+            self._items.append(item)
+            self._condition.notify_all()
+
+    async def get(self, host):
+        """Take the next item for a host, or None once the queue is finished."""
+        async with self._condition:
+            self._waiting[host] = self._waiting.get(host, 0) + 1
+            try:
+                while True:
+                    index = hedge = None
+                    if self.host_available(host):
+                        index = self._choose(host)
+                        hedge = self._choose_hedge(host) if index is None else None
+                    if index is not None or hedge is not None or self.finished:
+                        break
+                    # Items left for busy faster or ejected hosts, and running
+                    # items that may become worth hedging, need a timed re-check
+                    recheck = self._items or (self.hedging and self._closed and self._outstanding)
+                    try:
+                        await asyncio.wait_for(
+                            self._condition.wait(), self.DEFER_RECHECK if recheck else None
+                        )
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting[host] -= 1
+            if hedge is not None:
+                item = hedge
+                item["hedge_host"] = host
+                self.hedges["issued"] += 1
+                log_message(f"Hedging prompt {item['id']} on {host}")
+            elif index is not None:
+                item = self._items.pop(index)
+                self._dispatched += 1
+                if self.affinity and item.get("context_digest"):
+                    self._affinity_hosts[item["context_digest"]] = host
+            else:
+                return None
+            self._running.setdefault(host, {})[id(item)] = (item, time.monotonic())
+            self.note_loaded(host, item["model"])
+            self._outstanding += 1
+            self._condition.notify_all()
+            return item
+
+    async def requeue(self, item):
+        """Put an outstanding item back into the queue."""
+        async with self._condition:
+            item["ready_at"] = time.monotonic()
+            self._items.append(item)
+            self._outstanding -= 1
+            self._condition.notify_all()
+
+    async def task_done(self):
+        async with self._condition:
+            self._outstanding -= 1
+            self._condition.notify_all()
+
+    async def drain(self):
+        """Remove and return every queued item."""
+        async with self._condition:
+            items, self._items = self._items, []
+            self._condition.notify_all()
+            return items
+
+    async def close(self):
+        """Signal that producers are done."""
+        async with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    async def wait_finished(self):
+        """Wait until the queue is closed and every item has been handled."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.finished)
+
+class BatchRun:
+    """Settings and shared state of one batch run, handed to the pipeline stages."""
+
+    def __init__(self, model, output_dir, stats, dispatch, generation=None, retry=None,
+                 fetcher=None, manifest=None, journal=None, writer=None, preamble=None, options=None,
+                 context=None, work_queue=None, response_cache=None, dedup=False, postprocessor=None):
+        self.model = model
+        self.options = options or {}
+        self.context = context or {}
+        self.work_queue = work_queue
+        self.response_cache = response_cache
+        self.dedup = dedup
+        self.postprocessor = postprocessor or ResponsePostProcessor(DEFAULT_CLEANER, workers=0)
+        # Request key -> items waiting on an identical request already in flight
+        self.duplicates = {}
+        self.output_dir = output_dir
+        self.stats = stats
+        self.dispatch = dispatch
+        self.generation = generation or {}
+        self.retry = retry or {}
+        self.fetcher = fetcher
+        self.manifest = manifest
+        self.journal = journal
+        self.writer = writer
+        self.preamble = preamble
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.tokens_per_second = Histogram(TOKEN_RATE_BUCKETS)
+
+    def dead_letter(self, item, reason):
+        """Record a prompt that could not be processed on any host."""
+        self.stats["failed"] += 1
+        record = {
+            "id": item["id"],
+            "prompt": item["prompt"],
+            "reason": reason,
+            "errors": item.get("errors", []),
+            "time": datetime.now().isoformat(),
+        }
+        with open(os.path.join(self.output_dir, "dead_letter.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if self.journal is not None:
+            self.journal.record(item["id"], "failed", error=reason)
+        if self.work_queue is not None:
+            self.work_queue.complete(item["id"], "failed")
+        log_message(f"Prompt {item['id']} moved to dead letter file: {reason}")
+        # Identical prompts waiting on this one would fail the same way
+        for follower in self.duplicates.pop(item.get("request_key"), None) or ():
+            self.dead_letter(follower, f"identical to prompt {item['id']}, which failed: {reason}")
+
+    def response_written(self, item, **details):
+        """
+        Callback for the ResponseWriter: record a written response in the
+        manifest, journal and shared work queue, or dead-letter the prompt
+        if it could not be saved.
+        """
+        def on_written(location, error):
+            if error is not None:
+                self.dead_letter(item, f"could not save response: {str(error)}")
+                return
+            # Counted here, once the outcome is final, so a prompt whose
+            # response can't be saved only counts as failed
+            self.stats[{"run": "deduplicated", "cache": "cached"}.get(details.get("cache"), "processed")] += 1
+            if self.manifest is not None:
+                self.manifest.record(item["id"], item["input_hash"], item["context_digest"], item["model"], location)
+            if self.journal is not None:
+                self.journal.record(item["id"], "done", **details)
+            if self.work_queue is not None:
+                self.work_queue.complete(item["id"], "done")
+        return on_written
+
+async def prepare_task(task, output_dir, fetcher, preamble=None, context_settings=None):
+    """
+    Resolve a queued task into a ready item for the GPU workers.
+
+    Fetches the linked references and builds the context block. With a
+    preamble (prefix-cache layout) the context block is that shared preamble
+    and the references travel separately, after it. The references are fitted
+    to the token budget from context_settings and the prompt's num_ctx (see
+    reference_token_budget). Returns None
+    if the prompt is skipped, either because a reference could not be
+    fetched or because the references are unchanged since the response
+    recorded in the manifest (see build_task).
+    """
+    prompt_id, prompt, system_msg = task["id"], task["prompt"], task["system_message"]
+
+    # Extract URLs from prompt text
+    links = extract_markdown_links(prompt)
+
+    # Create a modified prompt with reference numbers instead of markdown links
+    modified_prompt = prompt
+    for i, (text, url) in enumerate(links, 1):
+        modified_prompt = modified_prompt.replace(f'[{text}]({url})', f'{text}[{i}]')
+
+    # Create the context block (always includes date/time and location)
+    context_block = preamble if preamble is not None else create_context_block()
+    references = None
+
+    # If we have URLs, fetch their content and create an enhanced context block
+    if links:
+        log_message(f"Found {len(links)} URLs in prompt {prompt_id}")
+        url_list = [url for _, url in links]
+
+        # Log the URLs being fetched
+        for i, url in enumerate(url_list, 1):
+            log_message(f"URL {i}: {url}")
+
+        try:
+            contexts = await fetch_all_contexts(url_list, fetcher)
+        except ValueError as e:
+            log_message(f"Error processing prompt {prompt_id}: {str(e)}")
+            log_message(f"Skipping prompt {prompt_id} due to URL fetch failure")
+            task["error"] = str(e)
+            return None
+
+        # Create context block with the fetched content
+        log_message(f"Successfully fetched content from all URLs")
+        for i, context in enumerate(contexts, 1):
+            log_message(f"Content from URL {i}: {len(context)} characters")
+
+        budget = reference_token_budget(
+            context_settings, task["options"], system_msg + context_block + modified_prompt
+        )
+        if budget == 0:
+            log_message(f"Prompt {prompt_id} leaves no room for references within num_ctx")
+        if preamble is not None:
+            references = create_references_block(contexts, links, budget)
+        else:
+            context_block = create_context_block(contexts, links, budget)
+        context_digest = compute_context_digest(contexts)
+        if task["expected_context_digest"] == context_digest:
+            log_message(f"Skipping {prompt_id} - prompt and references unchanged since last run")
+            return None
+    else:
+        log_message(f"No URLs found in prompt {prompt_id}")
+        context_digest = None
+
+    return {
+        "id": prompt_id,
+        "input_hash": task["input_hash"],
+        "context_digest": context_digest,
+        "prompt": prompt,
+        "chat_prompt": modified_prompt,
+        "system_message": system_msg,
+        "context_block": context_block,
+        "references": references,
+        "model": task["model"],
+        "options": task["options"],
+        "priority": task.get("priority", 0),
+    }
+
+async def write_shared_response(item, record, run, source):
+    """Save a response generated for an identical request as this item's response."""
+    output, markdown = build_response_record(
+        item["prompt"],
+        record["response"],
+        cleaned=await run.postprocessor.clean(record["response"]),
+        length=record.get("length"),
+        full_prompt=record.get("full_prompt"),
+        extra_metrics=record.get("metrics"),
+        extra_fields={
+            "model": item["model"],
+            "input_hash": item["input_hash"],
+            "context_digest": item["context_digest"],
+            "cached_from": {"source": source, "prompt_id": record.get("prompt_id"), "created": record.get("created")},
+        },
+    )
+    await run.writer.submit(item["id"], output, markdown, run.response_written(item, cache=source))
+
+async def share_response(item, record, run):
+    """Fan a finished response out to identical prompts of this run and store it in the response cache."""
+    for follower in run.duplicates.pop(item["request_key"], None) or ():
+        await write_shared_response(follower, record, run, "run")
+    if run.response_cache is not None:
+        try:
+            await asyncio.to_thread(run.response_cache.put, item["request_key"], record)
+        except OSError as e:
+            log_message(f"Could not cache response for {item['id']}: {str(e)}")
+
+async def reuse_response(item, run):
+    """
+    Serve an item without a model request if possible. Returns True when the
+    item was attached to an identical request already in flight (its response
+    is shared when that one finishes) or answered from the response cache.
+    """
+    key = item["request_key"] = compute_request_key(item, run.generation)
+    if run.dedup:
+        followers = run.duplicates.get(key)
+        if followers is not None:
+            followers.append(item)
+            log_message(f"Prompt {item['id']} is identical to a prompt in flight, sharing its response")
+            return True
+        # Claim the key before the cache lookup, so identical prompts prepared meanwhile wait on this one
+        run.duplicates[key] = []
+    if run.response_cache is None:
+        return False
+    record = await asyncio.to_thread(run.response_cache.get, key)
+    if record is None:
+        return False
+    log_message(f"Prompt {item['id']} answered from the response cache")
+    for cached in [item] + (run.duplicates.pop(key, None) or []):
+        await write_shared_response(cached, record, run, "cache")
+    return True
+
+async def prefetch_worker(task_queue, run):
+    """
+    Producer stage: prepare queued tasks ahead of the GPU workers.
 
-    # Track the current timestamp for last_updated field
-    current_time = datetime.now()
+    Ready items go to the bounded dispatch queue, so at most its size worth
+    of prompts are resolved ahead of the GPUs.
+    """
+    stats, journal = run.stats, run.journal
+    while True:
+        task = await task_queue.get()
+        try:
+            if task is None:  # None is our signal to stop
+                break
+            try:
+                item = await prepare_task(task, run.output_dir, run.fetcher, run.preamble, run.context)
+            except Exception as e:
+                log_message(f"Error preparing prompt {task['id']}: {str(e)}")
+                traceback.print_exc()
+                task["error"] = str(e)
+                item = None
+            if item is None:
+                stats["skipped"] += 1
+                if journal is not None:
+                    if task.get("error"):
+                        journal.record(task["id"], "failed", error=task["error"])
+                    else:
+                        journal.record(task["id"], "done", skipped=True)
+                if run.work_queue is not None:
+                    run.work_queue.complete(task["id"], "failed" if task.get("error") else "done")
+                continue
+            if (run.dedup or run.response_cache is not None) and await reuse_response(item, run):
+                continue
+            await run.dispatch.put(item)
+            pipeline_stats = stats["pipeline"]
+            pipeline_stats["ready_peak"] = max(pipeline_stats["ready_peak"], run.dispatch.qsize())
+        finally:
+            task_queue.task_done()
 
-    # Create the output dictionary with timing and length metrics
-    output = {
-        "prompt": prompt,
-        "full_prompt": full_prompt if full_prompt else prompt,  # Include full prompt if available
-        "response": response_text,
-        "think": think_content,
-        "metrics": {
-            "start_time": start_time.isoformat() if start_time else None,
-            "duration_seconds": duration,
-            "length": length
-        },
-        "last_updated": current_time.isoformat()
-    }
+async def monitor_pipeline(task_queue, ready_queue, interval):
+    """Periodically log the depth of the pending and ready queues."""
+    while True:
+        await asyncio.sleep(interval)
+        log_message(
+            f"Queue depth: pending {task_queue.qsize()}, "
+            f"ready {ready_queue.qsize()}/{ready_queue.maxsize}"
+        )
 
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+async def retry_or_dead_letter(item, host, error, run):
+    """
+    Handle a failed attempt: requeue the item after an exponential backoff,
+    preferring other hosts, or dead-letter it once max_attempts is reached.
+    """
+    item["attempts"] = item.get("attempts", 0) + 1
+    item.setdefault("failed_hosts", set()).add(host)
+    item.setdefault("errors", []).append({"host": host, "error": str(error)})
+    max_attempts = int(run.retry.get("max_attempts", 3))
+    if item["attempts"] >= max_attempts:
+        run.dead_letter(item, f"failed {item['attempts']} attempt(s), last error: {str(error)}")
+        await run.dispatch.task_done()
+        return
 
-    # Save JSON with full data
-    json_path = os.path.join(output_dir, f"{base_filename}.json")
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    base = float(run.retry.get("backoff_base", 2))
+    delay = min(float(run.retry.get("backoff_max", 60)), base * 2 ** (item["attempts"] - 1))
+    delay *= random.uniform(0.5, 1.0)
+    run.stats["retried"] += 1
+    if run.journal is not None:
+        run.journal.record(item["id"], "queued", attempt=item["attempts"] + 1)
+    log_message(f"Retrying prompt {item['id']} in {delay:.1f}s (attempt {item['attempts'] + 1} of {max_attempts})")
 
-    # Save TXT with just the cleaned response
-    txt_path = os.path.join(output_dir, f"{base_filename}.md")
-    with open(txt_path, 'w', encoding='utf-8') as f:
-        f.write(clean_markdown)
+    async def requeue_later():
+        await asyncio.sleep(delay)
+        await run.dispatch.requeue(item)
 
-    return json_path, txt_path
+    asyncio.create_task(requeue_later())
 
-def should_regenerate(prompt_id, output_dir, prompt_file_modified_time):
+def instance_serves(instance, model):
+    """True if a parsed instance may run the model."""
+    models = instance["models"]
+    return models is None or normalize_model_name(model) in {normalize_model_name(m) for m in models}
+
+def normalize_model_name(name):
+    """Ollama treats "llama3" and "llama3:latest" as the same model."""
+    return name if ":" in name else f"{name}:latest"
+
+async def watch_loaded_models(client_pool, dispatch, hosts, interval):
     """
-    Check if we should regenerate the response by comparing prompt file's 
-    modification time with the last_updated time in the output JSON.
-    
-    Returns True if the response should be regenerated, False otherwise.
+    Poll /api/ps on every host and tell the dispatcher which models are
+    loaded where. hosts is re-read on every poll, so hosts may be added.
     """
-    if not prompt_id:
-        return True  # Always regenerate if no prompt ID is provided
-    
-    # Check if the output file exists
-    output_file = os.path.join(output_dir, f"{prompt_id}.json")
-    if not os.path.exists(output_file):
-        return True  # Regenerate if output doesn't exist
-    
+    async def poll(host):
+        try:
+            response = await client_pool.get(host).ps()
+            dispatch.set_loaded(host, [
+                model.get("name") or model.get("model") for model in response.get("models", [])
+            ])
+        except Exception as e:
+            log_message(f"Could not list loaded models on {host}: {type(e).__name__}: {str(e)}")
+
+    while True:
+        await asyncio.gather(*(poll(host) for host in list(hosts)))
+        await asyncio.sleep(interval)
+
+async def warm_up_model(client, host, model, keep_alive=None):
+    """Load the model on a host with an empty generate request, so the first prompt doesn't pay for it."""
+    started = time.monotonic()
     try:
-        # Load the existing output file
-        with open(output_file, 'r', encoding='utf-8') as f:
-            output_data = json.load(f)
-        
-        # Get the last_updated timestamp from the output
-        last_updated_str = output_data.get('last_updated')
-        if not last_updated_str:
-            return True  # Regenerate if no last_updated field
-        
-        # Convert last_updated string to datetime
-        last_updated = datetime.fromisoformat(last_updated_str)
-        
-        # Compare with prompt file's modification time
-        if prompt_file_modified_time > last_updated:
-            return True  # Regenerate if prompt file was modified after last run
-        
-        return False  # No need to regenerate
+        await client.generate(model=model, prompt="", keep_alive=keep_alive)
+        log_message(f"Model {model} loaded on {host} in {time.monotonic() - started:.1f}s")
     except Exception as e:
-        log_message(f"Error checking regeneration status: {str(e)}")
-        return True  # Regenerate on error to be safe
+        log_message(f"Could not warm up {model} on {host}: {type(e).__name__}: {str(e)}")
 
-async def chat(prompt, host, model, system_message, context_block=None):
-    """Process a single prompt with context and return the response."""
-    start_time = datetime.now()
-    
-    # Create context block with date and location if none was provided
-    if context_block is None:
-        context_block = create_context_block()
-    
-    # Prepare messages with context if available
-    messages = []
-    if system_message:
-        messages.append({"role": "system", "content": system_message})
-    
-    # Always include context block
-    messages.append({"role": "user", "content": context_block})
-    messages.append({"role": "user", "content": prompt})
+def host_stats_for(stats, host, gpu_index):
+    """Return the per-host counters in stats, creating them on first use."""
+    return stats.setdefault("hosts", {}).setdefault(host, {
+        "gpu": gpu_index,
+        "processed": 0,
+        "failed": 0,
+        "slots": {},
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "eval_tokens": 0,
+        "prompt_eval_seconds": 0.0,
+        "eval_seconds": 0.0,
+        "load_seconds": 0.0,
+        "queue_wait_seconds": 0.0,
+    })
 
-    # Create the full prompt for debugging
-    full_prompt = ""
-    if system_message:
-        full_prompt += f"System: {system_message}\n\n"
-    
-    # Always include context block in full prompt
-    full_prompt += f"Context: {context_block}\n\n"
-    full_prompt += f"User: {prompt}"
+def record_token_stats(host_stats, slot, metrics):
+    """Add one completed request's token counts and timings to the host totals."""
+    host_stats["processed"] += 1
+    host_stats["slots"][slot] += 1
+    host_stats["queue_wait_seconds"] += metrics["queue_wait_seconds"]
+    # Rates are only meaningful over requests that report both count and duration
+    if metrics["prompt_tokens"] is not None and metrics["prompt_eval_seconds"] is not None:
+        host_stats["prompt_tokens"] += metrics["prompt_tokens"]
+        host_stats["prompt_eval_seconds"] += metrics["prompt_eval_seconds"]
+    if metrics["completion_tokens"] is not None:
+        host_stats["completion_tokens"] += metrics["completion_tokens"]
+    if metrics["tokens_per_second"] is not None:
+        host_stats["eval_tokens"] += metrics["completion_tokens"]
+        host_stats["eval_seconds"] += metrics["eval_seconds"]
+    if metrics["load_seconds"] is not None:
+        host_stats["load_seconds"] += metrics["load_seconds"]
 
-    # Make the API request
-    client = AsyncClient(host=host)
-    response = await client.chat(
-        model=model,
-        messages=messages,
-        stream=False
-    )
-    
-    # Calculate duration and get response length
-    duration = (datetime.now() - start_time).total_seconds()
-    length = len(response['message']['content'])
-    
-    return response['message']['content'], start_time, duration, length, full_prompt
+def format_metric(value, spec):
+    """Format an optional metric, showing n/a when Ollama didn't report it."""
+    return spec.format(value) if value is not None else "n/a"
 
-async def worker(host, gpu_index, model, task_queue, output_dir, stats=None):
-    """Process prompts from the queue using the specified host and GPU."""
+async def worker(host, gpu_index, slot, run, controller=None, client=None, health=None):
+    """Send prepared prompts from the dispatch queue to the specified host, GPU and request slot."""
+    stats, journal = run.stats, run.journal
+    request_timeout = float(run.retry.get("request_timeout", 0)) or None
+    host_stats = host_stats_for(stats, host, gpu_index)
+    host_stats["slots"].setdefault(slot, 0)
     processed = 0
-    skipped = 0
     
     while True:
+        # Don't take work while this host is ejected by its circuit breaker
+        if health is not None:
+            await health.wait_available()
+        # Wait for a free slot on this host before taking work off the shared queue
+        if controller is not None:
+            await controller.acquire()
+        outcome, latency, units, started = None, None, 0, False
         try:
-            # Get a task from the queue
-            task = await task_queue.get()
-            if task is None:  # None is our signal to stop
-                task_queue.task_done()
+            # Get a prepared prompt from the dispatch queue
+            wait_started = time.monotonic()
+            item = await run.dispatch.get(host)
+            if item is None:  # Everything has been processed
                 break
-                
-            prompt_id, prompt, system_msg, prompt_file_modified_time = task
+            if controller is not None:
+                controller.start()
+                started = True
+            stats["pipeline"]["ready_wait_seconds"] += time.monotonic() - wait_started
+            queue_wait = time.monotonic() - item["ready_at"]
             
-            # Check if we need to regenerate the response
-            if not should_regenerate(prompt_id, output_dir, prompt_file_modified_time):
-                log_message(f"Skipping {prompt_id} - prompt unchanged since last run")
-                skipped += 1
-                task_queue.task_done()
+            prompt_id, model = item["id"], item["model"]
+            if journal is not None:
+                journal.record(prompt_id, "in_flight", flush=False, host=host)
+            try:
+                # Process the prompt - use modified prompt with reference numbers.
+                # The request runs as its own task so that a hedged copy of
+                # the prompt on another host can cancel it by finishing first.
+                request = asyncio.ensure_future(asyncio.wait_for(
+                    chat(
+                        item["chat_prompt"], host, model, item["system_message"], item["context_block"],
+                        client, run.generation, item["references"], item["options"]
+                    ),
+                    request_timeout,
+                ))
+                copies = item.setdefault("requests", {})
+                copies[host] = request
+                try:
+                    await asyncio.wait({request})
+                except asyncio.CancelledError:
+                    request.cancel()
+                    raise
+                finally:
+                    copies.pop(host, None)
+                if request.cancelled() or item.get("completed"):
+                    # Another copy of this prompt finished first
+                    run.dispatch.mark_stopped(host, item)
+                    await run.dispatch.task_done()
+                    continue
+                response_text, start_time, duration, length, full_prompt, chat_metrics = request.result()
+            except Exception as e:
+                log_message(f"Error on host {host} for prompt {prompt_id}: {type(e).__name__}: {str(e)}")
+                run.dispatch.mark_stopped(host, item, failed=True)
+                host_stats["failed"] += 1
+                if is_overload_error(e):
+                    outcome = False
+                if health is not None and is_host_failure(e):
+                    health.record_failure()
+                if item.get("requests") or item.get("completed"):
+                    # A hedged copy is still running (or already won)
+                    await run.dispatch.task_done()
+                    continue
+                item.pop("hedge_host", None)
+                await retry_or_dead_letter(item, host, e, run)
                 continue
+
+            # First copy to finish wins; cancel the others
+            item["completed"] = True
+            for other in item["requests"].values():
+                other.cancel()
+            if item.get("hedge_host"):
+                won = item["hedge_host"] == host
+                run.dispatch.hedges["won" if won else "lost"] += 1
+                log_message(f"Hedge for prompt {prompt_id} {'won' if won else 'lost'} (finished on {host})")
+
+            if health is not None:
+                health.record_success()
+            processed += 1
+            chat_metrics["queue_wait_seconds"] = queue_wait
+            record_token_stats(host_stats, slot, chat_metrics)
+            run.dispatch.record_completion(host, item, duration, chat_metrics["completion_tokens"])
+            run.request_seconds.observe(host, duration)
+            if chat_metrics["tokens_per_second"] is not None:
+                run.tokens_per_second.observe(host, chat_metrics["tokens_per_second"])
             
-            start_time = datetime.now()
+            # Throughput for the concurrency controller, in generated tokens
+            tokens = chat_metrics["completion_tokens"]
+            if tokens is None:
+                tokens = len(response_text.split())
+            outcome, latency, units = True, duration, tokens
+            
+            # Hand the response to the background writer; it is recorded as
+            # done in the manifest and journal once it is safely on disk
+            output, markdown = build_response_record(
+                item["prompt"],  # Save original prompt in output
+                response_text,
+                start_time,
+                duration,
+                length,
+                full_prompt,
+                chat_metrics,
+                {
+                    "model": model,
+                    "input_hash": item["input_hash"],
+                    "context_digest": item["context_digest"],
+                },
+                cleaned=await run.postprocessor.clean(response_text),
+            )
+
             try:
-                # Extract URLs from prompt text
-                links = extract_markdown_links(prompt)
-                
-                # Create a modified prompt with reference numbers instead of markdown links
-                modified_prompt = prompt
-                for i, (text, url) in enumerate(links, 1):
-                    modified_prompt = modified_prompt.replace(f'[{text}]({url})', f'{text}[{i}]')
-                
-                # Create the context block (always includes date/time and location)
-                context_block = create_context_block()
-                
-                # If we have URLs, fetch their content and create an enhanced context block
-                if links:
-                    log_message(f"Found {len(links)} URLs in prompt {prompt_id}")
-                    url_list = [url for _, url in links]
-                    
-                    # Log the URLs being fetched
-                    for i, url in enumerate(url_list, 1):
-                        log_message(f"URL {i}: {url}")
-                    
-                    try:
-                        contexts = await fetch_all_contexts(url_list)
-                        
-                        # Create context block with the fetched content
-                        log_message(f"Successfully fetched content from all URLs")
-                        for i, context in enumerate(contexts, 1):
-                            log_message(f"Content from URL {i}: {len(context)} characters")
-                            
-                        context_block = create_context_block(contexts, links)
-                    except ValueError as e:
-                        log_message(f"Error processing prompt {prompt_id}: {str(e)}")
-                        log_message(f"Skipping prompt {prompt_id} due to URL fetch failure")
-                        skipped += 1
-                        task_queue.task_done()
-                        continue
-                else:
-                    log_message(f"No URLs found in prompt {prompt_id}")
-                
-                # Process the prompt - use modified prompt with reference numbers
-                response_text, start_time, duration, length, full_prompt = await chat(modified_prompt, host, model, system_msg, context_block)
-                processed += 1
-                
-                # Calculate words in response
-                word_count = len(response_text.split())
-                
-                # Save response with timing information
-                json_path, txt_path = save_response(
-                    prompt,  # Save original prompt in output
-                    response_text, 
-                    output_dir, 
-                    prompt_id,
-                    start_time,
-                    duration,
-                    length,
-                    full_prompt
-                )
-                
-                # Log completion with metrics
-                processing_time = (datetime.now() - start_time).total_seconds()
-                wps = word_count / processing_time if processing_time > 0 else 0
-                log_message(
-                    f"Host: {host}, GPU: {gpu_index}, Words: {word_count}, "
-                    f"Duration: {processing_time:.2f}s, WPS: {wps:.2f}"
-                )
-                
-            except Exception as e:
-                log_message(f"Error on host {host}: {str(e)}")
-                traceback.print_exc()
-                
-            # Mark task as done
-            task_queue.task_done()
+                await run.writer.submit(prompt_id, output, markdown, run.response_written(item, host=host))
+                if item.get("request_key"):
+                    await share_response(item, {
+                        "response": response_text,
+                        "full_prompt": full_prompt,
+                        "length": length,
+                        "metrics": chat_metrics,
+                        "model": model,
+                        "prompt_id": prompt_id,
+                        "created": datetime.now().isoformat(),
+                    }, run)
+            finally:
+                await run.dispatch.task_done()
+            
+            # Log completion with metrics
+            streaming_info = ""
+            if chat_metrics.get("streamed"):
+                ttft = chat_metrics["time_to_first_token"]
+                streaming_info = (
+                    f", TTFT: {ttft:.2f}s" if ttft is not None else ", TTFT: n/a"
+                ) + f", Stop: {chat_metrics['stop_reason']}"
+            log_message(
+                f"Host: {host}, GPU: {gpu_index}, Slot: {slot}, "
+                f"Prompt tokens: {format_metric(chat_metrics['prompt_tokens'], '{:d}')} "
+                f"({format_metric(chat_metrics['prompt_tokens_per_second'], '{:.1f}/s')}), "
+                f"Tokens: {format_metric(chat_metrics['completion_tokens'], '{:d}')} "
+                f"({format_metric(chat_metrics['tokens_per_second'], '{:.1f}/s')}), "
+                f"Load: {format_metric(chat_metrics['load_seconds'], '{:.2f}s')}, "
+                f"Queue wait: {queue_wait:.2f}s, Duration: {duration:.2f}s{streaming_info}"
+            )
             
         except asyncio.CancelledError:
             break
         except Exception as e:
             log_message(f"Worker error: {str(e)}")
             traceback.print_exc()
+        finally:
+            if controller is not None:
+                await controller.release(outcome, latency, units, started)
     
-    # Update stats dictionary if provided
-    if stats is not None:
-        stats["processed"] += processed
-        stats["skipped"] += skipped
-            
-    log_message(f"Worker for {host} (GPU {gpu_index}) shutting down")
-    return processed, skipped
+    log_message(f"Worker for {host} (GPU {gpu_index}, slot {slot}) shutting down")
+    return processed
+
+async def watch_outage(healths, dispatch, run, max_outage):
+    """
+    Dead-letter queued prompts when every host has been ejected for longer
+    than max_outage seconds, so a cluster-wide outage ends the run instead
+    of waiting forever. healths maps hosts to their HostHealth and may grow
+    while the run goes on.
+    """
+    while not dispatch.finished:
+        await asyncio.sleep(min(max_outage, 5.0))
+        now = time.monotonic()
+        if healths and all(
+            h.ejected_since is not None and now - h.ejected_since >= max_outage for h in list(healths.values())
+        ):
+            for item in await dispatch.drain():
+                run.dead_letter(item, f"all hosts unavailable for {max_outage:.0f}s")
 
 async def process_prompt_with_context(prompt, host, model, system_message, prompt_id=None, prompt_file_modified_time=None, output_dir="responses"):
     """Process a single prompt with context fetching."""
@@ -465,7 +2629,7 @@ async def process_prompt_with_context(prompt, host, model, system_message, promp
         log_message(f"No URLs found in prompt {prompt_id}")
     
     # Get response from model - use modified_prompt with reference numbers
-    response_text, start_time, duration, length, full_prompt = await chat(modified_prompt, host, model, system_message, context_block)
+    response_text, start_time, duration, length, full_prompt, chat_metrics = await chat(modified_prompt, host, model, system_message, context_block)
     
     # Save response with timing information
     return save_response(
@@ -476,57 +2640,510 @@ async def process_prompt_with_context(prompt, host, model, system_message, promp
         start_time, 
         duration, 
         length,
-        full_prompt
+        full_prompt,
+        chat_metrics
     )
 
-async def main(config_path, prompts_path, output_dir, no_notify=False):
+async def feed_from_work_queue(task_queue, run, ingested, claim_batch, poll_interval=2.0):
+    """
+    Intake stage with a shared work queue: claim prompts this driver's hosts
+    serve and hold at most claim_batch of them at a time, counting every
+    claimed prompt until it is done (queued, being prepared, ready or running),
+    so other drivers get a share of what is left. Returns once ingestion is
+    done and no prompt this driver could run is pending or leased anywhere.
+    """
+    work_queue, journal = run.work_queue, run.journal
+    models = run.dispatch.served_models()
+    claimed = 0
+    while True:
+        wanted = claim_batch - work_queue.outstanding()
+        if wanted <= 0:
+            await asyncio.sleep(min(poll_interval, 0.5))
+            continue
+        tasks = await asyncio.to_thread(work_queue.claim, wanted, models)
+        for task in tasks:
+            journal.record(task["id"], "queued", flush=False, driver=work_queue.driver_id)
+            await task_queue.put(task)
+        claimed += len(tasks)
+        if tasks:
+            journal.flush()
+            continue
+        if ingested.is_set() and not await asyncio.to_thread(work_queue.unfinished, models):
+            break
+        await asyncio.sleep(poll_interval)
+    log_message(f"Claimed {claimed} prompts from the shared work queue")
+
+async def renew_leases(work_queue, interval):
+    """Periodically write completions to the shared work queue and renew this driver's leases."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(work_queue.heartbeat)
+        except sqlite3.Error as e:
+            log_message(f"Could not renew leases in {work_queue.path}: {str(e)}")
+
+async def ingest_prompts(prompt_source, task_queue, run, system_msg, resume=False):
+    """
+    Intake stage: turn prompt records into tasks on the bounded task queue.
+
+    Records are pulled lazily from prompt_source, and put() blocks while the
+    queue is full, so only a queue's worth of prompts is held in memory.
+    With a shared work queue (run.work_queue) the tasks are added to it in
+    batches instead, and feed_from_work_queue() claims them from there.
+    Returns the number of prompts read.
+    """
+    journal, stats, work_queue = run.journal, run.stats, run.work_queue
+    count = 0
+    queued = 0
+    shared = []
+    # Derived id -> copies of that prompt text seen so far in the current
+    # file, least recently seen first and bounded by REPEAT_WINDOW
+    derived, derived_source = {}, None
+    for prompt, source_file, modified_time in prompt_source:
+        count += 1
+        if isinstance(prompt, dict):
+            prompt_id = prompt.get('id', None)
+            prompt_content = prompt.get('content', prompt.get('prompt', ''))
+            prompt_model = prompt.get('model') or run.model
+            prompt_options = {**run.options, **(prompt.get('options') or {})}
+        else:
+            # If prompt is a string (simple format)
+            prompt_id, prompt_content = None, prompt
+            prompt_model, prompt_options = run.model, dict(run.options)
+        if not prompt_id:
+            if source_file != derived_source:
+                # Derived ids include the file name, so repeats are only counted within a file
+                derived, derived_source = {}, source_file
+            prompt_id = derive_prompt_id(prompt_content, source_file)
+            occurrence = derived.pop(prompt_id, 0)
+            derived[prompt_id] = occurrence + 1
+            if len(derived) > REPEAT_WINDOW:
+                del derived[next(iter(derived))]
+            if occurrence:
+                base_id, prompt_id = prompt_id, derive_prompt_id(prompt_content, source_file, occurrence)
+                log_message(f"Prompt {prompt_id} repeats {base_id} in {source_file} (copy {occurrence + 1})")
+        if resume and journal.is_done(prompt_id):
+            log_message(f"Skipping {prompt_id} - already done in the resumed run")
+            stats["skipped"] += 1
+        elif work_queue is None and not run.dispatch.serves(prompt_model):
+            run.dead_letter(
+                {"id": prompt_id, "prompt": prompt_content},
+                f"no host in [ollama_instances] serves model {prompt_model}",
+            )
+        else:
+            # Model options only join the hash when set, so earlier hashes stay valid
+            hash_options = output_generation_settings(run.generation)
+            if prompt_options:
+                hash_options["options"] = prompt_options
+            task = build_task(
+                prompt_id, prompt_content, system_msg, prompt_model, hash_options,
+                modified_time, run.manifest, run.output_dir
+            )
+            if task is None:
+                log_message(f"Skipping {prompt_id} - prompt unchanged since last run")
+                stats["skipped"] += 1
+                journal.record(prompt_id, "done", flush=False, skipped=True)
+            else:
+                if isinstance(prompt, dict):
+                    try:
+                        task["priority"] = int(prompt.get("priority", 0))
+                    except (TypeError, ValueError):
+                        log_message(f"Prompt {prompt_id} has an invalid priority {prompt.get('priority')!r}, using 0")
+                        task["priority"] = 0
+                task["model"], task["options"] = prompt_model, prompt_options
+                if work_queue is not None:
+                    # Another driver's hosts may serve the model, so it is queued regardless
+                    shared.append(task)
+                else:
+                    journal.record(prompt_id, "queued", flush=False)
+                    await task_queue.put(task)
+                queued += 1
+        if shared and (len(shared) >= 500 or count % 1000 == 0):
+            await asyncio.to_thread(work_queue.add, shared)
+            shared = []
+        if count % 1000 == 0:
+            journal.flush()
+            # Reading and hashing is synchronous; let the workers run
+            await asyncio.sleep(0)
+    if shared:
+        await asyncio.to_thread(work_queue.add, shared)
+    journal.flush()
+    log_message(f"Read {count} prompts: {queued} queued, {stats['skipped']} skipped")
+    return count
+
+# Histogram bucket bounds for request/fetch latency (seconds) and generation speed (tokens/s)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+class Histogram:
+    """A labelled Prometheus-style histogram with fixed bucket bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self._series = {}
+
+    def observe(self, label, value):
+        series = self._series.get(label)
+        if series is None:
+            series = self._series[label] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self, name, label_name=None):
+        """Return the exposition lines for every observed label value."""
+        lines = []
+        for label, series in sorted(self._series.items(), key=lambda item: str(item[0])):
+            base = f'{label_name}="{label}",' if label_name else ""
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f'{name}_bucket{{{base}le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{base}le="+Inf"}} {series["count"]}')
+            labels = f"{{{base.rstrip(',')}}}" if base else ""
+            lines.append(f"{name}_sum{labels} {series['sum']}")
+            lines.append(f"{name}_count{labels} {series['count']}")
+        return lines
+
+# Prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class MetricsServer:
+    """
+    Serves live batch metrics in the Prometheus text format on /metrics.
+
+    Counters are read from the run's stats, gauges from the queues,
+    concurrency controllers and host health, and the latency and tokens/s
+    histograms are filled in by the workers and the URL fetcher.
+    """
+
+    def __init__(self, run, task_queue, controllers, healths, host="127.0.0.1", port=9109):
+        self.run = run
+        self.task_queue = task_queue
+        self.controllers = controllers
+        self.healths = healths
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, self.host, self.port).start()
+        log_message(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_metrics(self, request):
+        # aiohttp's content_type argument rejects parameters, so the
+        # exposition format version goes in the header directly
+        return aiohttp.web.Response(
+            body=self.render().encode("utf-8"),
+            headers={"Content-Type": METRICS_CONTENT_TYPE},
+        )
+
+    def render(self):
+        stats = self.run.stats
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric("ollama_batch_prompts_total", "counter", "Prompts by final outcome.", [
+            ({"outcome": outcome}, stats[outcome])
+            for outcome in ("processed", "skipped", "failed", "cached", "deduplicated")
+        ])
+        metric("ollama_batch_retries_total", "counter", "Failed attempts that were requeued.", [({}, stats["retried"])])
+        metric("ollama_batch_hedges_total", "counter", "Hedged duplicate requests by result.", [
+            ({"result": result}, count) for result, count in self.run.dispatch.hedges.items()
+        ])
+        metric("ollama_batch_queue_depth", "gauge", "Prompts waiting in each pipeline queue.", [
+            ({"queue": "pending"}, self.task_queue.qsize()),
+            ({"queue": "ready"}, self.run.dispatch.qsize()),
+        ])
+
+        hosts = stats.get("hosts", {})
+        metric("ollama_batch_in_flight", "gauge", "Requests currently running on each host.", [
+            ({"host": host}, controller.in_flight) for host, controller in self.controllers.items()
+        ])
+        metric("ollama_batch_concurrency_limit", "gauge", "Current concurrency limit of each host.", [
+            ({"host": host}, controller.limit) for host, controller in self.controllers.items()
+        ])
+        metric("ollama_batch_host_up", "gauge", "0 while a host is ejected by its circuit breaker.", [
+            ({"host": host}, int(health.is_available)) for host, health in self.healths.items()
+        ])
+        metric("ollama_batch_host_requests_total", "counter", "Completed and failed requests per host.", [
+            ({"host": host, "gpu": host_stats["gpu"], "outcome": outcome}, host_stats[key])
+            for host, host_stats in hosts.items()
+            for outcome, key in (("success", "processed"), ("failure", "failed"))
+        ])
+        metric("ollama_batch_host_tokens_total", "counter", "Prompt and generated tokens per host.", [
+            ({"host": host, "kind": kind}, host_stats[key])
+            for host, host_stats in hosts.items()
+            for kind, key in (("prompt", "prompt_tokens"), ("completion", "completion_tokens"))
+        ])
+        metric("ollama_batch_host_model_load_seconds_total", "counter", "Time spent loading the model per host.", [
+            ({"host": host}, host_stats["load_seconds"]) for host, host_stats in hosts.items()
+        ])
+        metric("ollama_batch_host_queue_wait_seconds_total", "counter", "Time prepared prompts waited for a slot, per host.", [
+            ({"host": host}, host_stats["queue_wait_seconds"]) for host, host_stats in hosts.items()
+        ])
+
+        lines.append("# HELP ollama_batch_request_duration_seconds Chat request latency per host.")
+        lines.append("# TYPE ollama_batch_request_duration_seconds histogram")
+        lines.extend(self.run.request_seconds.render("ollama_batch_request_duration_seconds", "host"))
+        lines.append("# HELP ollama_batch_tokens_per_second Generation speed reported by Ollama per host.")
+        lines.append("# TYPE ollama_batch_tokens_per_second histogram")
+        lines.extend(self.run.tokens_per_second.render("ollama_batch_tokens_per_second", "host"))
+
+        fetcher = self.run.fetcher
+        if fetcher is not None:
+            metric("ollama_batch_url_cache_requests_total", "counter", "URL lookups by cache result.", [
+                ({"result": result}, fetcher.stats[key]) for result, key in (
+                    ("hit", "hits"), ("revalidated", "revalidated"),
+                    ("miss", "misses"), ("deduplicated", "deduplicated"),
+                )
+            ])
+            lines.append("# HELP ollama_batch_url_fetch_duration_seconds URL download latency.")
+            lines.append("# TYPE ollama_batch_url_fetch_duration_seconds histogram")
+            lines.extend(fetcher.download_seconds.render("ollama_batch_url_fetch_duration_seconds"))
+
+        return "\n".join(lines) + "\n"
+
+async def main(config_path, prompts_path, output_dir, no_notify=False, resume=False, queue_path=None):
     """Main function to process prompts using Ollama."""
     start_time = datetime.now()
-    stats = {"processed": 0, "skipped": 0}
+    stats = {
+        "processed": 0, "skipped": 0, "failed": 0, "retried": 0, "cached": 0, "deduplicated": 0,
+        "pipeline": {"ready_peak": 0, "ready_wait_seconds": 0.0},
+    }
     
     try:
         # Load configuration
         config = load_config(config_path)
         system_msg = config.get("system_message", "")
         model = config["model"]
+        generation = config.get("generation", {})
+        # Built up front so bad [postprocess] rules fail before any work starts
+        postprocessor = create_postprocessor(config)
         
-        # Load prompts from both specified path and prompts directory
-        prompts = load_prompts(prompts_dir="prompts", prompts_files=[prompts_path] if prompts_path else None)
-        total_prompts = len(prompts)
-        log_message(f"Total prompts to process: {total_prompts}")
-        
-        # Create directory for responses
+        # Create directory for responses and load the index of existing ones
         os.makedirs(output_dir, exist_ok=True)
+        manifest = ResponseManifest(output_dir)
+        manifest.load()
+        journal = RunJournal(output_dir)
+        journal.open(resume)
+
+        # With a shared work queue, several drivers split the prompts between them
+        queue_config = config.get("queue", {})
+        queue_path = queue_path or queue_config.get("path")
+        work_queue = None
+        if queue_path:
+            work_queue = LeaseQueue(
+                queue_path, queue_config.get("driver") or None, float(queue_config.get("lease_seconds", 120))
+            )
+            await asyncio.to_thread(work_queue.open)
+            log_message(f"Driver {work_queue.driver_id} using shared work queue {queue_path}")
         
-        # Create a task queue
-        task_queue = asyncio.Queue()
+        # Create the GPU worker tasks, one per request slot on each Ollama instance
+        tasks = []
+        controllers = {}
+        healths = {}
+        # A supervisor may still be bringing its servers up
+        await wait_for_instances(config, config_path, float(config.get("instances_wait", 600)))
+        instances = parse_ollama_instances(config)
+        client_pool = create_client_pool(instances, config)
+        fetcher = create_context_fetcher(config)
+        await fetcher.start()
         
-        # Add tasks to the queue
-        for prompt in prompts:
-            # Format: [prompt_id, prompt_content, system_message, modified_time]
-            if isinstance(prompt, dict):
-                prompt_id = prompt.get('id', None)
-                prompt_content = prompt.get('content', prompt.get('prompt', ''))
-                modified_time = prompt.get('_modified_time', datetime.now())
-                task_queue.put_nowait((prompt_id, prompt_content, system_msg, modified_time))
-            else:
-                # If prompt is a string (simple format)
-                task_queue.put_nowait((None, prompt, system_msg, datetime.now()))
+        # Prepared prompts wait in a bounded dispatch queue between the
+        # prefetch stage and the GPU workers
+        pipeline_config = config.get("pipeline", {})
+        retry_config = config.get("retry", {})
+        task_queue = asyncio.Queue(maxsize=max(int(pipeline_config.get("intake_queue_size", 1000)), 1))
+        total_slots = sum(instance["max_slots"] for instance in instances)
+        hedging_config = config.get("hedging", {})
+        prompt_cache_config = config.get("prompt_cache", {})
+        ready_queue = DispatchQueue(
+            maxsize=int(pipeline_config.get("ready_queue_size", 0)) or 2 * total_slots,
+            expected_output_tokens=int(generation.get("max_tokens", 0)),
+            hedging=bool(hedging_config.get("enabled", False)),
+            hedge_budget=float(hedging_config.get("budget", 0.05)),
+            hedge_delay=float(hedging_config.get("delay", 1.0)),
+            affinity=bool(prompt_cache_config.get("enabled", False) and prompt_cache_config.get("affinity", True)),
+            swap_delay=float(config.get("routing", {}).get("swap_delay", 30)),
+            max_loaded_models=int(config.get("routing", {}).get("max_loaded_models", 1)),
+        )
+        output_config = config.get("output", {})
+        writer = ResponseWriter(
+            output_dir,
+            backend=output_config.get("backend", "files"),
+            shard_mb=float(output_config.get("shard_mb", 256)),
+            batch_size=int(output_config.get("batch_size", 64)),
+            flush_interval=float(output_config.get("flush_interval", 0.5)),
+        )
+        await writer.start()
+        postprocessor.start()
+        context_config = dict(config.get("context", {}))
+        response_cache_config = config.get("response_cache", {})
+        # Leave room for the longest response we allow
+        if generation.get("max_tokens"):
+            context_config.setdefault("reserve_tokens", int(generation["max_tokens"]))
+        run = BatchRun(
+            model, output_dir, stats, ready_queue,
+            generation=generation, retry=retry_config,
+            fetcher=fetcher, manifest=manifest, journal=journal, writer=writer,
+            # One preamble (and date) for the whole run keeps the prefix identical
+            preamble=create_context_preamble() if prompt_cache_config.get("enabled", False) else None,
+            options=config.get("options", {}),
+            context=context_config,
+            work_queue=work_queue,
+            response_cache=ResponseCache(
+                response_cache_config.get("directory", ".response_cache"),
+                float(response_cache_config.get("ttl", 0)),
+            ) if response_cache_config.get("enabled", False) else None,
+            dedup=bool(response_cache_config.get("dedup", False)),
+            postprocessor=postprocessor,
+        )
         
-        # Create a list of worker tasks, one for each Ollama instance
-        tasks = []
-        for host, gpu_index in config.get("ollama_instances", {}).items():
-            worker_task = asyncio.create_task(
-                worker(host, gpu_index, model, task_queue, output_dir, stats)
+        async def start_instance(instance):
+            """Warm up an instance and start its worker slots, at startup or when it joins later."""
+            host, gpu_index = instance["host"], instance["gpu"]
+            if host not in client_pool:
+                client_pool.add(host, client_connections(instance, config))
+            # Load the model before the first prompt is dispatched; hosts
+            # that don't serve the default model load their first one
+            if generation.get("warmup", True):
+                await warm_up_model(
+                    client_pool.get(host), host,
+                    model if instance_serves(instance, model) else instance["models"][0],
+                    generation.get("model_keep_alive") or None,
+                )
+            controller = create_controller(instance, config)
+            controllers[host] = controller
+            healths[host] = HostHealth(
+                host, client_pool.get(host),
+                failure_threshold=int(retry_config.get("failure_threshold", 3)),
+                probe_interval=float(retry_config.get("probe_interval", 15)),
+            )
+            ready_queue.register_host(host, gpu_index, instance["speed"], instance["models"], healths[host])
+            log_message(
+                f"Starting {controller.max_limit} worker slot(s) for {host} (GPU {gpu_index}), "
+                f"initial concurrency {controller.limit}{' (adaptive)' if controller.adaptive else ''}"
             )
-            tasks.append(worker_task)
+            for slot in range(controller.max_limit):
+                worker_task = asyncio.create_task(
+                    worker(host, gpu_index, slot, run, controller, client_pool.get(host), healths[host])
+                )
+                tasks.append(worker_task)
+        
+        await asyncio.gather(*(start_instance(instance) for instance in instances))
         
-        # Add sentinel values to stop workers
-        for _ in range(len(tasks)):
-            await task_queue.put(None)
+        # Start the prefetch stage that resolves links and context ahead of the GPUs
+        prefetch_count = max(int(pipeline_config.get("prefetch_workers", 4)), 1)
+        prefetchers = [
+            asyncio.create_task(prefetch_worker(task_queue, run))
+            for _ in range(prefetch_count)
+        ]
+        monitor = asyncio.create_task(
+            monitor_pipeline(task_queue, ready_queue, float(pipeline_config.get("report_interval", 30)))
+        )
+        outage_watch = asyncio.create_task(
+            watch_outage(healths, ready_queue, run, float(retry_config.get("max_outage", 600)))
+        )
+        log_message(f"Prefetching with {prefetch_count} worker(s), ready queue size {ready_queue.maxsize}")
+        # Keep track of which models each host has loaded, for routing
+        routing_config = config.get("routing", {})
+        ps_interval = float(routing_config.get("ps_interval", 10))
+        models_watch = None
+        if ps_interval > 0:
+            models_watch = asyncio.create_task(
+                watch_loaded_models(client_pool, ready_queue, healths, ps_interval)
+            )
+        # Start workers for servers the supervisor reports ready later on
+        instances_watch = None
+        if instances_file_paths(config, config_path):
+            instances_watch = asyncio.create_task(watch_instances_files(
+                config, config_path, start_instance, controllers, float(config.get("instances_poll", 5))
+            ))
+        metrics_server = None
+        metrics_config = config.get("metrics", {})
+        if metrics_config.get("enabled", False):
+            metrics_server = MetricsServer(
+                run, task_queue, controllers, healths,
+                host=metrics_config.get("host", "127.0.0.1"),
+                port=int(metrics_config.get("port", 9109)),
+            )
+            await metrics_server.start()
         
-        # Wait for all tasks to complete
-        await asyncio.gather(*tasks)
+        # Wait for all tasks to complete, then release pooled connections
+        heartbeat = None
+        try:
+            # Stream prompts from the input files into the bounded task queue
+            prompt_source = iter_prompts(prompts_dir="prompts", prompts_files=[prompts_path] if prompts_path else None)
+            if work_queue is not None:
+                ingested = asyncio.Event()
+                heartbeat = asyncio.create_task(
+                    renew_leases(work_queue, float(queue_config.get("heartbeat_interval", 10)))
+                )
+                feeder = asyncio.create_task(feed_from_work_queue(
+                    task_queue, run, ingested,
+                    int(queue_config.get("claim_batch", 0)) or 2 * total_slots,
+                    float(queue_config.get("poll_interval", 2)),
+                ))
+                total_prompts = await ingest_prompts(prompt_source, task_queue, run, system_msg, resume)
+                ingested.set()
+                await feeder
+            else:
+                total_prompts = await ingest_prompts(prompt_source, task_queue, run, system_msg, resume)
+                if not total_prompts:
+                    log_message("No prompts found in specified paths")
+            
+            # Add sentinel values to stop the prefetch workers
+            for _ in range(len(prefetchers)):
+                await task_queue.put(None)
+            await asyncio.gather(*prefetchers)
+            # Let the GPU workers exit once everything prepared has been processed
+            await ready_queue.close()
+            await ready_queue.wait_finished()
+            if instances_watch is not None:
+                instances_watch.cancel()
+            # Wake workers parked on an ejected host so they can exit too
+            for health in healths.values():
+                health.shutdown()
+            await asyncio.gather(*tasks)
+        finally:
+            monitor.cancel()
+            outage_watch.cancel()
+            if models_watch is not None:
+                models_watch.cancel()
+            if instances_watch is not None:
+                instances_watch.cancel()
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if metrics_server is not None:
+                await metrics_server.close()
+            for health in healths.values():
+                health.shutdown()
+            await client_pool.close()
+            await fetcher.close()
+            await writer.close()
+            postprocessor.close()
+            manifest.close()
+            journal.close()
+            if work_queue is not None:
+                await asyncio.to_thread(work_queue.heartbeat)
+                queue_counts = await asyncio.to_thread(work_queue.counts)
+                await asyncio.to_thread(work_queue.close)
         
         # Calculate duration and stats
         duration = (datetime.now() - start_time).total_seconds()
@@ -534,9 +3151,48 @@ async def main(config_path, prompts_path, output_dir, no_notify=False):
         
         completion_message = (
             f"Processing completed in {int(minutes)}m {int(seconds)}s. "
-            f"Processed: {stats['processed']}, Skipped: {stats['skipped']}"
+            f"Processed: {stats['processed']}, Skipped: {stats['skipped']}, "
+            f"Failed: {stats['failed']}, Retried: {stats['retried']}, "
+            f"Cache hits: {stats['cached']}, Deduplicated: {stats['deduplicated']}"
         )
         log_message(completion_message)
+        if work_queue is not None:
+            log_message(
+                "Shared work queue: " + ", ".join(f"{state}: {count}" for state, count in sorted(queue_counts.items()))
+            )
+        for host, host_stats in stats.get("hosts", {}).items():
+            slot_counts = ", ".join(f"{slot}={count}" for slot, count in sorted(host_stats["slots"].items()))
+            log_message(
+                f"Host: {host}, GPU: {host_stats['gpu']}, "
+                f"Processed: {host_stats['processed']}, Failed attempts: {host_stats['failed']}, "
+                f"Ejections: {healths[host].ejections}, "
+                f"Concurrency: {controllers[host].limit} (peak {controllers[host].peak}), "
+                f"Per slot: {slot_counts}"
+            )
+            if host_stats["processed"]:
+                prompt_rate = host_stats["prompt_tokens"] / host_stats["prompt_eval_seconds"] if host_stats["prompt_eval_seconds"] else None
+                token_rate = host_stats["eval_tokens"] / host_stats["eval_seconds"] if host_stats["eval_seconds"] else None
+                log_message(
+                    f"Host: {host}, Prompt tokens: {host_stats['prompt_tokens']} "
+                    f"({format_metric(prompt_rate, '{:.1f}/s')} prefill), "
+                    f"Generated tokens: {host_stats['completion_tokens']} "
+                    f"({format_metric(token_rate, '{:.1f}/s')}), "
+                    f"Model load: {host_stats['load_seconds']:.1f}s, "
+                    f"Avg queue wait: {host_stats['queue_wait_seconds'] / host_stats['processed']:.2f}s"
+                )
+        log_message(
+            f"Ready queue: peak depth {stats['pipeline']['ready_peak']}/{ready_queue.maxsize}, "
+            f"GPU workers waited {stats['pipeline']['ready_wait_seconds']:.1f}s in total for prepared prompts"
+        )
+        if ready_queue.hedging:
+            hedges = ready_queue.hedges
+            log_message(f"Hedging: Issued: {hedges['issued']}, Won: {hedges['won']}, Lost: {hedges['lost']}")
+        url_stats = fetcher.stats
+        log_message(
+            f"URL cache: Hits: {url_stats['hits'] + url_stats['revalidated']} "
+            f"(revalidated {url_stats['revalidated']}), Misses: {url_stats['misses']}, "
+            f"Deduplicated: {url_stats['deduplicated']}"
+        )
         
         # Show notification when done (if not disabled)
         if not no_notify:
@@ -552,57 +3208,212 @@ async def main(config_path, prompts_path, output_dir, no_notify=False):
         traceback.print_exc()
 
 def load_config(config_path):
-    """Load the configuration from a TOML file."""
+    """
+    Load the configuration from a TOML file. Instances listed in the files
+    named by `instances_file` (a path or a list of paths, relative to the
+    config file), such as those written by ollama-batch-supervisor.py, are
+    added to [ollama_instances].
+    """
     try:
-        return toml.load(config_path)
+        config = toml.load(config_path)
     except Exception as e:
         log_message(f"Error loading config: {str(e)}")
         raise
+    config["ollama_instances"] = {
+        **config.get("ollama_instances", {}), **read_instances_files(config, config_path, verbose=True)
+    }
+    return config
 
-def load_prompts(prompts_dir="prompts", prompts_files=None):
+def instances_file_paths(config, config_path):
+    """The `instances_file` paths of a config, resolved relative to the config file."""
+    instances_files = config.get("instances_file") or []
+    if isinstance(instances_files, str):
+        instances_files = [instances_files]
+    return [Path(config_path).parent / instances_file for instances_file in instances_files]
+
+def read_instances_files(config, config_path, verbose=False):
+    """Merge the [ollama_instances] tables of every instances file that exists."""
+    instances = {}
+    for path in instances_file_paths(config, config_path):
+        try:
+            found = toml.load(path).get("ollama_instances", {})
+        except FileNotFoundError:
+            if verbose:
+                log_message(f"Instances file {path} not found, skipping it")
+            continue
+        except toml.TomlDecodeError as e:
+            # The supervisor replaces the file atomically, so this is a real error
+            log_message(f"Could not parse instances file {path}: {str(e)}")
+            continue
+        instances.update(found)
+        if verbose:
+            log_message(f"Loaded {len(found)} instance(s) from {path}")
+    return instances
+
+async def wait_for_instances(config, config_path, timeout):
     """
-    Load prompts from both a directory and specific JSONL/JSON files.
-    Tracks modification times for each prompt source file.
+    With instances files and no instance ready yet (the supervisor is still
+    starting its servers), wait up to timeout seconds for the first one.
+    """
+    if config["ollama_instances"] or not instances_file_paths(config, config_path):
+        return
+    log_message(f"No Ollama instance ready yet, waiting up to {timeout:.0f}s for the instances file")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(1.0)
+        instances = await asyncio.to_thread(read_instances_files, config, config_path)
+        if instances:
+            config["ollama_instances"].update(instances)
+            log_message(f"Instances file lists {len(instances)} ready instance(s)")
+            return
+    raise ValueError(f"No Ollama instance became ready within {timeout:.0f}s")
+
+async def watch_instances_files(config, config_path, start_instance, known, interval):
+    """
+    Poll the instances files and start workers for every instance that shows
+    up while the run is going. Instances that disappear are left to the
+    circuit breaker, which ejects them once their requests fail, and come
+    back through its probes when they are listed again.
+    """
+    paths = instances_file_paths(config, config_path)
+    def mtimes():
+        return [path.stat().st_mtime if path.exists() else None for path in paths]
+
+    seen = await asyncio.to_thread(mtimes)
+    listed = await asyncio.to_thread(read_instances_files, config, config_path)
+    while True:
+        await asyncio.sleep(interval)
+        current = await asyncio.to_thread(mtimes)
+        if current == seen:
+            continue
+        seen = current
+        previous, listed = listed, await asyncio.to_thread(read_instances_files, config, config_path)
+        for host in previous.keys() - listed.keys():
+            log_message(f"Instance {host} is no longer listed as ready")
+        new = {host: value for host, value in listed.items() if host not in known}
+        for instance in parse_ollama_instances({**config, "ollama_instances": new}):
+            log_message(f"Instance {instance['host']} joined the run")
+            await start_instance(instance)
+
+def parse_ollama_instances(config):
+    """
+    Parse the [ollama_instances] table into a list of instance dicts.
+
+    Each entry is either a bare GPU index ("host:port" = 0) or an inline table
+    ("host:port" = { gpu = 0, slots = 8, max_slots = 16, speed = 2.0 }). Slots default to
+    the top-level `slots` setting, or 1 if that is not set either. max_slots
+    is the most requests the instance ever gets and sizes its connection pool
+    and the queues: with [concurrency] adaptive enabled it defaults to
+    [concurrency] max_slots (or slots when that is not set), otherwise it is
+    always slots. speed is the
+    GPU's relative speed, used by the scheduler until it has been measured.
+    models restricts the instance to the listed models (default: any).
+    """
+    default_slots = int(config.get("slots", 1))
+    concurrency = config.get("concurrency", {})
+    adaptive = bool(concurrency.get("adaptive", False))
+    default_max_slots = concurrency.get("max_slots")
+    instances = []
+    for host, value in config.get("ollama_instances", {}).items():
+        if not isinstance(value, dict):
+            value = {"gpu": value}
+        slots = int(value.get("slots", default_slots))
+        if slots < 1:
+            raise ValueError(f"Instance {host} must have at least one slot, got {slots}")
+        # Without adaptive concurrency an instance never runs more than its slots
+        max_slots = int(value.get("max_slots", default_max_slots or slots)) if adaptive else slots
+        instances.append({
+            "host": host,
+            "gpu": value.get("gpu", 0),
+            "slots": slots,
+            "max_slots": max(max_slots, slots),
+            "speed": float(value.get("speed", 1.0)),
+            "models": list(value.get("models", [])) or None,
+        })
+    return instances
+
+def create_controller(instance, config):
+    """Create the ConcurrencyController for one parsed Ollama instance."""
+    concurrency = config.get("concurrency", {})
+    adaptive = bool(concurrency.get("adaptive", False))
+    return ConcurrencyController(
+        instance["host"],
+        initial=instance["slots"],
+        min_limit=int(concurrency.get("min_slots", 1)),
+        max_limit=instance["max_slots"] if adaptive else instance["slots"],
+        adaptive=adaptive,
+        window=int(concurrency.get("window", 8)),
+        latency_factor=float(concurrency.get("latency_factor", 2.0)),
+        backoff_factor=float(concurrency.get("backoff_factor", 0.5)),
+    )
+
+def create_context_fetcher(config):
+    """Create the ContextFetcher for reference URLs from the [fetch] and [url_cache] settings."""
+    fetch_config = config.get("fetch", {})
+    cache_config = config.get("url_cache", {})
+    extract_workers = fetch_config.get("extract_workers")
+    cache = None
+    if cache_config.get("enabled", True):
+        cache = UrlContentCache(
+            cache_config.get("directory", ".url_cache"),
+            ttl=float(cache_config.get("ttl", 86400)),
+            max_bytes=int(float(cache_config.get("max_mb", 512)) * 1024 * 1024),
+        )
+    return ContextFetcher(
+        timeout=float(fetch_config.get("timeout", 30)),
+        per_domain_limit=int(fetch_config.get("per_domain_limit", 4)),
+        max_connections=int(fetch_config.get("max_connections", 32)),
+        extract_workers=int(extract_workers) if extract_workers is not None else None,
+        cache=cache,
+    )
+
+def create_postprocessor(config):
+    """Create the ResponsePostProcessor from the [postprocess] settings."""
+    postprocess_config = config.get("postprocess", {})
+    workers = postprocess_config.get("workers")
+    return ResponsePostProcessor(
+        ResponseCleaner.from_config(postprocess_config),
+        workers=int(workers) if workers is not None else None,
+    )
+
+def read_prompt_file(path):
+    """Yield the prompt records of one JSON or JSONL file, reading JSONL line by line."""
+    if path.suffix.lower() == '.jsonl':
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        log_message(f"Error parsing JSONL line in {path}")
+    elif path.suffix.lower() == '.json':
+        with open(path, "r", encoding="utf-8") as file:
+            try:
+                data = json.load(file)
+            except json.JSONDecodeError:
+                log_message(f"Error parsing JSON file: {path}")
+                return
+        if isinstance(data, list):
+            yield from data
+        else:
+            yield data
+
+def iter_prompts(prompts_dir="prompts", prompts_files=None):
+    """
+    Lazily yield (prompt, source_file, modified_time) from specific JSONL/JSON
+    files and from a directory of JSON files.
+
+    Nothing is read ahead, so memory use doesn't depend on the input size.
     """
-    prompts = []
-    
     # Process specific JSONL/JSON files if provided
-    if prompts_files:
-        for file_path in prompts_files:
-            path = Path(file_path)
-            if path.exists() and path.is_file():
-                modified_time = datetime.fromtimestamp(path.stat().st_mtime)
-                log_message(f"Loading prompts from file: {path}")
-                
-                if path.suffix.lower() == '.json':
-                    with open(path, "r", encoding="utf-8") as file:
-                        data = json.load(file)
-                        # Add source file and modification time to each prompt
-                        if isinstance(data, list):
-                            for item in data:
-                                if isinstance(item, dict):
-                                    item['_source_file'] = str(path)
-                                    item['_modified_time'] = modified_time
-                            prompts.extend(data)
-                        else:
-                            if isinstance(data, dict):
-                                data['_source_file'] = str(path)
-                                data['_modified_time'] = modified_time
-                            prompts.append(data)
-                
-                elif path.suffix.lower() == '.jsonl':
-                    with open(path, "r", encoding="utf-8") as file:
-                        for line in file:
-                            if line.strip():
-                                try:
-                                    item = json.loads(line)
-                                    if isinstance(item, dict):
-                                        item['_source_file'] = str(path)
-                                        item['_modified_time'] = modified_time
-                                    prompts.append(item)
-                                except json.JSONDecodeError:
-                                    log_message(f"Error parsing JSONL line in {path}")
-    
+    for file_path in prompts_files or []:
+        path = Path(file_path)
+        if path.exists() and path.is_file():
+            modified_time = datetime.fromtimestamp(path.stat().st_mtime)
+            log_message(f"Loading prompts from file: {path}")
+            for prompt in read_prompt_file(path):
+                yield prompt, str(path), modified_time
+
     # Process prompts directory
     if prompts_dir:
         prompts_path = Path(prompts_dir)
@@ -610,24 +3421,20 @@ def load_prompts(prompts_dir="prompts", prompts_files=None):
             log_message(f"Loading prompts from directory: {prompts_path}")
             for json_file in prompts_path.glob("*.json"):
                 modified_time = datetime.fromtimestamp(json_file.stat().st_mtime)
-                
-                with open(json_file, "r", encoding="utf-8") as file:
-                    try:
-                        data = json.load(file)
-                        # Add source file and modification time to each prompt
-                        if isinstance(data, list):
-                            for item in data:
-                                if isinstance(item, dict):
-                                    item['_source_file'] = str(json_file)
-                                    item['_modified_time'] = modified_time
-                            prompts.extend(data)
-                        else:
-                            if isinstance(data, dict):
-                                data['_source_file'] = str(json_file)
-                                data['_modified_time'] = modified_time
-                            prompts.append(data)
-                    except json.JSONDecodeError:
-                        log_message(f"Error parsing JSON file: {json_file}")
+                for prompt in read_prompt_file(json_file):
+                    yield prompt, str(json_file), modified_time
+
+def load_prompts(prompts_dir="prompts", prompts_files=None):
+    """
+    Load prompts from both a directory and specific JSONL/JSON files into a list.
+    Tracks modification times for each prompt source file.
+    """
+    prompts = []
+    for prompt, source_file, modified_time in iter_prompts(prompts_dir, prompts_files):
+        if isinstance(prompt, dict):
+            prompt['_source_file'] = source_file
+            prompt['_modified_time'] = modified_time
+        prompts.append(prompt)
     
     if not prompts:
         raise ValueError("No prompts found in specified paths")
@@ -641,11 +3448,13 @@ if __name__ == "__main__":
     parser.add_argument("--prompts", type=str, help="Path to additional JSON/JSONL file with prompts (will also load from prompts directory)")
     parser.add_argument("--output_dir", type=str, default="responses", help="Directory to save the response JSON files")
     parser.add_argument("--no-notify", action="store_true", help="Disable sound notification when processing completes")
+    parser.add_argument("--resume", action="store_true", help="Continue the last run from its journal, skipping prompts it already finished")
+    parser.add_argument("--queue", type=str, help="SQLite work queue shared with other drivers (overrides [queue] path)")
 
     args = parser.parse_args()
 
     try:
-        asyncio.run(main(args.config, args.prompts, args.output_dir, args.no_notify))
+        asyncio.run(main(args.config, args.prompts, args.output_dir, args.no_notify, args.resume, args.queue))
         log_message("All prompts processed. Exiting...")
     except KeyboardInterrupt:
         log_message("Process interrupted by user. Exiting...")
@@ -1,20 +1,25 @@
 #!/bin/bash
 
+# Starts one Ollama server per GPU through ollama-batch-supervisor.py, which
+# waits until each server answers, restarts servers that exit and writes the
+# ready instances to ollama-instances.toml. Runs in the foreground; stop it
+# with Ctrl-C to shut the servers down.
+
 # Constants
 HOST="0.0.0.0"
 BASE_PORT=11432
-OLLAMA_BINARY="/home/rmcdermo/ollama/bin/ollama"
+OLLAMA_BINARY="${OLLAMA_BINARY:-ollama}"
 LOG_DIR="ollama-server-logs"
-SLEEP_INTERVAL=1
 
 # Check if the number of GPUs is provided as an argument
-if [[ $# -ne 1 ]]; then
-    echo "Usage: $0 <num_gpus>"
+if [[ $# -lt 1 ]]; then
+    echo "Usage: $0 <num_gpus> [supervisor options, e.g. --model deepseek-r1:32b]"
     exit 1
 fi
 
 # Command-line argument
 NUM_GPUS=$1
+shift
 
 # Validate that NUM_GPUS is a positive integer
 if ! [[ "$NUM_GPUS" =~ ^[0-9]+$ ]] || [[ "$NUM_GPUS" -le 0 ]]; then
@@ -22,39 +27,6 @@ if ! [[ "$NUM_GPUS" =~ ^[0-9]+$ ]] || [[ "$NUM_GPUS" -le 0 ]]; then
     exit 1
 fi
 
-# Check if the Ollama binary exists
-if [[ ! -x "$OLLAMA_BINARY" ]]; then
-    echo "Error: Ollama binary not found or not executable at $OLLAMA_BINARY"
-    exit 1
-fi
-
-# Create log directory if it doesn't exist
-mkdir -p "$LOG_DIR"
-
-# Start server instances
-for ((i=0; i<NUM_GPUS; i++)); do
-    PORT=$((BASE_PORT + i))
-    LOG_FILE="${LOG_DIR}/${PORT}.log"
-
-    # Environment variables
-    export OLLAMA_LOAD_TIMEOUT="120m"
-    export OLLAMA_KEEP_ALIVE="120m"
-    export OLLAMA_NUM_PARALLEL="16"
-    export OLLAMA_HOST="${HOST}:${PORT}"
-    export CUDA_VISIBLE_DEVICES="$i"
-
-    # Start server with nohup and log output
-    nohup "$OLLAMA_BINARY" serve > "$LOG_FILE" 2>&1 &
-
-    if [[ $? -eq 0 ]]; then
-        echo "Started server instance $i on port ${PORT}, logging to ${LOG_FILE}"
-    else
-        echo "Error: Failed to start server instance $i on port ${PORT}"
-    fi
-
-    # Sleep interval between starting instances
-    sleep "$SLEEP_INTERVAL"
-done
-
-echo "All server instances started successfully."
-
+exec python "$(dirname "$0")/ollama-batch-supervisor.py" "$NUM_GPUS" \
+    --binary "$OLLAMA_BINARY" --host "$HOST" --base-port "$BASE_PORT" --log-dir "$LOG_DIR" \
+    --num-parallel 16 --keep-alive 120m --load-timeout 120m "$@"
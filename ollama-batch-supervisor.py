@@ -0,0 +1,268 @@
+import os
+import time
+import shlex
+import signal
+import socket
+import asyncio
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+import toml
+
+def log_message(message):
+    """Print a timestamped message, in the same format as the batch processor."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"{timestamp}, {message}", flush=True)
+
+class ServerProcess:
+    """
+    One supervised `ollama serve` process on one GPU.
+
+    The process is started with the environment ollama-batch-servers.sh used
+    to set (OLLAMA_HOST, CUDA_VISIBLE_DEVICES, OLLAMA_NUM_PARALLEL, ...). It
+    counts as ready once its API answers and every preload model is loaded,
+    and stops being ready when it exits or fails health checks.
+    """
+
+    def __init__(self, gpu, port, args):
+        self.gpu = gpu
+        self.port = port
+        self.args = args
+        self.process = None
+        self.ready = False
+        self.restarts = 0
+        self.started_at = None
+        self.log_path = Path(args.log_dir) / f"{port}.log"
+
+    @property
+    def url(self):
+        """Where the supervisor reaches the server: the --host it binds, or loopback for a wildcard address."""
+        host = {"0.0.0.0": "127.0.0.1", "::": "::1", "": "127.0.0.1"}.get(self.args.host, self.args.host)
+        if ":" in host:
+            host = f"[{host}]"
+        return f"http://{host}:{self.port}"
+
+    def environment(self):
+        env = dict(os.environ)
+        env.update({
+            "OLLAMA_HOST": f"{self.args.host}:{self.port}",
+            "CUDA_VISIBLE_DEVICES": str(self.gpu),
+            "OLLAMA_NUM_PARALLEL": str(self.args.num_parallel),
+            "OLLAMA_KEEP_ALIVE": self.args.keep_alive,
+            "OLLAMA_LOAD_TIMEOUT": self.args.load_timeout,
+        })
+        if self.args.max_loaded_models:
+            env["OLLAMA_MAX_LOADED_MODELS"] = str(self.args.max_loaded_models)
+        return env
+
+    async def start(self):
+        command = shlex.split(self.args.binary) + ["serve"]
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.log_path, "ab") as log:
+            self.process = await asyncio.create_subprocess_exec(
+                *command, env=self.environment(), stdout=log, stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True,
+            )
+        self.started_at = time.monotonic()
+        log_message(f"Started server for GPU {self.gpu} on port {self.port} (pid {self.process.pid}), logging to {self.log_path}")
+
+    async def stop(self, grace=10.0):
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), grace)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    async def api_ok(self, session):
+        try:
+            async with session.get(f"{self.url}/api/version") as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def wait_ready(self, session):
+        """
+        Wait for the API to answer and the preload models to load. Returns
+        False if the process exits or the ready timeout passes first.
+        """
+        deadline = time.monotonic() + self.args.ready_timeout
+        while not await self.api_ok(session):
+            if self.process.returncode is not None or time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.5)
+        for model in self.args.model:
+            started = time.monotonic()
+            payload = {"model": model, "prompt": "", "keep_alive": self.args.keep_alive}
+            try:
+                timeout = aiohttp.ClientTimeout(total=max(deadline - time.monotonic(), 1.0))
+                async with session.post(f"{self.url}/api/generate", json=payload, timeout=timeout) as response:
+                    if response.status != 200:
+                        log_message(f"Port {self.port}: loading {model} failed: HTTP {response.status} {await response.text()}")
+                        return False
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log_message(f"Port {self.port}: loading {model} failed: {type(e).__name__}: {str(e)}")
+                return False
+            log_message(f"Port {self.port}: loaded {model} in {time.monotonic() - started:.1f}s")
+        return True
+
+class Supervisor:
+    """
+    Runs one ServerProcess per GPU: starts them, gates them on readiness,
+    restarts them when they exit (with exponential backoff), and keeps the
+    instances file listing exactly the servers that are ready.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.servers = [ServerProcess(gpu, args.base_port + i, args) for i, gpu in enumerate(args.gpu_ids)]
+        self.stopping = asyncio.Event()
+        self.advertise_host = args.advertise_host or (
+            socket.gethostname() if args.host in ("0.0.0.0", "::") else args.host
+        )
+
+    def write_instances(self):
+        """Atomically rewrite the instances file with the servers that are ready."""
+        if not self.args.instances_file:
+            return
+        instances = {
+            f"{self.advertise_host}:{server.port}": {"gpu": server.gpu, "slots": self.args.slots or self.args.num_parallel}
+            for server in self.servers if server.ready
+        }
+        path = Path(self.args.instances_file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("# Written by ollama-batch-supervisor.py: the Ollama instances that are up and ready.\n")
+            toml.dump({"ollama_instances": instances}, f)
+        os.replace(temp_path, path)
+
+    def set_ready(self, server, ready):
+        if server.ready != ready:
+            server.ready = ready
+            self.write_instances()
+
+    async def run_server(self, server, session):
+        """Keep one server running until the supervisor stops."""
+        backoff = self.args.restart_backoff
+        while not self.stopping.is_set():
+            await server.start()
+            if await server.wait_ready(session):
+                self.set_ready(server, True)
+                log_message(f"Server for GPU {server.gpu} on port {server.port} is ready")
+                await self.monitor(server, session)
+            else:
+                log_message(f"Server for GPU {server.gpu} on port {server.port} did not become ready")
+                await server.stop()
+            self.set_ready(server, False)
+            if self.stopping.is_set():
+                break
+
+            code = server.process.returncode
+            log_message(f"Server for GPU {server.gpu} on port {server.port} stopped (exit code {code})")
+            if self.args.max_restarts and server.restarts >= self.args.max_restarts:
+                log_message(f"Giving up on port {server.port} after {server.restarts} restart(s)")
+                return
+            # A server that stayed up for a while starts over with the shortest backoff
+            if time.monotonic() - server.started_at > 60:
+                backoff = self.args.restart_backoff
+            server.restarts += 1
+            log_message(f"Restarting port {server.port} in {backoff:.0f}s (restart {server.restarts})")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, 300.0)
+
+    async def monitor(self, server, session):
+        """Return when the server exits or is stopped; hung servers are restarted."""
+        failures = 0
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(server.process.wait(), self.args.health_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if await server.api_ok(session):
+                failures = 0
+                self.set_ready(server, True)
+                continue
+            failures += 1
+            self.set_ready(server, False)
+            if failures >= self.args.health_failures:
+                log_message(f"Port {server.port} failed {failures} health checks, restarting it")
+                await server.stop()
+                return
+        await server.stop()
+
+    async def run(self):
+        self.write_instances()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stopping.set)
+
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=None)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            runners = [asyncio.create_task(self.run_server(server, session)) for server in self.servers]
+            watch = asyncio.create_task(self.report_ready())
+            await self.stopping.wait()
+            log_message("Stopping servers")
+            watch.cancel()
+            await asyncio.gather(*(server.stop() for server in self.servers))
+            await asyncio.gather(*runners, return_exceptions=True)
+        for server in self.servers:
+            server.ready = False
+        self.write_instances()
+        log_message("All servers stopped")
+
+    async def report_ready(self):
+        """Log once every server is ready, with the time it took."""
+        started = time.monotonic()
+        while not all(server.ready for server in self.servers):
+            await asyncio.sleep(0.5)
+        log_message(f"All {len(self.servers)} server(s) ready after {time.monotonic() - started:.1f}s")
+        if self.args.instances_file:
+            log_message(f"Instances written to {self.args.instances_file}")
+
+def parse_gpu_ids(args):
+    if args.gpu_ids:
+        return [int(gpu) for gpu in args.gpu_ids.split(",") if gpu.strip()]
+    return list(range(args.gpus))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start, monitor and restart one Ollama server per GPU.")
+    parser.add_argument("gpus", type=int, nargs="?", default=1, help="Number of GPUs to start servers on (0..N-1).")
+    parser.add_argument("--gpu-ids", dest="gpu_ids", help="Comma-separated GPU indices, instead of 0..N-1.")
+    parser.add_argument("--binary", default=os.environ.get("OLLAMA_BINARY", "ollama"),
+                        help="Ollama command (default: $OLLAMA_BINARY or ollama on PATH); 'serve' is appended.")
+    parser.add_argument("--host", default="0.0.0.0", help="Address the servers listen on.")
+    parser.add_argument("--base-port", type=int, default=11432, help="Port of the first server; the next GPUs use the next ports.")
+    parser.add_argument("--advertise-host", help="Host name written to the instances file (default: this machine's name).")
+    parser.add_argument("--model", action="append", default=[], help="Model to load before a server counts as ready (repeatable).")
+    parser.add_argument("--num-parallel", type=int, default=16, help="OLLAMA_NUM_PARALLEL for each server.")
+    parser.add_argument("--max-loaded-models", type=int, default=0, help="OLLAMA_MAX_LOADED_MODELS (default: Ollama's).")
+    parser.add_argument("--keep-alive", default="120m", help="OLLAMA_KEEP_ALIVE, also used for the preload.")
+    parser.add_argument("--load-timeout", default="120m", help="OLLAMA_LOAD_TIMEOUT.")
+    parser.add_argument("--slots", type=int, default=0, help="Slots per instance in the instances file (default: --num-parallel).")
+    parser.add_argument("--instances-file", default="ollama-instances.toml",
+                        help="File listing the ready instances as an [ollama_instances] table ('' = don't write).")
+    parser.add_argument("--log-dir", default="ollama-server-logs", help="Directory for the server logs.")
+    parser.add_argument("--ready-timeout", type=float, default=600.0, help="Seconds for a server to come up and load its models.")
+    parser.add_argument("--health-interval", type=float, default=15.0, help="Seconds between health checks.")
+    parser.add_argument("--health-failures", type=int, default=3, help="Failed health checks before a hung server is restarted.")
+    parser.add_argument("--restart-backoff", type=float, default=2.0, help="First restart delay in seconds; doubles up to 300.")
+    parser.add_argument("--max-restarts", type=int, default=0, help="Restarts per server before giving up (0 = no limit).")
+
+    args = parser.parse_args()
+    args.gpu_ids = parse_gpu_ids(args)
+    if not args.gpu_ids:
+        parser.error("at least one GPU is needed")
+    if not shlex.split(args.binary):
+        parser.error("--binary is empty")
+
+    asyncio.run(Supervisor(args).run())
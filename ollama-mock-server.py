@@ -0,0 +1,333 @@
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+# Roughly what the batch client assumes for budgeting (see estimate_tokens)
+CHARS_PER_TOKEN = 4
+# Tokens generated between speed re-checks of a streamed response
+TOKENS_PER_STEP = 8
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+
+class MockHost:
+    """
+    Simulated Ollama instance on one GPU.
+
+    Up to `parallel` requests run at once (OLLAMA_NUM_PARALLEL); more wait in
+    line. Requests running together share the GPU: the aggregate generation
+    rate grows as active ** batch_scaling, so each of them gets slower the
+    more are running. Loading a model that isn't resident takes load_seconds
+    and evicts the least recently used model beyond max_loaded_models.
+    """
+
+    def __init__(self, name, tokens_per_second=40.0, prefill_tokens_per_second=2000.0, parallel=4,
+                 batch_scaling=0.7, output_tokens=300, jitter=0.1, failure_rate=0.0, stall_rate=0.0,
+                 stall_seconds=60.0, load_seconds=0.0, max_loaded_models=1, rng=None):
+        self.name = name
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.parallel = parallel
+        self.batch_scaling = batch_scaling
+        self.output_tokens = output_tokens
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.load_seconds = load_seconds
+        self.max_loaded_models = max_loaded_models
+        self.rng = rng or random.Random()
+        self._slots = asyncio.Semaphore(parallel)
+        self._load_lock = asyncio.Lock()
+        self.loaded = []
+        self.reset()
+
+    def reset(self):
+        """Clear the counters (loaded models stay loaded)."""
+        self.active = 0
+        self.requests = 0
+        self.failures = 0
+        self.loads = 0
+        self.peak = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.busy_seconds = 0.0
+        self.first_request = None
+        self.last_finish = None
+        self._busy_since = None
+
+    def stats(self):
+        busy = self.busy_seconds
+        if self._busy_since is not None:
+            busy += time.monotonic() - self._busy_since
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "loads": self.loads,
+            "peak_in_flight": self.peak,
+            "prompt_tokens": self.prompt_tokens,
+            "eval_tokens": self.eval_tokens,
+            "busy_seconds": round(busy, 4),
+            "first_request": self.first_request,
+            "last_finish": self.last_finish,
+            "loaded": list(self.loaded),
+        }
+
+    def _start(self):
+        now = time.monotonic()
+        if self.active == 0:
+            self._busy_since = now
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def _stop(self):
+        now = time.monotonic()
+        self.active -= 1
+        if self.active == 0 and self._busy_since is not None:
+            self.busy_seconds += now - self._busy_since
+            self._busy_since = None
+        self.last_finish = time.time()
+
+    def _rate(self, speed):
+        """Current generation tokens/s of one of the running requests."""
+        return speed * self.tokens_per_second * max(self.active, 1) ** (self.batch_scaling - 1)
+
+    async def load(self, model):
+        """Make the model resident, returning the seconds spent loading it."""
+        async with self._load_lock:
+            if model in self.loaded:
+                self.loaded.remove(model)
+                self.loaded.append(model)
+                return 0.0
+            self.loads += 1
+            await asyncio.sleep(self.load_seconds)
+            self.loaded = (self.loaded + [model])[-self.max_loaded_models:]
+            return self.load_seconds
+
+    async def generate(self, model, prompt_tokens, max_tokens=None):
+        """
+        Run one request, yielding (tokens, done) as tokens are produced and
+        finally the timing report. Raises web.HTTPInternalServerError for
+        injected failures.
+        """
+        self.requests += 1
+        if self.first_request is None:
+            self.first_request = time.time()
+        async with self._slots:
+            self._start()
+            try:
+                if self.rng.random() < self.failure_rate:
+                    self.failures += 1
+                    raise web.HTTPInternalServerError(
+                        text=json.dumps({"error": "mock failure: CUDA error: out of memory"}),
+                        content_type="application/json",
+                    )
+                started = time.monotonic()
+                load_seconds = await self.load(model)
+
+                speed = 1.0 + self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 1.0
+                prefill_seconds = prompt_tokens / (self.prefill_tokens_per_second * speed)
+                await asyncio.sleep(prefill_seconds)
+                if self.rng.random() < self.stall_rate:
+                    await asyncio.sleep(self.stall_seconds)
+
+                target = max(int(self.rng.gauss(self.output_tokens, self.output_tokens * 0.25)), 1)
+                if max_tokens:
+                    target = min(target, max_tokens)
+                eval_started = time.monotonic()
+                produced = 0
+                while produced < target:
+                    step = min(TOKENS_PER_STEP, target - produced)
+                    await asyncio.sleep(step / self._rate(speed))
+                    produced += step
+                    yield step, None
+                eval_seconds = time.monotonic() - eval_started
+
+                self.prompt_tokens += prompt_tokens
+                self.eval_tokens += produced
+                yield 0, {
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": int(prefill_seconds * 1e9),
+                    "eval_count": produced,
+                    "eval_duration": int(eval_seconds * 1e9),
+                    "load_duration": int(load_seconds * 1e9),
+                    "total_duration": int((time.monotonic() - started) * 1e9),
+                }
+            finally:
+                self._stop()
+
+def article_words(count):
+    """Filler response in the shape the batch client post-processes."""
+    words = [FILLER[i % len(FILLER)] for i in range(max(count - 12, 1))]
+    head = ["<think>mock", "reasoning</think>\n---BEGIN", "ARTICLE---\n#", "Mock", "article\n"]
+    return head + words + ["\n---END", "ARTICLE---\n"]
+
+def chunk_text(words, start, count):
+    return "".join(word + " " for word in words[start:start + count])
+
+def make_app(host):
+    """aiohttp application serving the Ollama API subset the batch client uses."""
+
+    def created_at():
+        return datetime.now(timezone.utc).isoformat()
+
+    async def chat(request):
+        body = await request.json()
+        model = body.get("model", "")
+        characters = sum(len(message.get("content") or "") for message in body.get("messages", []))
+        prompt_tokens = math.ceil(characters / CHARS_PER_TOKEN)
+        max_tokens = (body.get("options") or {}).get("num_predict")
+        stream = body.get("stream", True)
+
+        words = article_words(host.output_tokens * 2)
+        position = 0
+        response = None
+        text = []
+        steps = host.generate(model, prompt_tokens, max_tokens)
+        try:
+            async for tokens, report in steps:
+                if report is not None:
+                    break
+                chunk = chunk_text(words, position, tokens)
+                position += tokens
+                if not stream:
+                    text.append(chunk)
+                    continue
+                if response is None:
+                    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+                    await response.prepare(request)
+                if request.transport is None or request.transport.is_closing():
+                    # Client stopped reading (stop marker reached or cancelled)
+                    return response
+                message = {"model": model, "created_at": created_at(),
+                           "message": {"role": "assistant", "content": chunk}, "done": False}
+                await response.write((json.dumps(message) + "\n").encode())
+        finally:
+            # Frees the slot right away when the client goes away mid-stream
+            await steps.aclose()
+
+        # Always close the article so stop markers and cleaning work
+        tail = "\n---END ARTICLE---\n" if position < len(words) else ""
+        final = {"model": model, "created_at": created_at(), "done": True, "done_reason": "stop", **report}
+        if not stream:
+            final["message"] = {"role": "assistant", "content": "".join(text) + tail}
+            return web.json_response(final)
+        final["message"] = {"role": "assistant", "content": tail}
+        if response is None:
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+        await response.write((json.dumps(final) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def generate(request):
+        # The batch client only uses this with an empty prompt, to load a model
+        body = await request.json()
+        load_seconds = await host.load(body.get("model", ""))
+        return web.json_response({
+            "model": body.get("model", ""), "created_at": created_at(), "response": "",
+            "done": True, "load_duration": int(load_seconds * 1e9),
+        })
+
+    async def tags(request):
+        return web.json_response({"models": [{"name": m, "model": m} for m in host.loaded]})
+
+    async def ps(request):
+        return web.json_response({"models": [{"name": m, "model": m} for m in host.loaded]})
+
+    async def version(request):
+        return web.json_response({"version": "0.0.0-mock"})
+
+    async def stats(request):
+        return web.json_response(host.stats())
+
+    async def reset(request):
+        host.reset()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_post("/api/chat", chat)
+    app.router.add_post("/api/generate", generate)
+    app.router.add_get("/api/tags", tags)
+    app.router.add_get("/api/ps", ps)
+    app.router.add_get("/api/version", version)
+    app.router.add_get("/mock/stats", stats)
+    app.router.add_post("/mock/reset", reset)
+    return app
+
+def parse_speeds(value, hosts):
+    """Per-host speed multipliers from "1,1,0.5", repeated to cover every host."""
+    speeds = [float(speed) for speed in value.split(",") if speed.strip()] if value else [1.0]
+    return [speeds[i % len(speeds)] for i in range(hosts)]
+
+async def serve(args):
+    speeds = parse_speeds(args.speeds, args.hosts)
+    rng = random.Random(args.seed)
+    runners = []
+    for i in range(args.hosts):
+        port = args.port + i
+        host = MockHost(
+            f"{args.host}:{port}",
+            tokens_per_second=args.tokens_per_second * speeds[i],
+            prefill_tokens_per_second=args.prefill_tokens_per_second * speeds[i],
+            parallel=args.parallel,
+            batch_scaling=args.batch_scaling,
+            output_tokens=args.output_tokens,
+            jitter=args.jitter,
+            failure_rate=args.failure_rate,
+            stall_rate=args.stall_rate,
+            stall_seconds=args.stall_seconds,
+            load_seconds=args.load_seconds,
+            max_loaded_models=args.max_loaded_models,
+            rng=random.Random(rng.random()),
+        )
+        runner = web.AppRunner(make_app(host), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, args.host, port).start()
+        runners.append(runner)
+        print(f"Mock Ollama {host.name}: {host.tokens_per_second:.0f} tok/s, {args.parallel} parallel", flush=True)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for Ollama's /api/chat, one simulated GPU per port.")
+    parser.add_argument("command", nargs="?", choices=["serve"],
+                        help="Ignored; accepted so the mock can stand in for the ollama binary.")
+    parser.add_argument("--host", default=None, help="Address to listen on (default: from OLLAMA_HOST, else 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=None,
+                        help="Port of the first host (default: from OLLAMA_HOST, else 11432); further hosts use the next ports.")
+    parser.add_argument("--hosts", type=int, default=1, help="Number of simulated hosts.")
+    parser.add_argument("--speeds", default="", help="Comma-separated speed multiplier per host, e.g. 1,1,0.5 (repeats).")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="Generation rate of a single request.")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=2000.0, help="Prompt processing rate.")
+    parser.add_argument("--parallel", type=int, default=4, help="Requests run at once per host (OLLAMA_NUM_PARALLEL).")
+    parser.add_argument("--batch-scaling", type=float, default=0.7,
+                        help="Aggregate rate grows as active**scaling; 1 = perfect batching, 0 = none.")
+    parser.add_argument("--output-tokens", type=int, default=300, help="Mean response length in tokens.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Per-request speed variation, as a fraction.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests answered with a 500 error.")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of requests that stall before generating.")
+    parser.add_argument("--stall-seconds", type=float, default=60.0, help="How long a stalled request hangs.")
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="Time to load a model that isn't resident.")
+    parser.add_argument("--max-loaded-models", type=int, default=1, help="Models resident at once per host.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, for reproducible runs.")
+
+    args = parser.parse_args()
+    # Like `ollama serve`, listen where OLLAMA_HOST says unless told otherwise
+    env_host, _, env_port = os.environ.get("OLLAMA_HOST", "").rpartition(":")
+    args.host = args.host or env_host or "127.0.0.1"
+    args.port = args.port or (int(env_port) if env_port.isdigit() else 11432)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,44 +1,64 @@
-import os
+import sys
 import json
 import argparse
 
-def extract_responses(input_dir, output_file):
+from response_index import add_filter_arguments, filter_index, ids_from_args, iter_records, load_index
+
+def parse_response(record):
+    """Extracts and parses the embedded JSON from a record's 'response' field."""
+    if 'response' not in record:
+        return None
+    return json.loads(record['response'])
+
+def extract_responses(input_dir, output_file, output_format="json", ids=None, since=None, until=None, model=None, workers=None):
     """
-    Reads all JSON files in the specified directory, extracts the embedded JSON from the 'response' field,
-    and saves them into a combined JSON file.
+    Reads the responses in the specified output directory, extracts the embedded JSON from the
+    'response' field, and streams them into a combined file one element at a time.
 
-    :param input_dir: Path to the directory containing JSON files.
-    :param output_file: Path to the output JSON file.
+    :param input_dir: Path to the batch output directory.
+    :param output_file: Path to the output file, or "-" for stdout.
+    :param output_format: "json" for a single array, "jsonl" for one response per line.
+    :param ids, since, until, model: Optional filters, see response_index.filter_index.
+    :param workers: Number of parser processes.
     """
-    combined_responses = []
-
-    # Iterate over all files in the directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith(".json"):
-            file_path = os.path.join(input_dir, filename)
-            
-            try:
-                # Open and load the JSON file
-                with open(file_path, 'r') as json_file:
-                    data = json.load(json_file)
-                    
-                    # Extract and parse the 'response' field
-                    if 'response' in data:
-                        response_json = json.loads(data['response'])
-                        combined_responses.append(response_json)
-            except (json.JSONDecodeError, ValueError, KeyError) as e:
-                print(f"Error processing file {filename}: {e}")
-    
-    # Write the combined responses to the output file
-    with open(output_file, 'w') as output_json:
-        json.dump(combined_responses, output_json, indent=2)
+    entries = filter_index(load_index(input_dir), ids, since, until, model)
+    output = sys.stdout if output_file == "-" else open(output_file, 'w', encoding='utf-8')
+    count = 0
+
+    try:
+        if output_format == "json":
+            output.write("[")
+        for entry, response_json, error in iter_records(input_dir, entries, parse_response, model, workers):
+            if error is not None:
+                print(f"Error processing {entry['id']}: {error}", file=sys.stderr)
+                continue
+            if response_json is None:
+                continue
+            line = json.dumps(response_json, ensure_ascii=False)
+            if output_format == "json":
+                output.write((",\n  " if count else "\n  ") + line)
+            else:
+                output.write(line + "\n")
+            count += 1
+        if output_format == "json":
+            output.write("\n]\n" if count else "]\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"Merged {count} response(s)", file=sys.stderr)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract embedded JSON from response fields in JSON files.")
     parser.add_argument("--input-dir", required=True, help="Path to the directory containing JSON files.")
-    parser.add_argument("--output-file", required=True, help="Path to the output JSON file.")
-    
+    parser.add_argument("--output-file", required=True, help="Path to the output JSON file, or - for stdout.")
+    parser.add_argument("--format", choices=["json", "jsonl"], default="json", help="Write a JSON array (default) or JSON lines.")
+    add_filter_arguments(parser)
+
     args = parser.parse_args()
-    
-    extract_responses(args.input_dir, args.output_file)
 
+    extract_responses(
+        args.input_dir, args.output_file, args.format,
+        ids=ids_from_args(args), since=args.since, until=args.until,
+        model=args.model, workers=args.workers,
+    )
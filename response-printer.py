@@ -1,46 +1,52 @@
 import os
 import sys
-import json
+import argparse
 
-def extract_prompts_and_responses(directory):
+from response_index import add_filter_arguments, filter_index, ids_from_args, iter_records, load_index
+
+def prompt_and_response(record):
+    """Picks the "prompt" and "response" fields out of a record."""
+    return (
+        record.get("prompt", "No prompt found"),
+        record.get("response", "No response found"),
+    )
+
+def extract_prompts_and_responses(directory, ids=None, since=None, until=None, model=None, workers=None):
     # Check if the provided directory exists
     if not os.path.isdir(directory):
         print(f"Error: Directory '{directory}' does not exist.")
         sys.exit(1)
 
-    # Iterate over each file in the directory
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-
-        # Only process JSON files
-        if filename.lower().endswith(".json"):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-
-                    # Extract "prompt" and "response"
-                    prompt = data.get("prompt", "No prompt found")
-                    response = data.get("response", "No response found")
-
-                    # Print with a separator
-                    print("#" * 40)
-                    print(f"# File: {filename}")
-                    print("#" * 40)
-                    print(f"Prompt:\n{prompt}\n")
-                    print(f"Response:\n{response}\n")
-
-            except json.JSONDecodeError:
-                print(f"Error: Failed to decode JSON in file '{filename}'.")
-            except Exception as e:
-                print(f"Error processing file '{filename}': {e}")
+    entries = filter_index(load_index(directory), ids, since, until, model)
+
+    # Records are parsed in a process pool and printed as they arrive
+    for entry, fields, error in iter_records(directory, entries, prompt_and_response, model, workers):
+        if error is not None:
+            print(f"Error processing '{entry['location']}': {error}")
+            continue
+        prompt, response = fields
+
+        # Print with a separator. Records in jsonl shards have no file of
+        # their own, so they are named by prompt id with the shard location
+        shard, _, offset = entry["location"].rpartition(":")
+        print("#" * 40)
+        if shard and offset.isdigit():
+            print(f"# File: {entry['id']}")
+            print(f"# Shard: {entry['location']}")
+        else:
+            print(f"# File: {os.path.basename(entry['location'])}")
+        print("#" * 40)
+        print(f"Prompt:\n{prompt}\n")
+        print(f"Response:\n{response}\n")
 
 if __name__ == "__main__":
-    # Ensure the directory path is provided as a command-line argument
-    if len(sys.argv) != 2:
-        print("Usage: python extract_json.py <directory_path>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Print the prompt and response of every response in a batch output directory.")
+    parser.add_argument("directory", help="Directory of response JSON files.")
+    add_filter_arguments(parser)
 
-    # Get the directory path from the command-line argument
-    directory_path = sys.argv[1]
-    extract_prompts_and_responses(directory_path)
+    args = parser.parse_args()
 
+    extract_prompts_and_responses(
+        args.directory, ids=ids_from_args(args), since=args.since,
+        until=args.until, model=args.model, workers=args.workers,
+    )
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import toml
+
+from response_cleaning import ResponseCleaner, raw_response
+from response_index import MANIFEST_FILENAME, add_filter_arguments, filter_index, ids_from_args, load_index
+
+def write_atomic(path, data):
+    """Write bytes or text to path via a temporary file and an atomic rename."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def reclean_record(record, cleaner):
+    """
+    Runs the cleaner over a stored record's raw response. Returns the new
+    fields for the record and the new markdown; raw_response is included so
+    records written before it was stored keep the text they were rebuilt from.
+    """
+    raw = raw_response(record)
+    response, think, markdown = cleaner.clean(raw)
+    return {"response": response, "think": think, "raw_response": raw}, markdown
+
+def record_differs(record, fields):
+    return any(record.get(key) != value for key, value in fields.items())
+
+def reclean_files(input_dir, entries, cleaner, model, dry_run):
+    """
+    Re-cleans a chunk of <id>.json/<id>.md pairs, rewriting only the files
+    whose content changes. Returns (changed, errors).
+    """
+    changed, errors = 0, []
+    for entry in entries:
+        json_path = os.path.join(input_dir, entry["location"])
+        md_path = json_path[:-len(".json")] + ".md"
+        try:
+            with open(json_path, 'r', encoding='utf-8') as json_file:
+                record = json.load(json_file)
+            if model and record.get("model", model) != model:
+                continue
+            fields, markdown = reclean_record(record, cleaner)
+            try:
+                with open(md_path, 'r', encoding='utf-8') as md_file:
+                    old_markdown = md_file.read()
+            except FileNotFoundError:
+                old_markdown = None
+            record_changed = record_differs(record, fields)
+            if not record_changed and markdown == old_markdown:
+                continue
+            changed += 1
+            if dry_run:
+                continue
+            if markdown != old_markdown:
+                write_atomic(md_path, markdown)
+            if record_changed:
+                record.update(fields)
+                write_atomic(json_path, json.dumps(record, indent=2, ensure_ascii=False))
+        except FileNotFoundError:
+            # Listed in the manifest but removed since
+            continue
+        except Exception as e:
+            errors.append((entry["id"], str(e)))
+    return changed, errors
+
+def reclean_shard(input_dir, shard, offsets, cleaner, model, dry_run):
+    """
+    Rewrites one shard with the records at the given byte offsets re-cleaned.
+    Returns (changed, errors, moved), where moved maps the old offset of every
+    record that shifted to its new one, for updating the manifest.
+    """
+    changed, errors, moved = 0, [], {}
+    lines = []
+    old_offset = new_offset = 0
+    with open(os.path.join(input_dir, shard), 'rb') as shard_file:
+        for line in shard_file:
+            length = len(line)
+            if old_offset in offsets:
+                try:
+                    record = json.loads(line)
+                    if not model or record.get("model", model) == model:
+                        fields, markdown = reclean_record(record, cleaner)
+                        fields["markdown"] = markdown
+                        if record_differs(record, fields):
+                            record.update(fields)
+                            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                            changed += 1
+                except Exception as e:
+                    errors.append((f"{shard}:{old_offset}", str(e)))
+            if new_offset != old_offset:
+                moved[old_offset] = new_offset
+            lines.append(line)
+            old_offset += length
+            new_offset += len(line)
+    if changed and not dry_run:
+        write_atomic(os.path.join(input_dir, shard), b"".join(lines))
+    return changed, errors, moved
+
+def update_manifest(input_dir, moved):
+    """Points manifest locations at the records' new offsets in rewritten shards."""
+    manifest_path = os.path.join(input_dir, MANIFEST_FILENAME)
+    if not moved or not os.path.exists(manifest_path):
+        return
+    lines = []
+    with open(manifest_path, 'r', encoding='utf-8') as manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            shard, _, offset = (entry.get("location") or "").rpartition(":")
+            if offset.isdigit() and int(offset) in moved.get(shard, {}):
+                entry["location"] = f"{shard}:{moved[shard][int(offset)]}"
+            lines.append(json.dumps(entry, ensure_ascii=False) + "\n")
+    write_atomic(manifest_path, "".join(lines))
+
+def reclean_directory(input_dir, cleaner, ids=None, since=None, until=None, model=None, workers=None,
+                      dry_run=False, chunk_size=256):
+    """
+    Re-cleans the selected responses of a batch output directory in a
+    process pool: per-prompt files a chunk per task, shards a file per task.
+    """
+    if not os.path.isdir(input_dir):
+        print(f"Error: Directory '{input_dir}' does not exist.")
+        sys.exit(1)
+
+    files, shards = [], defaultdict(set)
+    for entry in filter_index(load_index(input_dir), ids, since, until, model):
+        shard, _, offset = entry["location"].rpartition(":")
+        if shard and offset.isdigit():
+            shards[shard].add(int(offset))
+        else:
+            files.append(entry)
+    total = len(files) + sum(len(offsets) for offsets in shards.values())
+
+    workers = workers or os.cpu_count() or 1
+    changed, errors, moved = 0, [], {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        file_jobs = [
+            pool.submit(reclean_files, input_dir, files[i:i + chunk_size], cleaner, model, dry_run)
+            for i in range(0, len(files), chunk_size)
+        ]
+        shard_jobs = {
+            shard: pool.submit(reclean_shard, input_dir, shard, offsets, cleaner, model, dry_run)
+            for shard, offsets in shards.items()
+        }
+        for job in file_jobs:
+            job_changed, job_errors = job.result()
+            changed += job_changed
+            errors += job_errors
+        for shard, job in shard_jobs.items():
+            job_changed, job_errors, job_moved = job.result()
+            changed += job_changed
+            errors += job_errors
+            if job_changed and job_moved:
+                moved[shard] = job_moved
+
+    if not dry_run:
+        update_manifest(input_dir, moved)
+    for prompt_id, error in errors:
+        print(f"Error re-cleaning '{prompt_id}': {error}")
+    action = "would change" if dry_run else "changed"
+    print(f"Re-cleaned {total} response(s): {changed} {action}, {len(errors)} error(s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-run the [postprocess] cleaning pipeline over an existing batch output directory."
+    )
+    parser.add_argument("directory", help="Batch output directory.")
+    parser.add_argument("--config", default="config.toml", help="Config file whose [postprocess] settings to apply.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the responses that would change.")
+    add_filter_arguments(parser)
+
+    args = parser.parse_args()
+
+    postprocess_config = toml.load(args.config).get("postprocess", {}) if os.path.exists(args.config) else {}
+    try:
+        cleaner = ResponseCleaner.from_config(postprocess_config)
+    except ValueError as e:
+        parser.error(str(e))
+
+    reclean_directory(
+        args.directory, cleaner, ids=ids_from_args(args), since=args.since, until=args.until,
+        model=args.model, workers=args.workers, dry_run=args.dry_run,
+    )
@@ -0,0 +1,64 @@
+import os
+import json
+import argparse
+
+def iter_shard_records(input_dir):
+    """
+    Yields records from the responses-*.jsonl shards written with the "jsonl"
+    output backend, oldest shard first. A truncated last line (from an
+    interrupted run) is skipped.
+
+    :param input_dir: Batch output directory, or its shards/ subdirectory.
+    """
+    shard_dir = os.path.join(input_dir, "shards")
+    if not os.path.isdir(shard_dir):
+        shard_dir = input_dir
+
+    for filename in sorted(os.listdir(shard_dir)):
+        if not (filename.startswith("responses-") and filename.endswith(".jsonl")):
+            continue
+        file_path = os.path.join(shard_dir, filename)
+        with open(file_path, 'r', encoding='utf-8') as shard:
+            for line_number, line in enumerate(shard, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Skipping bad record {filename}:{line_number}: {e}")
+
+def export_shards(input_dir, output_dir):
+    """
+    Writes one <id>.json and <id>.md file per record, the same layout the
+    "files" output backend produces. When a prompt was generated more than
+    once, the latest record wins.
+
+    :param input_dir: Batch output directory containing shards/.
+    :param output_dir: Directory to write the per-prompt files to.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    exported = 0
+
+    for record in iter_shard_records(input_dir):
+        prompt_id = record.pop("id", None)
+        if not prompt_id:
+            continue
+        markdown = record.pop("markdown", "")
+
+        with open(os.path.join(output_dir, f"{prompt_id}.json"), 'w', encoding='utf-8') as json_file:
+            json.dump(record, json_file, indent=2, ensure_ascii=False)
+        with open(os.path.join(output_dir, f"{prompt_id}.md"), 'w', encoding='utf-8') as md_file:
+            md_file.write(markdown)
+        exported += 1
+
+    print(f"Exported {exported} record(s) to {output_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export sharded batch output to per-prompt JSON and markdown files.")
+    parser.add_argument("--input-dir", required=True, help="Batch output directory containing the shards/ folder.")
+    parser.add_argument("--output-dir", required=True, help="Directory to write the .json and .md files to.")
+
+    args = parser.parse_args()
+
+    export_shards(args.input_dir, args.output_dir)
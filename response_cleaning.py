@@ -0,0 +1,117 @@
+"""
+Response post-processing shared by ollama-batch-process.py and response-reclean.py.
+
+A raw model response is split into its <think> reasoning and the answer,
+and the answer is turned into the markdown written next to it by a
+pipeline of precompiled regex rules: the built-in marker stripping plus any
+[[postprocess.rules]] from config.toml. A ResponseCleaner holds nothing but
+compiled patterns, so it is cheap to send to worker processes.
+"""
+import re
+
+THINK_BLOCK = re.compile(r'<think>(.*?)</think>', re.DOTALL)
+
+# Article markers and model artifacts removed from the markdown. One
+# pattern per marker: re finds a literal prefix much faster than it scans
+# for any branch of an alternation.
+BUILTIN_RULES = [
+    (re.compile(r'---BEGIN ARTICLE---\s*'), ''),
+    (re.compile(r'---END ARTICLE---\s*'), ''),
+    (re.compile(r'---END---\s*'), ''),
+    (re.compile(r'\\boxed\{.*?\}', re.DOTALL), ''),
+    (re.compile(r'</think>'), ''),
+    (re.compile(r'<CURRENT_CURSOR_POSITION>'), ''),
+]
+
+RULE_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}
+RULE_TARGETS = ("markdown", "response")
+
+def compile_rule(rule):
+    """
+    Compile one [[postprocess.rules]] entry into (target, pattern, replacement).
+
+    :param rule: Dict with "pattern", and optionally "replacement" (default
+                 ""), "flags" (any of "imsx") and "target" ("markdown", the
+                 default, or "response" to also change the JSON response;
+                 the model's output itself is kept as raw_response).
+    """
+    flags = 0
+    for flag in rule.get("flags", ""):
+        if flag not in RULE_FLAGS:
+            raise ValueError(f"Unknown regex flag {flag!r} in rule {rule.get('pattern')!r}")
+        flags |= RULE_FLAGS[flag]
+    target = rule.get("target", "markdown")
+    if target not in RULE_TARGETS:
+        raise ValueError(f"Unknown target {target!r} in rule {rule.get('pattern')!r}")
+    try:
+        pattern = re.compile(rule["pattern"], flags)
+    except KeyError:
+        raise ValueError(f"Post-processing rule without a pattern: {rule}")
+    except re.error as e:
+        raise ValueError(f"Bad post-processing pattern {rule['pattern']!r}: {e}")
+    return target, pattern, rule.get("replacement", "")
+
+class ResponseCleaner:
+    """
+    Splits a raw response into (response, think, markdown).
+
+    The response is the answer with its <think> block removed, after any
+    "response" rules; the markdown is the response after the built-in
+    marker stripping and the "markdown" rules. Rules run in config order.
+    """
+
+    def __init__(self, rules=(), extract_think=True, strip_markers=True):
+        compiled = [compile_rule(rule) for rule in rules]
+        self.extract_think = extract_think
+        self.response_rules = [(pattern, replacement) for target, pattern, replacement in compiled if target == "response"]
+        self.markdown_rules = (BUILTIN_RULES if strip_markers else []) + [
+            (pattern, replacement) for target, pattern, replacement in compiled if target == "markdown"
+        ]
+
+    @classmethod
+    def from_config(cls, settings):
+        """Build a cleaner from the [postprocess] table of config.toml."""
+        return cls(
+            rules=settings.get("rules", []),
+            extract_think=bool(settings.get("extract_think", True)),
+            strip_markers=bool(settings.get("strip_markers", True)),
+        )
+
+    def clean(self, text):
+        think = ""
+        if self.extract_think:
+            think = "\n\n".join(block.strip() for block in THINK_BLOCK.findall(text)).strip()
+            text = THINK_BLOCK.sub('', text)
+        for pattern, replacement in self.response_rules:
+            text = pattern.sub(replacement, text)
+        response = text.strip()
+
+        markdown = response
+        for pattern, replacement in self.markdown_rules:
+            markdown = pattern.sub(replacement, markdown)
+        return response, think, markdown.strip()
+
+DEFAULT_CLEANER = ResponseCleaner()
+
+def raw_response(record):
+    """
+    The model's untouched output from a stored record, for re-cleaning.
+    Records from before raw_response was stored are rebuilt from their
+    response and think fields.
+    """
+    if record.get("raw_response") is not None:
+        return record["raw_response"]
+    response = record.get("response") or ""
+    think = record.get("think")
+    return f"<think>{think}</think>\n{response}" if think else response
+
+# Worker processes get the cleaner once, from the pool initializer, rather
+# than with every response
+_worker_cleaner = DEFAULT_CLEANER
+
+def init_worker(cleaner):
+    global _worker_cleaner
+    _worker_cleaner = cleaner
+
+def clean_in_worker(text):
+    return _worker_cleaner.clean(text)
@@ -0,0 +1,194 @@
+"""
+Shared helpers for the response post-processing scripts.
+
+A batch output directory is indexed through its .manifest.jsonl (written by
+ollama-batch-process.py), which records the id, model, update time and
+location of every response. Older output directories without a manifest are
+indexed by listing their *.json files and shards instead. Records are then
+read and parsed in a process pool and yielded in index order, a bounded
+window at a time, so memory stays flat however large the run is.
+"""
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+MANIFEST_FILENAME = ".manifest.jsonl"
+SHARD_DIR = "shards"
+
+def load_index(input_dir):
+    """
+    Returns a list of index entries ({"id", "location", "model", "updated"}),
+    one per prompt, with the latest manifest entry winning.
+
+    :param input_dir: Batch output directory.
+    """
+    manifest_path = os.path.join(input_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return scan_index(input_dir)
+
+    entries = {}
+    with open(manifest_path, 'r', encoding='utf-8') as manifest:
+        for line in manifest:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Truncated last line of an interrupted run
+                continue
+            prompt_id = entry.get("id")
+            if not prompt_id:
+                continue
+            entries.pop(prompt_id, None)  # keep latest-write order
+            entries[prompt_id] = {
+                "id": prompt_id,
+                "location": entry.get("location") or f"{prompt_id}.json",
+                "model": entry.get("model"),
+                "updated": entry.get("updated"),
+            }
+    return list(entries.values())
+
+def scan_index(input_dir):
+    """Builds an index from the directory contents when there is no manifest."""
+    entries = {}
+    for filename in sorted(os.listdir(input_dir)):
+        if filename.endswith(".json"):
+            file_path = os.path.join(input_dir, filename)
+            entries[filename[:-len(".json")]] = {
+                "id": filename[:-len(".json")],
+                "location": filename,
+                "model": None,
+                "updated": datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat(),
+            }
+
+    shard_dir = os.path.join(input_dir, SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        for filename in sorted(os.listdir(shard_dir)):
+            if not (filename.startswith("responses-") and filename.endswith(".jsonl")):
+                continue
+            with open(os.path.join(shard_dir, filename), 'rb') as shard:
+                offset = 0
+                for line in shard:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        record = {}
+                    if record.get("id"):
+                        entries.pop(record["id"], None)
+                        entries[record["id"]] = {
+                            "id": record["id"],
+                            "location": f"{SHARD_DIR}/{filename}:{offset}",
+                            "model": record.get("model"),
+                            "updated": record.get("last_updated"),
+                        }
+                    offset += len(line)
+    return list(entries.values())
+
+def filter_index(entries, ids=None, since=None, until=None, model=None):
+    """
+    Yields the entries matching every given filter.
+
+    :param ids: Collection of prompt ids to keep.
+    :param since: ISO date or datetime; keep entries updated at or after it.
+    :param until: ISO date or datetime; keep entries updated before it.
+    :param model: Keep entries generated by this model. Entries whose model
+                  is unknown (no manifest) are kept and checked after loading.
+    """
+    for entry in entries:
+        if ids is not None and entry["id"] not in ids:
+            continue
+        updated = entry.get("updated") or ""
+        if since and updated < since:
+            continue
+        if until and updated >= until:
+            continue
+        if model and entry.get("model") not in (None, model):
+            continue
+        yield entry
+
+def read_record(input_dir, location):
+    """
+    Loads one response record. Locations are either a JSON file relative to
+    the output directory or "shards/<file>:<byte offset>".
+    """
+    path, _, offset = location.rpartition(":")
+    if path and offset.isdigit():
+        with open(os.path.join(input_dir, path), 'rb') as shard:
+            shard.seek(int(offset))
+            return json.loads(shard.readline())
+
+    with open(os.path.join(input_dir, location), 'r', encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+def _load_chunk(input_dir, entries, transform, model):
+    results = []
+    for entry in entries:
+        try:
+            record = read_record(input_dir, entry["location"])
+            if model and record.get("model", model) != model:
+                continue
+            results.append((entry, transform(record), None))
+        except FileNotFoundError:
+            # Listed in the manifest but removed since
+            continue
+        except Exception as e:
+            results.append((entry, None, e))
+    return results
+
+def _identity(record):
+    return record
+
+def iter_records(input_dir, entries, transform=None, model=None, workers=None, chunk_size=256):
+    """
+    Reads and transforms the records for the given index entries in a
+    process pool, yielding (entry, result, error) tuples in index order.
+
+    :param transform: Picklable function applied to each record in the
+                      worker process; errors it raises are returned as error.
+    :param model: Drop records whose "model" field doesn't match.
+    :param workers: Process count, defaults to the CPU count. 1 reads inline.
+    :param chunk_size: Entries per task; at most 2 * workers tasks are in flight.
+    """
+    transform = transform or _identity
+    workers = workers or os.cpu_count() or 1
+
+    def chunks():
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if workers == 1:
+        for chunk in chunks():
+            yield from _load_chunk(input_dir, chunk, transform, model)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks():
+            pending.append(pool.submit(_load_chunk, input_dir, chunk, transform, model))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def add_filter_arguments(parser):
+    """Adds the shared --id/--ids-file/--since/--until/--model/--workers options."""
+    parser.add_argument("--id", action="append", dest="ids", help="Only include this prompt id (repeatable).")
+    parser.add_argument("--ids-file", help="File with one prompt id per line to include.")
+    parser.add_argument("--since", help="Only include responses updated at or after this ISO date/time.")
+    parser.add_argument("--until", help="Only include responses updated before this ISO date/time.")
+    parser.add_argument("--model", help="Only include responses generated by this model.")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count).")
+
+def ids_from_args(args):
+    """Collects the prompt ids given with --id and --ids-file, or None for all."""
+    ids = set(args.ids or [])
+    if args.ids_file:
+        with open(args.ids_file, 'r', encoding='utf-8') as ids_file:
+            ids.update(line.strip() for line in ids_file if line.strip())
+    return ids or None
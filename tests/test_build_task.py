@@ -0,0 +1,74 @@
+import importlib.util
+import tempfile
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+class BuildTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manifest = batch.ResponseManifest(self.tmp.name)
+        self.manifest.load()
+
+    def tearDown(self):
+        self.manifest.close()
+        self.tmp.cleanup()
+
+    def build(self, prompt="p", generation=None, model="m"):
+        options = batch.output_generation_settings(generation or {})
+        return batch.build_task("id", prompt, "sys", model, options, None, self.manifest, self.tmp.name)
+
+    def generate(self, **kwargs):
+        task = self.build(**kwargs)
+        self.manifest.record(task["id"], task["input_hash"], None, kwargs.get("model", "m"), "id.json")
+        return task
+
+    def test_unchanged_prompt_is_skipped(self):
+        self.generate()
+        self.assertIsNone(self.build())
+
+    def test_changed_prompt_or_model_is_regenerated(self):
+        self.generate()
+        self.assertIsNotNone(self.build(prompt="edited"))
+        self.assertIsNotNone(self.build(model="other"))
+
+    def test_settings_that_do_not_change_the_text_keep_responses(self):
+        self.generate(generation={"max_tokens": 100})
+        self.assertIsNone(self.build(generation={"max_tokens": 100, "warmup": False, "model_keep_alive": "5m"}))
+        # Stop markers only cut streamed responses
+        self.assertIsNone(self.build(generation={"max_tokens": 100, "stop_markers": ["END"]}))
+
+    def test_settings_that_change_the_text_regenerate(self):
+        self.generate(generation={"max_tokens": 100})
+        self.assertIsNotNone(self.build(generation={"max_tokens": 200}))
+        self.assertIsNotNone(self.build(generation={"max_tokens": 100, "stream": True, "stop_markers": ["END"]}))
+
+    def test_recorded_context_digest_defers_to_prepare_task(self):
+        task = self.build()
+        self.manifest.record(task["id"], task["input_hash"], "digest", "m", "id.json")
+        self.assertEqual(self.build()["expected_context_digest"], "digest")
+
+class ResponseManifestTest(unittest.TestCase):
+    def test_latest_entry_survives_reload_and_compaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            manifest = batch.ResponseManifest(tmp)
+            manifest.load()
+            for i in range(3):
+                manifest.record("a", f"h{i}", None, "m", "a.json")
+            with open(manifest.path, "a", encoding="utf-8") as f:
+                f.write('{"id": "torn"')
+            manifest.close()
+
+            reloaded = batch.ResponseManifest(tmp)
+            reloaded.load()
+            reloaded.close()
+            self.assertEqual(reloaded.get("a")["input_hash"], "h2")
+            self.assertIsNone(reloaded.get("torn"))
+            self.assertEqual(len(manifest.path.read_text(encoding="utf-8").splitlines()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import importlib.util
+import unittest
+from pathlib import Path
+
+import aiohttp.web
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+class OllamaClientPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.peers = []
+        self.connections = []
+
+        async def tags(request):
+            self.peers.append(request.transport.get_extra_info("peername")[1])
+            self.connections.append(request.transport)
+            return aiohttp.web.json_response({"models": []})
+
+        app = aiohttp.web.Application()
+        app.router.add_get("/api/tags", tags)
+        self.runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.host = f"127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_requests_reuse_one_connection_until_closed(self):
+        pool = batch.OllamaClientPool({self.host: 1})
+        client = pool.get(self.host)
+        await client.list()
+        await client.list()
+        self.assertEqual(len(set(self.peers)), 1)
+
+        await pool.close()
+        self.assertNotIn(self.host, pool)
+        # The server sees the kept-alive connection go away
+        for _ in range(100):
+            if self.connections[0].is_closing():
+                break
+            await asyncio.sleep(0.01)
+        self.assertTrue(self.connections[0].is_closing())
+
+    async def test_without_keep_alive_every_request_connects(self):
+        pool = batch.OllamaClientPool({self.host: 1}, keep_alive=False)
+        await pool.get(self.host).list()
+        await pool.get(self.host).list()
+        await pool.close()
+        self.assertEqual(len(set(self.peers)), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import importlib.util
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+def controller(initial=2, **kwargs):
+    return batch.ConcurrencyController("h", initial, max_limit=8, adaptive=True, window=2, **kwargs)
+
+async def run_window(ctrl, running, latency=1.0, units=100):
+    """Acquire `running` slots, start them all, and complete them successfully."""
+    for _ in range(running):
+        await ctrl.acquire()
+        ctrl.start()
+    for _ in range(running):
+        await ctrl.release(True, latency, units, started=True)
+
+class ConcurrencyControllerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_parked_workers_do_not_count_as_in_flight(self):
+        ctrl = batch.ConcurrencyController("h", 4)
+        for _ in range(4):
+            await ctrl.acquire()
+        for _ in range(3):
+            ctrl.start()
+        self.assertEqual((ctrl.reserved, ctrl.in_flight, ctrl.peak), (4, 3, 3))
+        await ctrl.release(None)
+        await ctrl.release(True, 1.0, 10, started=True)
+        self.assertEqual((ctrl.reserved, ctrl.in_flight, ctrl.peak), (2, 2, 3))
+
+    async def test_acquire_waits_for_a_reserved_slot(self):
+        ctrl = batch.ConcurrencyController("h", 1)
+        await ctrl.acquire()
+        waiter = asyncio.ensure_future(ctrl.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        await ctrl.release(None)
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_saturated_windows_raise_the_limit(self):
+        ctrl = controller()
+        await run_window(ctrl, 2)
+        self.assertEqual(ctrl.limit, 3)
+
+    async def test_unsaturated_windows_leave_the_limit_alone(self):
+        ctrl = controller(initial=4)
+        for _ in range(3):
+            await run_window(ctrl, 1)
+        self.assertEqual(ctrl.limit, 4)
+
+    async def test_rising_latency_backs_off(self):
+        ctrl = controller(initial=4)
+        await run_window(ctrl, 4, latency=1.0)
+        await run_window(ctrl, 2, latency=5.0)
+        self.assertEqual(ctrl.limit, 2)
+
+    async def test_failure_backs_off(self):
+        ctrl = controller(initial=4)
+        await ctrl.acquire()
+        ctrl.start()
+        await ctrl.release(False, started=True)
+        self.assertEqual((ctrl.limit, ctrl.in_flight), (2, 0))
+
+if __name__ == "__main__":
+    unittest.main()
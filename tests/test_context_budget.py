@@ -0,0 +1,49 @@
+import importlib.util
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+TRUNCATED = "(content truncated for brevity)"
+
+class AllocateTokenBudgetTest(unittest.TestCase):
+    def test_everything_fits(self):
+        self.assertEqual(batch.allocate_token_budget([10, 20], 100), [10, 20])
+
+    def test_short_references_leave_their_surplus_to_long_ones(self):
+        self.assertEqual(batch.allocate_token_budget([500, 10, 300], 400), [195, 10, 195])
+
+    def test_no_budget(self):
+        self.assertEqual(batch.allocate_token_budget([10, 20], -5), [0, 0])
+
+class FitReferenceTest(unittest.TestCase):
+    def test_short_text_is_unchanged(self):
+        self.assertEqual(batch.fit_reference("One.\n\nTwo.", 100), "One.\n\nTwo.")
+
+    def test_keeps_whole_paragraphs_then_whole_sentences(self):
+        text = "a" * 40 + "\n\n" + "First sentence here. " + "b" * 200
+        fitted = batch.fit_reference(text, 20)
+        self.assertEqual(fitted, "a" * 40 + "\n\nFirst sentence here.\n\n" + TRUNCATED)
+
+    def test_text_without_breaks_is_cut_at_a_word(self):
+        fitted = batch.fit_reference("word " * 100, 5)
+        self.assertTrue(fitted.startswith("word word word"))
+        self.assertIn("...", fitted)
+        self.assertTrue(fitted.endswith(TRUNCATED))
+
+class ReferenceTokenBudgetTest(unittest.TestCase):
+    def test_default_budget(self):
+        self.assertEqual(batch.reference_token_budget({}, {}, ""), batch.DEFAULT_REFERENCE_TOKENS)
+
+    def test_capped_by_the_context_window(self):
+        budget = batch.reference_token_budget({"reserve_tokens": 500}, {"num_ctx": 2048}, "x" * 400)
+        self.assertEqual(budget, 2048 - 500 - 100)
+
+    def test_never_negative(self):
+        self.assertEqual(batch.reference_token_budget({}, {"num_ctx": 100}, ""), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import importlib.util
+import time
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+def item(prompt_id, prompt="p", priority=0, model="m", context_digest=None):
+    return {
+        "id": prompt_id, "chat_prompt": prompt, "context_block": "", "references": None,
+        "system_message": "", "model": model, "priority": priority, "context_digest": context_digest,
+    }
+
+class DispatchQueueTest(unittest.IsolatedAsyncioTestCase):
+    async def test_priority_first_then_longest_job(self):
+        dispatch = batch.DispatchQueue(maxsize=8)
+        dispatch.register_host("a", 0)
+        await dispatch.put(item("short", "x" * 40))
+        await dispatch.put(item("long", "x" * 4000))
+        await dispatch.put(item("urgent", "x", priority=5))
+        order = [(await dispatch.get("a"))["id"] for _ in range(3)]
+        self.assertEqual(order, ["urgent", "long", "short"])
+
+    async def test_items_only_go_to_hosts_serving_their_model(self):
+        dispatch = batch.DispatchQueue(maxsize=8)
+        dispatch.register_host("a", 0, models=["llama3"])
+        dispatch.register_host("b", 1, models=["qwen:7b"])
+        await dispatch.put(item("q", model="qwen:7b"))
+        await dispatch.put(item("l", model="llama3:latest"))
+        self.assertEqual((await dispatch.get("a"))["id"], "l")
+        self.assertEqual((await dispatch.get("b"))["id"], "q")
+        await dispatch.put(item("l2", model="llama3"))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(dispatch.get("b"), 0.3)
+
+    async def test_idle_faster_host_hedges_a_running_prompt(self):
+        dispatch = batch.DispatchQueue(maxsize=8, hedging=True, hedge_budget=1.0, hedge_delay=0)
+        dispatch.register_host("a", 0)
+        dispatch.register_host("b", 1, speed=2.0)
+        await dispatch.put(item("p", "x" * 4000))
+        await dispatch.close()
+        running = await dispatch.get("a")
+        hedge = await asyncio.wait_for(dispatch.get("b"), 1)
+        self.assertIs(hedge, running)
+        self.assertEqual((hedge["hedge_host"], dispatch.hedges["issued"]), ("b", 1))
+
+    async def test_hedges_stay_within_budget(self):
+        dispatch = batch.DispatchQueue(maxsize=8, hedging=True, hedge_budget=0.0, hedge_delay=0)
+        dispatch.register_host("a", 0)
+        dispatch.register_host("b", 1, speed=2.0)
+        await dispatch.put(item("p", "x" * 4000))
+        await dispatch.close()
+        await dispatch.get("a")
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(dispatch.get("b"), 0.3)
+
+    async def test_affinity_keeps_shared_references_on_one_host(self):
+        dispatch = batch.DispatchQueue(maxsize=8, affinity=True)
+        dispatch.register_host("a", 0)
+        dispatch.register_host("b", 1)
+        await dispatch.put(item("first", context_digest="refs"))
+        self.assertEqual((await dispatch.get("a"))["id"], "first")
+        await dispatch.put(item("other", "x" * 4000))
+        await dispatch.put(item("second", context_digest="refs"))
+        self.assertEqual((await dispatch.get("a"))["id"], "second")
+        self.assertEqual((await dispatch.get("b"))["id"], "other")
+
+    async def test_get_returns_none_once_closed_and_done(self):
+        dispatch = batch.DispatchQueue(maxsize=8)
+        dispatch.register_host("a", 0)
+        await dispatch.put(item("p"))
+        await dispatch.close()
+        await dispatch.get("a")
+        await dispatch.task_done()
+        self.assertIsNone(await asyncio.wait_for(dispatch.get("a"), 1))
+
+    async def test_queue_wait_starts_when_the_item_is_queued(self):
+        dispatch = batch.DispatchQueue(maxsize=1)
+        dispatch.register_host("a", 0)
+        await dispatch.put(item("first"))
+        blocked = asyncio.ensure_future(dispatch.put(item("second")))
+        await asyncio.sleep(0.2)
+        self.assertFalse(blocked.done())
+
+        await dispatch.get("a")
+        await blocked
+        second = await dispatch.get("a")
+        self.assertLess(time.monotonic() - second["ready_at"], 0.1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import importlib.util
+import unittest
+from pathlib import Path
+
+import httpx
+from ollama import ResponseError
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+class ProbeClient:
+    def __init__(self, failures=0):
+        self.failures = failures
+
+    async def list(self):
+        if self.failures:
+            self.failures -= 1
+            raise httpx.ConnectError("refused")
+        return {"models": []}
+
+class HostHealthTest(unittest.IsolatedAsyncioTestCase):
+    async def test_ejects_after_consecutive_failures_only(self):
+        health = batch.HostHealth("h", ProbeClient(), failure_threshold=2, probe_interval=60)
+        health.record_failure()
+        health.record_success()
+        health.record_failure()
+        self.assertTrue(health.is_available)
+        health.record_failure()
+        self.assertFalse(health.is_available)
+        self.assertEqual(health.ejections, 1)
+        health.shutdown()
+
+    async def test_probe_brings_the_host_back(self):
+        health = batch.HostHealth("h", ProbeClient(failures=1), failure_threshold=1, probe_interval=0.01)
+        health.record_failure()
+        self.assertFalse(health.is_available)
+        await asyncio.wait_for(health.wait_available(), 1)
+        self.assertEqual((health.consecutive_failures, health.ejected_since), (0, None))
+
+class HostFailureTest(unittest.TestCase):
+    def test_host_failures(self):
+        for error in (httpx.ConnectError("x"), httpx.ReadError("x"), asyncio.TimeoutError(),
+                      ResponseError("boom", 500), ResponseError("CUDA out of memory", 400)):
+            self.assertTrue(batch.is_host_failure(error), error)
+
+    def test_prompt_errors_are_not_host_failures(self):
+        for error in (ResponseError("model not found", 404), ResponseError("bad request", 400), ValueError("x")):
+            self.assertFalse(batch.is_host_failure(error), error)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import asyncio
+import importlib.util
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+class IngestPromptsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stats = {"processed": 0, "skipped": 0, "failed": 0}
+        dispatch = batch.DispatchQueue(maxsize=16)
+        dispatch.register_host("127.0.0.1:1", 0)
+        self.manifest = batch.ResponseManifest(self.tmp.name)
+        self.manifest.load()
+        self.journal = batch.RunJournal(self.tmp.name)
+        self.journal.open()
+        self.run = batch.BatchRun(
+            "m", self.tmp.name, self.stats, dispatch, manifest=self.manifest, journal=self.journal,
+        )
+
+    async def asyncTearDown(self):
+        self.journal.close()
+        self.manifest.close()
+        self.tmp.cleanup()
+
+    async def ingest(self, prompts):
+        task_queue = asyncio.Queue()
+        await batch.ingest_prompts(prompts, task_queue, self.run, "sys")
+        return [task_queue.get_nowait() for _ in range(task_queue.qsize())]
+
+    async def test_invalid_priority_defaults_to_zero(self):
+        tasks = await self.ingest([
+            ({"id": "a", "content": "x", "priority": "high"}, "p.jsonl", None),
+            ({"id": "b", "content": "y", "priority": "3"}, "p.jsonl", None),
+            ({"id": "c", "content": "z", "priority": None}, "p.jsonl", None),
+        ])
+        self.assertEqual([(t["id"], t["priority"]) for t in tasks], [("a", 0), ("b", 3), ("c", 0)])
+
+    async def test_repeated_prompts_get_distinct_ids(self):
+        tasks = await self.ingest([
+            ("same", "a.txt", None), ("other", "a.txt", None), ("same", "a.txt", None), ("same", "b.txt", None),
+        ])
+        ids = [t["id"] for t in tasks]
+        self.assertEqual(len(set(ids)), 4)
+        self.assertEqual(ids[0], batch.derive_prompt_id("same", "a.txt"))
+        self.assertEqual(ids[2], batch.derive_prompt_id("same", "a.txt", 1))
+        self.assertEqual(ids[3], batch.derive_prompt_id("same", "b.txt"))
+
+    async def test_repeat_tracking_is_bounded(self):
+        prompts = [("first", "a.txt", None), ("second", "a.txt", None), ("third", "a.txt", None),
+                   ("second", "a.txt", None), ("first", "a.txt", None)]
+        with mock.patch.object(batch, "REPEAT_WINDOW", 2):
+            tasks = await self.ingest(prompts)
+        ids = [t["id"] for t in tasks]
+        # "second" is still in the window; "first" dropped out of it
+        self.assertEqual(ids[3], batch.derive_prompt_id("second", "a.txt", 1))
+        self.assertEqual(ids[4], batch.derive_prompt_id("first", "a.txt"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+def task(prompt_id, prompt="p", model="llama3", input_hash="h1", priority=0):
+    return {"id": prompt_id, "prompt": prompt, "model": model, "input_hash": input_hash, "priority": priority}
+
+class LeaseQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "queue.sqlite")
+        self.queue = self.open_queue("a")
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp.cleanup()
+
+    def open_queue(self, driver_id, lease_seconds=120.0):
+        queue = batch.LeaseQueue(self.path, driver_id=driver_id, lease_seconds=lease_seconds)
+        queue.open()
+        return queue
+
+    def finish(self, queue, prompt_ids, state="done"):
+        for prompt_id in prompt_ids:
+            queue.complete(prompt_id, state)
+        queue.heartbeat()
+
+    def test_claims_highest_priority_first_and_only_once(self):
+        self.queue.add([task("low"), task("high", priority=5), task("mid", priority=1)])
+        self.assertEqual([t["id"] for t in self.queue.claim(2)], ["high", "mid"])
+        self.assertEqual([t["id"] for t in self.queue.claim(5)], ["low"])
+        self.assertEqual(self.queue.claim(5), [])
+        self.assertEqual(self.queue.outstanding(), 3)
+
+    def test_readding_unchanged_prompt_keeps_its_state(self):
+        self.queue.add([task("x")])
+        self.queue.claim(1)
+        self.finish(self.queue, ["x"])
+        self.queue.add([task("x")])
+        self.assertEqual(self.queue.claim(1), [])
+        self.assertEqual(self.queue.counts(), {"done": 1})
+
+    def test_readding_edited_prompt_queues_it_again(self):
+        self.queue.add([task("x", prompt="old")])
+        self.queue.claim(1)
+        self.finish(self.queue, ["x"])
+        self.queue.add([task("x", prompt="new", input_hash="h2")])
+        self.assertEqual(self.queue.counts(), {"pending": 1})
+        self.assertEqual([t["prompt"] for t in self.queue.claim(1)], ["new"])
+
+    def test_completion_of_replaced_prompt_does_not_finish_new_version(self):
+        self.queue.add([task("x", prompt="old")])
+        self.queue.claim(1)
+        self.queue.add([task("x", prompt="new", input_hash="h2")])
+        self.finish(self.queue, ["x"])
+        self.assertEqual(self.queue.counts(), {"pending": 1})
+
+    def test_models_are_normalized_and_filtered_exactly(self):
+        self.queue.add([task("a", model="llama3"), task("b", model="qwen:7b")])
+        self.assertEqual(self.queue.unfinished({"llama3:latest"}), 1)
+        self.assertEqual([t["id"] for t in self.queue.claim(5, {"llama3:latest"})], ["a"])
+        self.assertEqual(self.queue.claim(5, {"llama3:latest"}), [])
+        self.assertEqual(self.queue.unfinished(), 2)
+
+    def test_task_without_model_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.queue.add([task("x", model=None)])
+        self.assertEqual(self.queue.counts(), {})
+
+    def test_expired_lease_is_claimed_by_another_driver(self):
+        self.queue.close()
+        self.queue = self.open_queue("a", lease_seconds=-1)
+        other = self.open_queue("b")
+        try:
+            self.queue.add([task("x")])
+            self.queue.claim(1)
+            self.assertEqual([t["id"] for t in other.claim(1)], ["x"])
+            self.finish(other, ["x"])
+            self.assertEqual(other.counts(), {"done": 1})
+        finally:
+            other.close()
+
+if __name__ == "__main__":
+    unittest.main()
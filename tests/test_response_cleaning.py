@@ -0,0 +1,49 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from response_cleaning import ResponseCleaner, raw_response
+
+RAW = "<think>plan it</think>\n---BEGIN ARTICLE---\n# Hello world\n---END ARTICLE---\nextra"
+
+class ResponseCleanerTest(unittest.TestCase):
+    def test_splits_think_and_strips_markers(self):
+        response, think, markdown = ResponseCleaner().clean(RAW)
+        self.assertEqual(think, "plan it")
+        self.assertEqual(response, "---BEGIN ARTICLE---\n# Hello world\n---END ARTICLE---\nextra")
+        self.assertEqual(markdown, "# Hello world\nextra")
+
+    def test_rules_apply_to_their_target_in_order(self):
+        cleaner = ResponseCleaner(rules=[
+            {"pattern": "hello", "replacement": "Hi", "flags": "i", "target": "response"},
+            {"pattern": r"^extra$", "flags": "m"},
+        ])
+        response, _, markdown = cleaner.clean(RAW)
+        self.assertIn("# Hi world", response)
+        self.assertIn("extra", response)
+        self.assertEqual(markdown, "# Hi world")
+
+    def test_think_extraction_and_markers_can_be_turned_off(self):
+        cleaner = ResponseCleaner.from_config({"extract_think": False, "strip_markers": False})
+        response, think, markdown = cleaner.clean(RAW)
+        self.assertEqual((response, think), (RAW, ""))
+        self.assertEqual(markdown, RAW)
+
+    def test_bad_rules_are_rejected(self):
+        for rule in ({"pattern": "(", }, {"pattern": "x", "flags": "q"}, {"pattern": "x", "target": "think"}, {}):
+            with self.assertRaises(ValueError):
+                ResponseCleaner(rules=[rule])
+
+class RawResponseTest(unittest.TestCase):
+    def test_stored_raw_response_wins(self):
+        record = {"response": "Hi", "think": "t", "raw_response": "<think>t</think>\nHello"}
+        self.assertEqual(raw_response(record), "<think>t</think>\nHello")
+
+    def test_older_records_are_rebuilt(self):
+        self.assertEqual(raw_response({"response": "Hello", "think": "t"}), "<think>t</think>\nHello")
+        self.assertEqual(raw_response({"response": "Hello"}), "Hello")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import asyncio
+import importlib.util
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+class FakeClient:
+    """Streams the given chunks the way ollama's AsyncClient.chat(stream=True) does."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.sent = 0
+
+    async def chat(self, **kwargs):
+        async def stream():
+            for content in self.chunks:
+                self.sent += 1
+                yield {"message": {"content": content}, "done": False}
+            yield {"message": {"content": ""}, "done": True, "eval_count": len(self.chunks)}
+        return stream()
+
+def run_stream(chunks, stop_markers=("---END ARTICLE---",)):
+    client = FakeClient(chunks)
+    generation = {"stream": True, "stop_markers": list(stop_markers)}
+    text, final, metrics = asyncio.run(batch.stream_chat(client, "m", [], generation))
+    return text, final, metrics, client
+
+class StreamChatStopMarkerTest(unittest.TestCase):
+    def test_marker_named_while_thinking_does_not_stop(self):
+        chunks = [
+            "<think>Plan: write the article, then end with ---END", " ARTICLE--- as asked.</", "think>",
+            "---BEGIN ARTICLE---\n# Title\n", "Body text.\n", "---END ARTICLE---", "\ntrailing", " junk",
+        ]
+        text, final, metrics, client = run_stream(chunks)
+        self.assertEqual(metrics["stop_reason"], "stop_marker")
+        self.assertTrue(text.endswith("Body text.\n---END ARTICLE---"))
+        self.assertIn("# Title", text)
+        self.assertNotIn("trailing", text)
+        self.assertIsNone(final)
+
+    def test_marker_in_answer_stops_without_think_block(self):
+        text, _, metrics, client = run_stream(["# Title\nBody ---END ART", "ICLE--- extra", " more", " more"])
+        self.assertEqual(metrics["stop_reason"], "stop_marker")
+        self.assertEqual(text, "# Title\nBody ---END ARTICLE---")
+        self.assertEqual(client.sent, 2)
+
+    def test_unclosed_think_block_runs_to_completion(self):
+        text, final, metrics, _ = run_stream(["<think>mention ---END ARTICLE---", " and keep going"])
+        self.assertEqual(metrics["stop_reason"], "done")
+        self.assertEqual(text, "<think>mention ---END ARTICLE--- and keep going")
+        self.assertIsNotNone(final)
+
+if __name__ == "__main__":
+    unittest.main()
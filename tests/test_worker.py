@@ -0,0 +1,122 @@
+import asyncio
+import importlib.util
+import tempfile
+import unittest
+from pathlib import Path
+
+SCRIPT = Path(__file__).resolve().parent.parent / "ollama-batch-process.py"
+spec = importlib.util.spec_from_file_location("ollama_batch_process", SCRIPT)
+batch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(batch)
+
+HOST = "127.0.0.1:1"
+
+class BlockingClient:
+    """Answers chat() requests once release() is called, counting the requests it holds."""
+
+    def __init__(self):
+        self.running = 0
+        self.calls = 0
+        self._released = asyncio.Event()
+
+    def release(self):
+        self._released.set()
+
+    async def chat(self, **kwargs):
+        self.calls += 1
+        self.running += 1
+        try:
+            await self._released.wait()
+        finally:
+            self.running -= 1
+        return {"message": {"content": "answer"}, "done": True, "eval_count": 1}
+
+    async def list(self):
+        return {"models": []}
+
+def ready_item(prompt_id):
+    return {
+        "id": prompt_id, "input_hash": prompt_id, "context_digest": None,
+        "prompt": prompt_id, "chat_prompt": prompt_id, "system_message": "",
+        "context_block": "", "references": None, "model": "m", "options": {},
+    }
+
+class WorkerTestCase(unittest.IsolatedAsyncioTestCase):
+    """Runs worker() slots for one host against a fake client and an on-disk writer."""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.stats = {
+            "processed": 0, "skipped": 0, "failed": 0, "retried": 0, "cached": 0, "deduplicated": 0,
+            "pipeline": {"ready_peak": 0, "ready_wait_seconds": 0.0},
+        }
+        self.dispatch = batch.DispatchQueue(maxsize=16)
+        self.dispatch.register_host(HOST, 0)
+        self.writer = batch.ResponseWriter(self.tmp.name, flush_interval=0.01)
+        await self.writer.start()
+        self.run = batch.BatchRun("m", self.tmp.name, self.stats, self.dispatch, writer=self.writer)
+        self.client = BlockingClient()
+        self.workers = []
+
+    async def asyncTearDown(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await self.writer.close()
+        self.tmp.cleanup()
+
+    def start_workers(self, slots, controller=None, health=None):
+        self.workers += [
+            asyncio.create_task(batch.worker(HOST, 0, slot, self.run, controller, self.client, health))
+            for slot in range(slots)
+        ]
+
+    async def wait_until(self, condition, timeout=2.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            if asyncio.get_running_loop().time() > deadline:
+                self.fail("condition not reached")
+            await asyncio.sleep(0.01)
+
+    async def finish(self):
+        self.client.release()
+        await self.dispatch.close()
+        await asyncio.wait_for(self.dispatch.wait_finished(), 2)
+        await asyncio.wait_for(asyncio.gather(*self.workers), 2)
+        await self.writer.close()
+
+class MetricsInFlightTest(WorkerTestCase):
+    async def test_in_flight_gauge_counts_running_requests(self):
+        controller = batch.ConcurrencyController(HOST, 4)
+        self.start_workers(4, controller)
+        for i in range(3):
+            await self.dispatch.put(ready_item(f"p{i}"))
+        await self.wait_until(lambda: self.client.running == 3)
+
+        metrics = batch.MetricsServer(self.run, asyncio.Queue(), {HOST: controller}, {})
+        self.assertIn(f'ollama_batch_in_flight{{host="{HOST}"}} 3', metrics.render().splitlines())
+
+        await self.finish()
+        self.assertIn(f'ollama_batch_in_flight{{host="{HOST}"}} 0', metrics.render().splitlines())
+        self.assertEqual((controller.peak, self.stats["processed"]), (3, 3))
+
+class EjectedHostTest(WorkerTestCase):
+    async def test_waiting_worker_takes_nothing_while_host_is_ejected(self):
+        health = batch.HostHealth(HOST, self.client, failure_threshold=1, probe_interval=0.2)
+        self.dispatch.register_host(HOST, 0, health=health)
+        self.start_workers(1, health=health)
+        await self.wait_until(lambda: self.dispatch._waiting.get(HOST))
+
+        health.record_failure()
+        await self.dispatch.put(ready_item("p0"))
+        await asyncio.sleep(0.1)
+        self.assertEqual((self.client.calls, self.dispatch.qsize()), (0, 1))
+
+        # The probe brings the host back and the waiting worker picks the prompt up
+        await self.wait_until(lambda: self.client.calls == 1)
+        await self.finish()
+        self.assertEqual(self.stats["processed"], 1)
+        health.shutdown()
+
+if __name__ == "__main__":
+    unittest.main()